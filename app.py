@@ -1,5 +1,10 @@
-from flask import Flask, request, jsonify, render_template, Response, redirect, session
+from flask import Flask, request, jsonify, render_template, Response, redirect, session, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import func, tuple_, or_, event
+from sqlalchemy.orm import validates
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
 from openai import OpenAI
 from dotenv import load_dotenv
 from pathlib import Path
@@ -14,8 +19,17 @@ import json
 import csv
 from werkzeug.security import generate_password_hash, check_password_hash
 import hashlib
+import base64
+import socket
+import time
+import copy
+import random
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import threading
 import pytz
-from collections import defaultdict
+from collections import defaultdict, namedtuple, deque, OrderedDict
 import httpx  # used for Brevo email API + webhooks
 
 # -------------------------
@@ -45,7 +59,56 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'change-this-in-production')
 
-db = SQLAlchemy(app)
+# -------------------------
+# READ REPLICA (optional)
+# Dashboards, analytics and exports marked @replica_read query
+# DATABASE_REPLICA_URL when it is set; chat, bookings and every write stay
+# on the primary. A browser that just changed something reads from the
+# primary for REPLICA_STICKY_SECONDS, so it always sees its own writes.
+# -------------------------
+replica_url = os.getenv('DATABASE_REPLICA_URL')
+if replica_url and replica_url.startswith('postgresql://'):
+    replica_url = replica_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+if replica_url:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_url}
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+
+
+class RoutingSession(FlaskSQLAlchemySession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # Only SELECTs go to the replica - a bulk update()/delete(), an
+        # insert or a statement-less connection() in a replica view must
+        # still hit the (writable) primary.
+        if (bind is None and not self._flushing and has_request_context() and g.get('use_replica')
+                and getattr(clause, 'is_select', False)):
+            return db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
+
+
+def replica_read(view):
+    """Serves a read-only view from the replica, if configured."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if replica_url and session.get('primary_until', 0) < time.time():
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+WIDGET_ENDPOINTS = ('chat', 'chat_stream', 'widget_book')
+
+
+@app.after_request
+def stick_to_primary_after_write(response):
+    # The widget's chat turns and bookings never read a dashboard - no
+    # cookie for them.
+    if (replica_url and request.method in ('POST', 'PUT', 'PATCH', 'DELETE')
+            and response.status_code < 400 and request.endpoint not in WIDGET_ENDPOINTS):
+        session['primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+    return response
 
 # -------------------------
 # OPENAI CLIENT
@@ -89,13 +152,11 @@ def assign_next_agent(agency):
     Returns None for solo tier or when no active agents exist."""
     if (agency.tier or 'solo') == 'solo':
         return None
-    agents = Agent.query.filter_by(agency_id=agency.id, status='active').all()
-    if not agents:
+    best = Agent.query.filter_by(agency_id=agency.id, status='active') \
+        .order_by(Agent.lead_count.asc(), Agent.id.asc()).first()
+    if not best:
         return None
-    counts = {a.id: Lead.query.filter_by(agency_id=agency.id, agent_id=a.id).count()
-              for a in agents}
-    best = min(agents, key=lambda a: (counts[a.id], a.id))
-    print(f"👥 Round-robin: lead → agent {best.name} (ID {best.id}, {counts[best.id]} leads)")
+    print(f"👥 Round-robin: lead → agent {best.name} (ID {best.id}, {best.lead_count} leads)")
     return best
 
 # ─────────────────────────────────────────────────────
@@ -247,6 +308,38 @@ BOOKING_KEYWORDS = [
 ]
 
 
+# ─────────────────────────────────────────────────────
+# COMPILED KEYWORD MATCHERS
+# Each dictionary is folded into ONE precompiled alternation at import,
+# so a message is scanned once per dictionary instead of once per entry.
+# ─────────────────────────────────────────────────────
+
+def compile_keywords(words, word_boundary=False):
+    """Single regex for a whole keyword list. Alternatives are tried
+    longest-first so the most specific phrase is the one reported.
+    word_boundary=False keeps plain substring semantics (`kw in text`),
+    which is what the booking/contact/objection checks have always used."""
+    alternation = '|'.join(re.escape(w) for w in sorted(set(words), key=len, reverse=True))
+    if word_boundary:
+        return re.compile(rf'\b(?:{alternation})\b')
+    return re.compile(f'(?:{alternation})')
+
+
+def keyword_hits(matcher, text):
+    """All (position, keyword) hits of a compiled dictionary, in one pass."""
+    return [(m.start(), m.group(0)) for m in matcher.finditer(text)]
+
+
+WEEKDAY_MATCHER = compile_keywords(WEEKDAY_WORDS, word_boundary=True)
+VIEWING_OFFER_MATCHER = compile_keywords(VIEWING_OFFER_PHRASES)
+BOOKING_MATCHER = compile_keywords(BOOKING_KEYWORDS)
+# A reply counts as affirmative when it IS the word or starts with it
+# followed by a space ("yes", "yes please") - not "yesterday".
+AFFIRMATIVE_MATCHER = re.compile(
+    r'(?:' + '|'.join(re.escape(w) for w in sorted(set(AFFIRMATIVE_WORDS), key=len, reverse=True)) + r')(?: |\Z)'
+)
+
+
 def clean_whatsapp_number(number):
     if not number:
         return None
@@ -255,72 +348,190 @@ def clean_whatsapp_number(number):
     return cleaned if len(cleaned) >= 9 else None
 
 
-def send_email_brevo(to_email, subject, body):
-    """Central email sender via Brevo API. Returns True/False."""
-    BREVO_API_KEY = os.getenv("BREVO_API_KEY")
-    if not BREVO_API_KEY:
-        print("⚠️ BREVO_API_KEY not set - email not sent")
-        return False
-    if not to_email:
-        return False
-    try:
-        response = httpx.post(
-            "https://api.brevo.com/v3/smtp/email",
-            headers={
-                "api-key": BREVO_API_KEY,
-                "Content-Type": "application/json"
-            },
-            json={
+# ─────────────────────────────────────────────────────
+# EMAIL DISPATCHER (Brevo)
+# One keep-alive httpx.Client per process instead of a new TLS connection
+# per email. Several emails for one event go out in parallel on a small
+# thread pool (at most EMAIL_CONCURRENCY in flight), so the event takes as
+# long as its slowest send rather than the sum of them. 429/5xx and
+# connection errors are retried with jittered backoff before giving up -
+# the job queue's own retries come after that. BREVO_API_URL points the
+# dispatcher at a local fake server for testing; EMAIL_BATCH=1 sends a
+# multi-recipient event as ONE Brevo request using messageVersions.
+# ─────────────────────────────────────────────────────
+
+BREVO_API_URL = os.getenv("BREVO_API_URL", "https://api.brevo.com/v3")
+EMAIL_CONCURRENCY = int(os.getenv("EMAIL_CONCURRENCY", "8"))
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "3"))
+EMAIL_BATCH = os.getenv("EMAIL_BATCH", "0") == "1"
+EMAIL_RETRY_BASE = 0.5           # seconds; doubled per attempt, full jitter
+EMAIL_RETRY_MAX = 8.0
+BREVO_MAX_VERSIONS = 1000        # Brevo's messageVersions limit per request
+
+
+class EmailDispatcher:
+    def __init__(self, base_url, concurrency, max_retries):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._pool = None
+
+    def _ensure_open(self):
+        # Per PID, like the session flusher - sockets and threads opened
+        # before gunicorn forks are unusable in the workers.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._client = httpx.Client(
+                base_url=self.base_url, timeout=10,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency))
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="email")
+            self._pid = os.getpid()
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), EMAIL_RETRY_MAX)
+        return random.uniform(0, min(EMAIL_RETRY_BASE * 2 ** attempt, EMAIL_RETRY_MAX))
+
+    def post(self, payload):
+        """POSTs one /smtp/email request, retrying 429/5xx and transport
+        errors. Returns the final response, or None if it never got one."""
+        api_key = os.getenv("BREVO_API_KEY")
+        self._ensure_open()
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self._retry_delay(attempt - 1, response))
+            try:
+                response = self._client.post("/smtp/email", json=payload, headers={"api-key": api_key})
+            except httpx.TransportError as e:
+                print(f"⚠️ Brevo error (attempt {attempt + 1}): {e}")
+                response = None
+                continue
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            print(f"⚠️ Brevo {response.status_code} (attempt {attempt + 1})")
+        return response
+
+    def send(self, to_email, subject, body):
+        try:
+            response = self.post({
                 "sender": {"name": "Luxury Leads AI", "email": SMTP_EMAIL},
                 "to": [{"email": to_email}],
                 "subject": subject,
                 "textContent": body
-            },
-            timeout=10
-        )
-        if response.status_code in (200, 201):
+            })
+        except Exception as e:
+            print(f"⚠️ Brevo error: {e}")
+            return False
+        if response is not None and response.status_code in (200, 201):
             print(f"✅ EMAIL SENT via Brevo to: {to_email}")
             return True
-        else:
+        if response is not None:
             print(f"⚠️ Brevo failed ({response.status_code}): {response.text[:200]}")
-            return False
-    except Exception as e:
-        print(f"⚠️ Brevo error: {e}")
         return False
 
+    def send_batch(self, emails):
+        """All of `emails` in one request via messageVersions - Brevo
+        accepts or rejects the request as a whole."""
+        subject, body = emails[0][1], emails[0][2]
+        try:
+            response = self.post({
+                "sender": {"name": "Luxury Leads AI", "email": SMTP_EMAIL},
+                "subject": subject,
+                "textContent": body,
+                "messageVersions": [{"to": [{"email": to}], "subject": s, "textContent": b}
+                                    for to, s, b in emails]
+            })
+        except Exception as e:
+            print(f"⚠️ Brevo error: {e}")
+            return [False] * len(emails)
+        ok = response is not None and response.status_code in (200, 201)
+        if ok:
+            print(f"✅ EMAIL BATCH SENT via Brevo to {len(emails)} recipients")
+        elif response is not None:
+            print(f"⚠️ Brevo batch failed ({response.status_code}): {response.text[:200]}")
+        return [ok] * len(emails)
+
+    def send_many(self, emails):
+        """[(to_email, subject, body), ...] -> [sent?, ...] in the same order."""
+        if len(emails) == 1:
+            return [self.send(*emails[0])]
+        if EMAIL_BATCH:
+            results = []
+            for start in range(0, len(emails), BREVO_MAX_VERSIONS):
+                results += self.send_batch(emails[start:start + BREVO_MAX_VERSIONS])
+            return results
+        self._ensure_open()
+        return list(self._pool.map(lambda email: self.send(*email), emails))
+
+
+email_dispatcher = EmailDispatcher(BREVO_API_URL, EMAIL_CONCURRENCY, EMAIL_MAX_RETRIES)
+
+
+def send_emails_brevo(emails):
+    """Sends [(to_email, subject, body), ...] concurrently. Returns a list
+    of True/False per email, in order."""
+    if not os.getenv("BREVO_API_KEY"):
+        print("⚠️ BREVO_API_KEY not set - email not sent")
+        return [False] * len(emails)
+    pending = [i for i, (to_email, _, _) in enumerate(emails) if to_email]
+    results = [False] * len(emails)
+    if pending:
+        for i, sent in zip(pending, email_dispatcher.send_many([emails[i] for i in pending])):
+            results[i] = sent
+    return results
+
+
+def send_email_brevo(to_email, subject, body):
+    """Central email sender via Brevo API. Returns True/False."""
+    return send_emails_brevo([(to_email, subject, body)])[0]
+
 
 # ─────────────────────────────────────────────────────
 # LANGUAGE-AGNOSTIC QUESTION DETECTION
 # ─────────────────────────────────────────────────────
 
+CONTACT_QUESTION_MATCHER = compile_keywords([
+    "best way to reach you", "how can i reach you", "reach you",
+    "contact you", "whatsapp, phone, or email", "phone, or email"
+])
+CONTACT_CHANNEL_MATCHER = compile_keywords([
+    'email', 'e-mail', 'mail', 'correo', 'phone', 'telefon',
+    'teléfono', 'telefono', 'téléphone', 'telephone', 'telefone',
+    'telefoon', 'numer', 'número', 'numero'
+])
+NUMBER_QUESTION_MATCHER = compile_keywords([
+    "whatsapp number", "phone number", "your number",
+    "share your number", "what's your"
+])
+NUMBER_WORD_MATCHER = compile_keywords(['nummer', 'número', 'numero', 'numéro', 'numer', 'numara'])
+
+
 def is_contact_question(ai_text):
     """True if the AI message is asking for contact preference - any language.
     Universal signal: 'whatsapp' appearing alongside an email/phone word."""
     ai_lower = ai_text.lower()
-    english_patterns = [
-        "best way to reach you", "how can i reach you", "reach you",
-        "contact you", "whatsapp, phone, or email", "phone, or email"
-    ]
-    if any(p in ai_lower for p in english_patterns):
+    if CONTACT_QUESTION_MATCHER.search(ai_lower):
+        return True
+    if 'whatsapp' in ai_lower and CONTACT_CHANNEL_MATCHER.search(ai_lower):
         return True
-    if 'whatsapp' in ai_lower:
-        contact_words = ['email', 'e-mail', 'mail', 'correo', 'phone', 'telefon',
-                          'teléfono', 'telefono', 'téléphone', 'telephone', 'telefone',
-                          'telefoon', 'numer', 'número', 'numero']
-        if any(w in ai_lower for w in contact_words):
-            return True
     return False
 
 
 def is_number_question(ai_text):
     """True if the AI message is asking for a phone/WhatsApp number - any language."""
     ai_lower = ai_text.lower()
-    english_patterns = ["whatsapp number", "phone number", "your number",
-                         "share your number", "what's your"]
-    if any(p in ai_lower for p in english_patterns):
+    if NUMBER_QUESTION_MATCHER.search(ai_lower):
         return True
-    number_words = ['nummer', 'número', 'numero', 'numéro', 'numer', 'numara']
-    if any(w in ai_lower for w in number_words) and ('whatsapp' in ai_lower or 'telefon' in ai_lower or 'phone' in ai_lower):
+    if NUMBER_WORD_MATCHER.search(ai_lower) and ('whatsapp' in ai_lower or 'telefon' in ai_lower or 'phone' in ai_lower):
         return True
     return False
 
@@ -419,14 +630,19 @@ def resolve_date_from_daymonth(user_text):
     return all_dates[-1] if all_dates else None
 
 
-def slot_booked_count(agency_id, date_iso, time_label):
-    """Count non-cancelled appointments for an exact date+time slot."""
-    return Appointment.query.filter(
+def slot_occupancy(agency_id, date_from_iso, date_to_iso):
+    """Non-cancelled appointment counts for every slot in a date window, as
+    {(date_iso, time_label): count} - ONE grouped query instead of a
+    COUNT(*) per slot. Slots with no bookings are simply absent (0)."""
+    rows = db.session.query(
+        Appointment.appointment_date_iso, Appointment.appointment_time, func.count(Appointment.id)
+    ).filter(
         Appointment.agency_id == agency_id,
-        Appointment.appointment_date_iso == date_iso,
-        Appointment.appointment_time == time_label,
+        Appointment.appointment_date_iso >= date_from_iso,
+        Appointment.appointment_date_iso <= date_to_iso,
         Appointment.status != 'cancelled'
-    ).count()
+    ).group_by(Appointment.appointment_date_iso, Appointment.appointment_time).all()
+    return defaultdict(int, {(d, t): n for d, t, n in rows})
 
 
 def get_slot_capacity(agency):
@@ -440,16 +656,6 @@ def get_slot_capacity(agency):
     return active if active > 0 else (agency.max_viewings_per_slot or 2)
 
 
-def agent_busy_at(agent_id, date_iso, time_label):
-    """True if this agent already has a non-cancelled booking at that exact slot."""
-    return Appointment.query.filter(
-        Appointment.agent_id == agent_id,
-        Appointment.appointment_date_iso == date_iso,
-        Appointment.appointment_time == time_label,
-        Appointment.status != 'cancelled'
-    ).count() > 0
-
-
 def pick_agent_for_slot(agency, date_iso, time_label, preferred_agent_id=None):
     """Choose the agent for a new booking:
     1. The customer's own agent (preferred) if free at that slot
@@ -457,50 +663,109 @@ def pick_agent_for_slot(agency, date_iso, time_label, preferred_agent_id=None):
     Returns None for solo tier or when nobody is free."""
     if (agency.tier or 'solo') == 'solo':
         return None
-    agents = Agent.query.filter_by(agency_id=agency.id, status='active').all()
-    if not agents:
-        return None
+    busy = db.exists().where(
+        Appointment.agent_id == Agent.id,
+        Appointment.appointment_date_iso == date_iso,
+        Appointment.appointment_time == time_label,
+        Appointment.status != 'cancelled')
+    order = [Agent.appointment_count.asc(), Agent.id.asc()]
     if preferred_agent_id:
-        pref = next((a for a in agents if a.id == preferred_agent_id), None)
-        if pref and not agent_busy_at(pref.id, date_iso, time_label):
-            return pref
-    free = [a for a in agents if not agent_busy_at(a.id, date_iso, time_label)]
-    if not free:
-        return None
-    counts = {a.id: Appointment.query.filter(
-        Appointment.agent_id == a.id,
-        Appointment.status != 'cancelled').count() for a in free}
-    return min(free, key=lambda a: (counts[a.id], a.id))
+        order.insert(0, db.case((Agent.id == preferred_agent_id, 0), else_=1))
+    return Agent.query.filter(Agent.agency_id == agency.id, Agent.status == 'active', ~busy) \
+        .order_by(*order).first()
 
-def get_availability_context(agency_id, max_per_slot):
-    """
-    Build next-7-days real availability for the AI.
-    Excludes Sundays and slots that are already full.
-    """
-    try:
-        today = datetime.now(PK_TZ).date()
-        lines = ["\nVIEWING AVAILABILITY - ONLY offer these exact dates and open time slots:"]
-        any_open = False
-        for i in range(1, 8):
-            d = today + timedelta(days=i)
-            if d.weekday() == 6:
-                continue
-            iso = d.strftime('%Y-%m-%d')
-            open_slots = [s for s in TIME_SLOTS
-                          if slot_booked_count(agency_id, iso, s) < max_per_slot]
-            if open_slots:
-                any_open = True
-                lines.append(f"- {d.strftime('%A, %B %d')}: {', '.join(open_slots)}")
-        if not any_open:
-            return ("\nVIEWING AVAILABILITY: All slots are fully booked for the next 7 days. "
-                    "Apologize and tell the customer the agency will contact them directly to arrange a viewing time.")
-        lines.append("When the customer wants a viewing, offer ALL of the above days (each with its date), not just one or two.")
-        lines.append("Always say the full date when offering or confirming, e.g. 'Monday, July 13' - never just 'Monday'.")
-        lines.append("If a customer asks for a day or time NOT listed above, say that slot is unavailable and offer the open options.")
-        return "\n".join(lines)
-    except Exception as e:
-        print(f"⚠️ Availability context error: {e}")
-        return ""
+# ─────────────────────────────────────────────────────
+# AVAILABILITY SNAPSHOT
+# Open slots for the next AVAILABILITY_DAYS days are identical for every
+# visitor of an agency until a booking or the capacity changes, so each
+# worker holds them in memory tagged with Agency.availability_version and
+# the PK_TZ date. Appointment, agent and capacity writes bump the version
+# in the same transaction (flush hook below); the date rolls the snapshot
+# over at midnight. Unchanged availability = zero queries per turn.
+# ─────────────────────────────────────────────────────
+
+AVAILABILITY_DAYS = 14
+AVAILABILITY_PROMPT_DAYS = 7     # what the AI is allowed to offer
+
+_availability = {}               # agency_id -> snapshot dict
+_AVAILABILITY_MAX_AGENCIES = 500
+
+
+def format_availability_context(days):
+    lines = ["\nVIEWING AVAILABILITY - ONLY offer these exact dates and open time slots:"]
+    for d, open_slots in days:
+        if open_slots:
+            lines.append(f"- {d.strftime('%A, %B %d')}: {', '.join(open_slots)}")
+    if len(lines) == 1:
+        return ("\nVIEWING AVAILABILITY: All slots are fully booked for the next 7 days. "
+                "Apologize and tell the customer the agency will contact them directly to arrange a viewing time.")
+    lines.append("When the customer wants a viewing, offer ALL of the above days (each with its date), not just one or two.")
+    lines.append("Always say the full date when offering or confirming, e.g. 'Monday, July 13' - never just 'Monday'.")
+    lines.append("If a customer asks for a day or time NOT listed above, say that slot is unavailable and offer the open options.")
+    return "\n".join(lines)
+
+
+def _build_availability(agency, version, today):
+    capacity = get_slot_capacity(agency)
+    occupancy = slot_occupancy(agency.id, (today + timedelta(days=1)).strftime('%Y-%m-%d'),
+                               (today + timedelta(days=AVAILABILITY_DAYS)).strftime('%Y-%m-%d'))
+    days = []
+    for i in range(1, AVAILABILITY_DAYS + 1):
+        d = today + timedelta(days=i)
+        if d.weekday() == 6:     # Sundays closed
+            continue
+        iso = d.strftime('%Y-%m-%d')
+        days.append((d, tuple(s for s in TIME_SLOTS if occupancy[(iso, s)] < capacity)))
+    return {
+        'version': version,
+        'today': today,
+        'capacity': capacity,
+        'days': tuple(days),
+        'context': format_availability_context(
+            [day for day in days if (day[0] - today).days <= AVAILABILITY_PROMPT_DAYS]),
+    }
+
+
+def get_availability(agency):
+    """The agency's availability snapshot: effective slot capacity, open
+    slots per day and the prompt block built from them. Rebuilt only when
+    Agency.availability_version or the date has moved on."""
+    today = datetime.now(PK_TZ).date()
+    version = agency.availability_version or 0
+    snapshot = _availability.get(agency.id)
+    if snapshot is None or snapshot['version'] != version or snapshot['today'] != today:
+        try:
+            snapshot = _build_availability(agency, version, today)
+        except Exception as e:
+            print(f"⚠️ Availability context error: {e}")
+            return {'version': None, 'today': today, 'capacity': agency.max_viewings_per_slot or 2,
+                    'days': (), 'context': ""}
+        if len(_availability) >= _AVAILABILITY_MAX_AGENCIES:
+            _availability.pop(next(iter(_availability)), None)
+        _availability[agency.id] = snapshot
+    return snapshot
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def track_availability_changes(session, flush_context, instances):
+    changed = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Appointment):
+            before = set() if obj in session.new else _slot_holdings(obj, 'before')
+            after = set() if obj in session.deleted else _slot_holdings(obj, 'after')
+            changed |= {key[1] for key in before ^ after if key[0] == 'agency'}
+        elif isinstance(obj, Agent):     # active agents are the capacity on Tier 2/3
+            status = _before_after(obj, 'status')
+            if obj in session.new or obj in session.deleted or status[0] != status[1]:
+                changed.add(obj.agency_id)
+        elif isinstance(obj, Agency) and obj not in session.new:
+            if any(len(set(_before_after(obj, attr))) > 1 for attr in ('max_viewings_per_slot', 'tier')):
+                changed.add(obj.id)
+    if changed:
+        agency = Agency.__table__
+        session.connection().execute(
+            agency.update().where(agency.c.id.in_(changed))
+            .values(availability_version=func.coalesce(agency.c.availability_version, 0) + 1))
 
 
 def budget_string_to_numeric(budget_str):
@@ -525,12 +790,17 @@ BUY_WORDS = ['buy', 'buying', 'purchase', 'purchasing', 'own', 'ownership',
 RENT_WORDS = ['rent', 'renting', 'rental', 'lease', 'leasing',
               'alquiler', 'miete', 'louer', 'affitto', 'wynajem']
 
-def detect_purpose(conversation_history):
+_RENT_PATTERN = re.compile(r'\b(?:' + '|'.join(RENT_WORDS) + r')\b')
+_BUY_PATTERN = re.compile(r'\b(?:' + '|'.join(BUY_WORDS) + r')\b')
+
+
+def detect_purpose(conversation_history, state=None):
     """Language-lite: scans user messages for buy/rent intent."""
-    user_text = " ".join([m['content'] for m in conversation_history if m['role'] == 'user']).lower()
-    if any(re.search(r'\b' + w + r'\b', user_text) for w in RENT_WORDS):
+    if state is None:
+        state = build_conversation_state(None, conversation_history)
+    if state['saw_rent']:
         return 'rent'
-    if any(re.search(r'\b' + w + r'\b', user_text) for w in BUY_WORDS):
+    if state['saw_buy']:
         return 'sale'
     return None
 
@@ -574,30 +844,25 @@ def expand_type_synonyms(prop_type):
     return TYPE_SYNONYMS.get(prop_type, {prop_type})
 
 
-def detect_property_type(agency_id, conversation_history):
+def detect_property_type(agency_id, conversation_history, state=None):
     """Matches conversation text against this agency's actual listing types + generic terms."""
-    user_text = " ".join([m['content'] for m in conversation_history if m['role'] == 'user']).lower()
-    db_types = [t[0].lower() for t in db.session.query(Listing.property_type)
-                .filter_by(agency_id=agency_id).distinct().all() if t[0]]
-    candidates = set(db_types) | set(GENERIC_PROPERTY_TYPES)
+    if state is None:
+        state = build_conversation_state(agency_id, conversation_history)
     # Longest phrases first so "single family" matches before a shorter
     # coincidental overlap would.
-    ordered = sorted(candidates, key=len, reverse=True)
-    for c in ordered:
-        if c and re.search(r'\b' + re.escape(c) + r'\b', user_text):
-            return c
+    if state['type_hits']:
+        return max(state['type_hits'], key=len)
     # Fallback: plain substring match (no word boundaries). Needed for
     # compound-word languages like German, where a qualifier attaches
     # directly to the noun with no space ("Luxusvilla" = "Luxus"+"villa"),
     # so a strict \bvilla\b never matches even though the word is right
     # there. Minimum length guards against short-word false positives.
-    for c in ordered:
-        if c and len(c) >= 4 and c in user_text:
-            return c
+    if state['type_sub_hits']:
+        return max(state['type_sub_hits'], key=len)
     return None
 
 
-def detect_location(agency_id, conversation_history):
+def detect_location(agency_id, conversation_history, state=None):
     """Matches conversation text against this agency's actual listing
     locations (city and state parts), DB-driven so it adapts to whatever
     markets the agency actually serves. Only matches city names and full
@@ -617,30 +882,56 @@ def detect_location(agency_id, conversation_history):
     city name genuinely changes across our supported languages."""
     if not conversation_history:
         return []
-    user_text = " ".join([m['content'] for m in conversation_history if m['role'] == 'user']).lower()
-    db_locations = [l[0] for l in db.session.query(Listing.location)
-                     .filter_by(agency_id=agency_id).distinct().all() if l[0]]
-    # candidate -> canonical city name (usually itself, except translated aliases)
-    candidates = {}
-    for loc in db_locations:
-        for part in loc.split(','):
-            part = part.strip().lower()
-            if len(part) >= 3:
-                candidates[part] = part
-                if part.startswith('new '):
-                    candidates['nueva ' + part[4:]] = part  # Spanish "Nueva York" -> "new york"
-
-    found = []
-    seen_canonical = set()
-    for c in sorted(candidates.keys(), key=len, reverse=True):
-        m = re.search(r'\b' + re.escape(c) + r'\b', user_text)
-        if m:
-            canonical = candidates[c]
-            if canonical not in seen_canonical:
-                seen_canonical.add(canonical)
-                found.append((m.start(), canonical))
-    found.sort(key=lambda x: x[0])
-    return [c for _, c in found]
+    if state is None:
+        state = build_conversation_state(agency_id, conversation_history)
+    return list(state['locations'])
+
+
+def build_title_matcher(titles):
+    """Aho-Corasick automaton over the lower-cased titles, built once per
+    catalog snapshot. Finds every title occurring in a text - including
+    overlapping/nested ones, exactly like `title.lower() in text` - in a
+    single pass over the text, whatever the catalog size.
+    `titles` must already be sorted longest-first; that order is kept as
+    each title's rank so results come back longest-first too."""
+    goto, fail, out = [{}], [0], [()]
+    for title in titles:
+        node = 0
+        for ch in title.lower():
+            nxt = goto[node].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto.append({})
+                fail.append(0)
+                out.append(())
+                goto[node][ch] = nxt
+            node = nxt
+        out[node] += (title,)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for ch, nxt in goto[node].items():
+            queue.append(nxt)
+            f = fail[node]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            target = goto[f].get(ch, 0)
+            fail[nxt] = target if target != nxt else 0
+            out[nxt] += out[fail[nxt]]
+    return {'goto': goto, 'fail': fail, 'out': out,
+            'rank': {title: i for i, title in enumerate(titles)}}
+
+
+def _titles_in_text(matcher, text_lower):
+    goto, fail, out = matcher['goto'], matcher['fail'], matcher['out']
+    found, node = set(), 0
+    for ch in text_lower:
+        while node and ch not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(ch, 0)
+        if out[node]:
+            found.update(out[node])
+    return sorted(found, key=matcher['rank'].__getitem__)
 
 
 def detect_listing_titles_in_text(agency_id, text):
@@ -652,17 +943,10 @@ def detect_listing_titles_in_text(agency_id, text):
     this stays multilingual-safe without any translation logic."""
     if not text:
         return []
-    titles = [t[0] for t in db.session.query(Listing.title)
-              .filter_by(agency_id=agency_id).distinct().all() if t[0]]
-    text_lower = text.lower()
-    found = []
-    for title in sorted(titles, key=len, reverse=True):
-        if title.lower() in text_lower:
-            found.append(title)
-    return found
+    return _titles_in_text(get_listing_catalog(agency_id)['title_matcher'], text.lower())
 
 
-def infer_budget_from_discussed_listings(agency_id, conversation_history):
+def infer_budget_from_discussed_listings(agency_id, conversation_history, state=None):
     """When no explicit number was ever stated, use the HIGHEST price among
     listings that were actually named anywhere in the conversation as a
     reasonable stand-in for the customer's budget ceiling - most relevant
@@ -672,12 +956,12 @@ def infer_budget_from_discussed_listings(agency_id, conversation_history):
     for normal conversational replies like 'That's great, tell me more'."""
     if not conversation_history:
         return None
-    all_text = " ".join(m['content'] for m in conversation_history)
-    rows = db.session.query(Listing.title, Listing.price_numeric) \
-        .filter_by(agency_id=agency_id).all()
-    all_text_lower = all_text.lower()
-    mentioned_prices = [price for title, price in rows
-                         if title and price and title.lower() in all_text_lower]
+    if state is None:
+        state = build_conversation_state(agency_id, conversation_history)
+    if not state['mentioned_titles']:
+        return None
+    title_prices = get_listing_catalog(agency_id)['title_prices']
+    mentioned_prices = [title_prices[t] for t in state['mentioned_titles'] if t in title_prices]
     if not mentioned_prices:
         return None
     highest = max(mentioned_prices)
@@ -689,6 +973,90 @@ def infer_budget_from_discussed_listings(agency_id, conversation_history):
     return f"{highest:.0f} USD (based on properties discussed)"
 
 
+# ─────────────────────────────────────────────────────
+# LISTING CATALOG CACHE
+# Every chat turn needs the same per-agency catalog (ranked listings,
+# distinct types, locations, titles, prices). It's held in memory as an
+# immutable snapshot tagged with Agency.catalog_version; every listing
+# write bumps that version in the same transaction, so all workers drop
+# their stale snapshot on the next turn. Unchanged catalog = zero listing
+# queries per turn.
+# ─────────────────────────────────────────────────────
+
+CatalogListing = namedtuple('CatalogListing', [
+    'id', 'title', 'location', 'price_raw', 'price', 'price_numeric', 'bedrooms', 'bathrooms',
+    'property_type', 'listing_purpose', 'features', 'description', 'status'])
+
+_listing_catalogs = {}          # agency_id -> snapshot dict
+_LISTING_CATALOG_MAX_AGENCIES = 500
+
+
+def _build_listing_catalog(agency_id, version):
+    rows = Listing.query.filter_by(agency_id=agency_id).order_by(Listing.id.asc()).all()
+    listings = tuple(CatalogListing(**{f: getattr(r, f) for f in CatalogListing._fields}) for r in rows)
+    titles = sorted({l.title for l in listings if l.title}, key=len, reverse=True)
+    # lower-cased title -> highest price listed under it
+    title_prices = {}
+    for l in listings:
+        if l.title and l.price_numeric:
+            t = l.title.lower()
+            title_prices[t] = max(title_prices.get(t, l.price_numeric), l.price_numeric)
+    db_types = {l.property_type.lower() for l in listings if l.property_type}
+    types = sorted(db_types | set(GENERIC_PROPERTY_TYPES), key=len, reverse=True)
+    # candidate -> canonical city name (usually itself, except translated aliases)
+    locations = {}
+    for loc in {l.location for l in listings if l.location}:
+        for part in loc.split(','):
+            part = part.strip().lower()
+            if len(part) >= 3:
+                locations[part] = part
+                if part.startswith('new '):
+                    locations['nueva ' + part[4:]] = part  # Spanish "Nueva York" -> "new york"
+    key_src = json.dumps([titles, types, sorted(locations.items())])
+    return {
+        'version': version,
+        'key': hashlib.md5(key_src.encode()).hexdigest(),   # changes only when match candidates do
+        'listings': listings,
+        'available': tuple(l for l in listings if l.status == 'available'),
+        'titles': titles,
+        'title_matcher': build_title_matcher(titles),
+        'title_prices': title_prices,
+        'types': types,
+        'locations': locations,
+    }
+
+
+def get_listing_catalog(agency_id):
+    """This agency's listing catalog snapshot, rebuilt only when
+    Agency.catalog_version has moved on. The agency row is normally
+    already in the session's identity map during a chat turn, so the
+    version check costs no query either."""
+    if agency_id is None:
+        return {'version': None, 'key': None, 'listings': (), 'available': (),
+                'titles': [], 'title_matcher': build_title_matcher([]), 'title_prices': {},
+                'types': [], 'locations': {}}
+    agency = db.session.get(Agency, agency_id)
+    version = (agency.catalog_version or 0) if agency else 0
+    snapshot = _listing_catalogs.get(agency_id)
+    if snapshot is None or snapshot['version'] != version:
+        snapshot = _build_listing_catalog(agency_id, version)
+        if len(_listing_catalogs) >= _LISTING_CATALOG_MAX_AGENCIES:
+            _listing_catalogs.pop(next(iter(_listing_catalogs)), None)
+        _listing_catalogs[agency_id] = snapshot
+    return snapshot
+
+
+def invalidate_listing_catalog(agency_id):
+    """Call inside the same transaction as any listing insert/update/delete."""
+    Agency.query.filter_by(id=agency_id).update(
+        {"catalog_version": func.coalesce(Agency.catalog_version, 0) + 1},
+        synchronize_session=False)
+    agency = db.session.get(Agency, agency_id)
+    if agency is not None:
+        db.session.expire(agency, ['catalog_version'])
+    _listing_catalogs.pop(agency_id, None)
+
+
 def format_num(x):
     """4.0 -> '4', 4.5 -> '4.5' - clean display for bedroom/bathroom counts."""
     if x is None:
@@ -712,7 +1080,7 @@ def _number_token_to_int(token):
     return NUMBER_WORDS.get(token.lower())
 
 
-def detect_bed_bath_requirements(conversation_history):
+def detect_bed_bath_requirements(conversation_history, state=None):
     """Scans ALL user messages for bedroom/bathroom count requirements, in
     any of our supported languages, and accepts BOTH digits ('5 bedrooms')
     and spelled-out numbers ('fünf Schlafzimmer', 'cinco habitaciones').
@@ -722,38 +1090,31 @@ def detect_bed_bath_requirements(conversation_history):
     customer can revise their requirement mid-chat."""
     if not conversation_history:
         return None, None
-    user_msgs = [m['content'] for m in conversation_history if m['role'] == 'user']
-    min_beds, min_baths = None, None
-    for msg in user_msgs:
-        for m in _BED_PATTERN.finditer(msg):
-            n = _number_token_to_int(m.group(1))
-            if n:
-                min_beds = n
-        for m in _BATH_PATTERN.finditer(msg):
-            n = _number_token_to_int(m.group(1))
-            if n:
-                min_baths = n
-    return min_beds, min_baths
-
-
-def get_listings_context(agency_id, conversation_history=None):
+    if state is None:
+        state = build_conversation_state(None, conversation_history)
+    return state['min_beds'], state['min_baths']
+
+
+def get_listings_context(agency_id, conversation_history=None, state=None):
     """Filters and ranks listings by the customer's stated budget, property
     type, buy/rent purpose, AND bedroom/bathroom requirements BEFORE handing
     anything to the AI - so the model only ever sees relevant, correctly-
     scoped options and never has to eyeball a bed/bath match itself."""
     try:
-        listings = Listing.query.filter_by(agency_id=agency_id, status='available').all()
+        listings = get_listing_catalog(agency_id)['available']
         if not listings:
             return ""
 
         budget_val, purpose, prop_type, min_beds, min_baths, location_val = None, None, None, None, None, []
         if conversation_history:
-            lead_snapshot = extract_lead_data(agency_id, conversation_history)
+            if state is None:
+                state = build_conversation_state(agency_id, conversation_history)
+            lead_snapshot = extract_lead_data(agency_id, conversation_history, state)
             budget_val = budget_string_to_numeric(lead_snapshot.get('budget'))
-            purpose = detect_purpose(conversation_history)
-            prop_type = detect_property_type(agency_id, conversation_history)
-            min_beds, min_baths = detect_bed_bath_requirements(conversation_history)
-            location_val = detect_location(agency_id, conversation_history)
+            purpose = detect_purpose(conversation_history, state)
+            prop_type = detect_property_type(agency_id, conversation_history, state)
+            min_beds, min_baths = detect_bed_bath_requirements(conversation_history, state)
+            location_val = detect_location(agency_id, conversation_history, state)
 
         def passes_bed_bath(l):
             if min_beds is not None and (l.bedrooms is None or l.bedrooms < min_beds):
@@ -928,7 +1289,8 @@ Default Password: admin123
     return send_email_brevo(agency.email, subject, body)
 
 
-def send_appointment_confirmation(agency, appointment):
+def appointment_confirmation_emails(agency, appointment):
+    """{'customer': (to, subject, body), 'agency': (to, subject, body)}"""
     assigned_agent_name = None
     if appointment.agent_id:
         assigned_agent = db.session.get(Agent, appointment.agent_id)
@@ -973,27 +1335,87 @@ New Appointment Booked!
 View all appointments:
 https://luxury-leads-ai.onrender.com/appointments/{agency.id}
 """
-    sent_customer = send_email_brevo(appointment.customer_email, customer_subject, customer_body)
-    sent_agency = send_email_brevo(agency.email, agency_subject, agency_body)
+    return {
+        'customer': (appointment.customer_email, customer_subject, customer_body),
+        'agency': (agency.email, agency_subject, agency_body),
+    }
+
+
+def send_appointment_confirmation(agency, appointment):
+    sent_customer, sent_agency = send_emails_brevo(list(appointment_confirmation_emails(agency, appointment).values()))
     return sent_customer or sent_agency
 
+
+def enqueue_appointment_confirmation(appointment_id):
+    """One job per recipient, so a failed customer email is retried on its
+    own and a retry never re-sends the email that already went out."""
+    for recipient in ('customer', 'agency'):
+        enqueue_job('appointment_confirmation', {'appointment_id': appointment_id, 'recipient': recipient},
+                    f"appointment_confirmation:{appointment_id}:{recipient}")
+
 def notify_agent(agent, subject, body):
     if agent and agent.email:
         return send_email_brevo(agent.email, subject, body)
     return False
 
 
+NOTE_TIMESTAMP_FORMAT = '%B %d, %Y at %I:%M %p'
+
+
+def add_lead_note_row(lead, text, author):
+    """Adds a note to the current DB session (caller commits)."""
+    note = LeadNote(lead_id=lead.id, agency_id=lead.agency_id, author=author, text=text,
+                    created_at=datetime.now(PK_TZ))
+    db.session.add(note)
+    return note
+
+
+def note_to_dict(note):
+    return {"id": note.id, "text": note.text, "author": note.author,
+            "timestamp": note.created_at.strftime(NOTE_TIMESTAMP_FORMAT) if note.created_at else ""}
+
+
+def load_lead_notes(lead_ids):
+    """{lead_id: [note dicts, oldest first]} for many leads in one query."""
+    notes = defaultdict(list)
+    lead_ids = list(lead_ids)
+    if not lead_ids:
+        return notes
+    for note in LeadNote.query.filter(LeadNote.lead_id.in_(lead_ids)).order_by(LeadNote.id.asc()):
+        notes[note.lead_id].append(note_to_dict(note))
+    return notes
+
+
+def normalize_email(email):
+    """Case/whitespace-insensitive form of an email, stored as email_norm on
+    Lead and Appointment so "same client" checks are indexed lookups."""
+    return (email or '').strip().lower() or None
+
+
 def get_related_appointments(agency_id, customer_email):
     """All appointments across the agency for this customer email, regardless
     of which agent they're assigned to - so every agent working with the
     same client can see the full picture, not just their own bookings."""
-    if not customer_email:
+    email_norm = normalize_email(customer_email)
+    if not email_norm:
         return []
-    email_lower = customer_email.strip().lower()
-    appts = Appointment.query.filter_by(agency_id=agency_id).all()
-    matched = [a for a in appts if (a.customer_email or '').strip().lower() == email_lower]
-    matched.sort(key=lambda a: a.created_at or datetime.min, reverse=True)
-    return matched
+    return Appointment.query.filter_by(
+        agency_id=agency_id, email_norm=email_norm
+    ).order_by(Appointment.created_at.desc()).all()
+
+
+def load_related_appointments(agency_id, emails):
+    """get_related_appointments() for many customers in one query:
+    {email_norm: [appointments, newest first]}."""
+    related = defaultdict(list)
+    emails = {normalize_email(e) for e in emails} - {None}
+    if not emails:
+        return related
+    for appt in Appointment.query.filter(
+        Appointment.agency_id == agency_id, Appointment.email_norm.in_(emails)
+    ).order_by(Appointment.created_at.desc()):
+        related[appt.email_norm].append(appt)
+    return related
 
 
 def resolve_lead_identity(agency_id, email, new_name):
@@ -1025,20 +1447,12 @@ def resolve_lead_identity(agency_id, email, new_name):
         return existing.name, existing.id
     # Names differ under the same email - flag it, but keep the ORIGINAL
     # name as canonical rather than silently switching identities.
-    try:
-        notes = json.loads(existing.notes or '[]')
-    except Exception:
-        notes = []
-    notes.append({
-        "id": len(notes) + 1,
-        "text": (f"⚠️ Possible duplicate: this email was already used here as '{existing.name}'. "
-                 f"A new conversation under the SAME email just used the name '{new_name}' instead. "
-                 f"We kept '{existing.name}' as the name on file - please verify with the customer "
-                 f"which name is correct, or whether this is a different person sharing the same email."),
-        "author": "System",
-        "timestamp": datetime.now(pytz.timezone('Asia/Karachi')).strftime('%B %d, %Y at %I:%M %p')
-    })
-    existing.notes = json.dumps(notes)
+    add_lead_note_row(existing,
+                      f"⚠️ Possible duplicate: this email was already used here as '{existing.name}'. "
+                      f"A new conversation under the SAME email just used the name '{new_name}' instead. "
+                      f"We kept '{existing.name}' as the name on file - please verify with the customer "
+                      f"which name is correct, or whether this is a different person sharing the same email.",
+                      "System")
     db.session.commit()
     print(f"⚠️ Name conflict on {email}: kept '{existing.name}' (new session used '{new_name}') - flagged on lead {existing.id}")
     return existing.name, existing.id
@@ -1050,25 +1464,30 @@ def notify_other_agents_of_update(appt, acting_agent, action_desc):
     client is being worked by more than one agent at the same agency."""
     if not appt.customer_email or not acting_agent:
         return
-    email_lower = appt.customer_email.strip().lower()
-    leads = Lead.query.filter_by(agency_id=appt.agency_id).all()
+    leads = Lead.query.filter(
+        Lead.agency_id == appt.agency_id,
+        Lead.email_norm == normalize_email(appt.customer_email),
+        Lead.agent_id.isnot(None),
+        Lead.agent_id != acting_agent.id
+    ).all()
+    emails = []
     for lead in leads:
-        if (lead.email and lead.email.strip().lower() == email_lower
-                and lead.agent_id and lead.agent_id != acting_agent.id):
-            other_agent = db.session.get(Agent, lead.agent_id)
-            if other_agent:
-                notify_agent(other_agent,
-                    f"🔔 Update on shared client: {appt.customer_name or lead.name or ''}",
-                    f"Hi {other_agent.name},\n\n{acting_agent.name} just {action_desc} for a client you're also working with:\n\n"
-                    f"Client: {lead.name or appt.customer_name}\nEmail: {appt.customer_email}\n"
-                    f"Appointment date: {appt.appointment_date}\nTime: {appt.appointment_time}\n"
-                    f"Status: {appt.status}\nNotes: {appt.notes or '-'}\n\n"
-                    f"Login to see the full picture: https://luxury-leads-ai.onrender.com/agent-login")
+        other_agent = db.session.get(Agent, lead.agent_id)
+        if other_agent and other_agent.email:
+            emails.append((other_agent.email,
+                f"🔔 Update on shared client: {appt.customer_name or lead.name or ''}",
+                f"Hi {other_agent.name},\n\n{acting_agent.name} just {action_desc} for a client you're also working with:\n\n"
+                f"Client: {lead.name or appt.customer_name}\nEmail: {appt.customer_email}\n"
+                f"Appointment date: {appt.appointment_date}\nTime: {appt.appointment_time}\n"
+                f"Status: {appt.status}\nNotes: {appt.notes or '-'}\n\n"
+                f"Login to see the full picture: https://luxury-leads-ai.onrender.com/agent-login"))
+    if emails:
+        send_emails_brevo(emails)
 
 
 def send_crm_webhook(agency, lead):
     if not agency.webhook_url:
-        return
+        return True
     try:
         payload = {
             "event": "lead_qualified",
@@ -1084,8 +1503,11 @@ def send_crm_webhook(agency, lead):
         }
         response = httpx.post(agency.webhook_url, json=payload, timeout=5)
         print(f"✅ Webhook sent (Status: {response.status_code})")
+        # 429/5xx are the receiver's problem right now, not a bad payload - worth retrying
+        return response.status_code != 429 and response.status_code < 500
     except Exception as e:
         print(f"⚠️ Webhook failed: {e}")
+        return False
 
 
 def send_followup_email(agency, lead, day):
@@ -1170,58 +1592,829 @@ def process_pending_followups():
 
 
 # ─────────────────────────────────────────────────────
-# DB-BACKED CONVERSATION SESSIONS (survive restarts)
+# BACKGROUND JOBS (DB-backed outbox)
+# Slow side effects of a chat turn - emails, the lead summary OpenAI call,
+# CRM webhooks - are written as BackgroundJob rows in the SAME commit as
+# the appointment/lead they belong to, and executed by job_worker.py with
+# retries + exponential backoff. idempotency_key makes enqueueing the same
+# effect twice a no-op.
 # ─────────────────────────────────────────────────────
 
-def clean_expired_sessions():
-    """Delete conversation sessions inactive for 30+ minutes (DB-backed)."""
-    try:
-        cutoff = datetime.utcnow() - timedelta(minutes=30)
-        deleted = ConversationSession.query.filter(
-            ConversationSession.updated_at < cutoff
-        ).delete()
-        if deleted:
-            db.session.commit()
-            print(f"🧹 {deleted} expired session(s) cleared")
-    except Exception as e:
-        print(f"⚠️ Session cleanup error: {e}")
-        db.session.rollback()
+JOB_MAX_ATTEMPTS = 5
+JOB_LOCK_TIMEOUT = timedelta(minutes=10)
+
+
+def enqueue_job(kind, payload, idempotency_key, max_attempts=JOB_MAX_ATTEMPTS):
+    """Adds a job to the current DB session (caller commits). Returns the
+    existing job instead if one with this idempotency_key already exists."""
+    existing = BackgroundJob.query.filter_by(idempotency_key=idempotency_key).first()
+    if existing:
+        return existing
+    job = BackgroundJob(kind=kind, payload=json.dumps(payload), idempotency_key=idempotency_key,
+                        max_attempts=max_attempts, run_after=datetime.utcnow())
+    db.session.add(job)
+    return job
+
+
+def job_backoff(attempts):
+    """30s, 1m, 2m, 4m ... capped at 1h."""
+    return timedelta(seconds=min(30 * 2 ** max(attempts - 1, 0), 3600))
+
+
+def _job_appointment_confirmation(payload):
+    appt = db.session.get(Appointment, payload['appointment_id'])
+    agency = db.session.get(Agency, appt.agency_id) if appt else None
+    if not appt or not agency:
+        return  # deleted since it was booked - nothing left to confirm
+    recipient = payload.get('recipient')
+    if not recipient:   # queued before confirmations were split per recipient
+        if not send_appointment_confirmation(agency, appt):
+            raise RuntimeError("appointment confirmation not sent")
+        return
+    to_email, subject, body = appointment_confirmation_emails(agency, appt)[recipient]
+    if not to_email:
+        return  # no address on file - nothing to retry
+    if not send_email_brevo(to_email, subject, body):
+        raise RuntimeError(f"appointment {appt.id} {recipient} confirmation not sent")
+
+
+def _job_notify_agent(payload):
+    agent = db.session.get(Agent, payload['agent_id'])
+    if not agent:
+        return
+    if not notify_agent(agent, payload['subject'], payload['body']):
+        raise RuntimeError(f"agent {agent.id} notification not sent")
+
+
+def _job_lead_summary(payload):
+    lead = db.session.get(Lead, payload['lead_id'])
+    agency = db.session.get(Agency, lead.agency_id) if lead else None
+    if not lead or not agency:
+        return
+    job = BackgroundJob.query.filter_by(idempotency_key=f"lead_summary:{lead.id}").first()
+    last_attempt = not job or job.attempts >= job.max_attempts
+    # OpenAI errors propagate so the job backs off and retries; only the
+    # last attempt settles for the placeholder, so the lead email and
+    # webhook still go out.
+    lead.message = generate_lead_summary(payload.get('history') or [], agency.name,
+                                         fallback=last_attempt)
+    enqueue_job('lead_email', {'lead_id': lead.id}, f"lead_email:{lead.id}")
+    enqueue_job('crm_webhook', {'lead_id': lead.id}, f"crm_webhook:{lead.id}")
+    if lead.agent_id:
+        assigned_agent = db.session.get(Agent, lead.agent_id)
+        if assigned_agent:
+            enqueue_job('notify_agent', {
+                'agent_id': assigned_agent.id,
+                'subject': f"🎯 New Lead Assigned - {lead.name}",
+                'body': f"Hi {assigned_agent.name},\n\nA new lead was assigned to you:\n\nName: {lead.name}\nEmail: {lead.email}\nBudget: {lead.budget}\n\nLogin: https://luxury-leads-ai.onrender.com/agent-login",
+            }, f"lead_assigned:{lead.id}:{assigned_agent.id}")
+
+
+def _job_lead_email(payload):
+    lead = db.session.get(Lead, payload['lead_id'])
+    agency = db.session.get(Agency, lead.agency_id) if lead else None
+    if not lead or not agency:
+        return
+    if not send_lead_email(agency, lead):
+        raise RuntimeError(f"lead {lead.id} email not sent")
+
+
+def _job_session_summary(payload):
+    row = db.session.get(ConversationSession, payload['session_key'])
+    if not row:
+        return  # session expired since
+    done = row.summary_upto or 0
+    if payload['upto'] <= done:
+        return  # an earlier/later refresh already covered it
+    messages = load_messages(row.session_key, done, payload['upto'])
+    if not messages:
+        return
+    row.summary = summarize_conversation(row.summary, messages)
+    row.summary_upto = done + len(messages)
+
+
+def _job_crm_webhook(payload):
+    lead = db.session.get(Lead, payload['lead_id'])
+    agency = db.session.get(Agency, lead.agency_id) if lead else None
+    if not lead or not agency:
+        return
+    if not send_crm_webhook(agency, lead):
+        raise RuntimeError(f"webhook for lead {lead.id} failed")
+
+
+JOB_HANDLERS = {
+    'appointment_confirmation': _job_appointment_confirmation,
+    'notify_agent': _job_notify_agent,
+    'lead_summary': _job_lead_summary,
+    'session_summary': _job_session_summary,
+    'lead_email': _job_lead_email,
+    'crm_webhook': _job_crm_webhook,
+}
+
 
+def process_pending_jobs(limit=20):
+    """Runs up to `limit` due jobs. Safe to call from several worker
+    processes at once: each job is claimed with a conditional UPDATE, so
+    only the worker whose UPDATE flips it pending -> running executes it."""
+    results = {"done": 0, "retried": 0, "failed": 0}
+    now = datetime.utcnow()
+    # A worker that died mid-job leaves it 'running' - put it back in line.
+    BackgroundJob.query.filter(
+        BackgroundJob.status == 'running',
+        BackgroundJob.locked_at < now - JOB_LOCK_TIMEOUT
+    ).update({"status": "pending"}, synchronize_session=False)
+    db.session.commit()
 
-def load_session(session_key):
-    """Load conversation history + booked slots from DB. Survives restarts."""
-    row = db.session.get(ConversationSession, session_key)
-    if row:
+    due = BackgroundJob.query.filter(
+        BackgroundJob.status == 'pending',
+        BackgroundJob.run_after <= now
+    ).order_by(BackgroundJob.run_after.asc(), BackgroundJob.id.asc()).limit(limit).all()
+    for job_id in [j.id for j in due]:
+        claimed = BackgroundJob.query.filter_by(id=job_id, status='pending').update({
+            "status": "running", "locked_at": datetime.utcnow(),
+            "attempts": BackgroundJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue  # another worker got it first
+        job = db.session.get(BackgroundJob, job_id)
+        db.session.refresh(job)
         try:
-            history = json.loads(row.history or '[]')
-        except Exception:
-            history = []
+            handler = JOB_HANDLERS.get(job.kind)
+            if not handler:
+                raise RuntimeError(f"no handler for job kind '{job.kind}'")
+            handler(json.loads(job.payload or '{}'))
+            job.status = 'done'
+            job.last_error = None
+            results["done"] += 1
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(BackgroundJob, job_id)
+            job.last_error = str(e)[:500]
+            if job.attempts >= job.max_attempts:
+                job.status = 'failed'
+                results["failed"] += 1
+                print(f"❌ Job {job.id} ({job.kind}) failed for good: {e}")
+            else:
+                job.status = 'pending'
+                job.run_after = datetime.utcnow() + job_backoff(job.attempts)
+                results["retried"] += 1
+                print(f"⚠️ Job {job.id} ({job.kind}) attempt {job.attempts} failed, retrying: {e}")
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+    return results
+
+
+# ─────────────────────────────────────────────────────
+# INCREMENTAL CONVERSATION STATE
+# Everything the extractors above need, accumulated message by message and
+# persisted per session, so each /chat turn only scans what was appended
+# since the previous turn instead of re-joining the whole history.
+# ─────────────────────────────────────────────────────
+
+CONVERSATION_STATE_VERSION = 1
+
+
+def new_conversation_state(catalog_key=None):
+    return {
+        'version': CONVERSATION_STATE_VERSION,
+        'catalog_key': catalog_key,
+        'processed': 0,                 # number of history messages already scanned
+        'user_msg_count': 0,
+        # lead details
+        'email': None,
+        'name_first_turn': None, 'name_context': None, 'name_explicit': None,
+        'contact_preference': None, 'contact_question_answered': False,
+        'mentions_whatsapp': False,
+        'phone_hits': [None] * len(PHONE_PATTERNS),     # first match per pattern
+        'budget_hits': [None] * len(BUDGET_PATTERNS),   # first [amount, unit] per pattern
+        'mentions_usd': False, 'mentions_aed': False,
+        'mentioned_titles': [],          # lowercased listing titles named by either side
+        # search criteria
+        'saw_rent': False, 'saw_buy': False,
+        'type_hits': [], 'type_sub_hits': [],
+        'locations': [],
+        'min_beds': None, 'min_baths': None,
+        # viewings
+        'viewing_requested': False,
+        'pending_days': [], 'pending_property': None, 'slots': [],
+        # contact step
+        'asked_contact_pref': False, 'user_said_email_only': False,
+        'asked_number': False, 'gave_number': False, 'user_declined_number': False,
+    }
+
+
+def _observe_message(state, catalog, index, prev, msg):
+    """Folds one newly appended message into the state. `prev` is the
+    message right before it (or None), needed for the question -> answer
+    pairs the contact, name and viewing-offer logic all depend on."""
+    content = msg['content']
+    lower = content.lower()
+
+    # Property mentions can come from EITHER side - the AI almost always
+    # names the property right before asking for a day.
+    titles_here = _titles_in_text(catalog['title_matcher'], lower)
+    if titles_here:
+        state['pending_property'] = titles_here[-1]
+        for title in titles_here:
+            if title.lower() not in state['mentioned_titles']:
+                state['mentioned_titles'].append(title.lower())
+
+    if msg['role'] == 'assistant':
+        if is_contact_question(content):
+            state['asked_contact_pref'] = True
+        if is_number_question(content):
+            state['asked_number'] = True
+        return
+    if msg['role'] != 'user':
+        return
+
+    state['user_msg_count'] += 1
+
+    # ── Lead details ──
+    if not state['email']:
+        email_match = _EMAIL_PATTERN.search(content)
+        if email_match:
+            state['email'] = email_match.group(0)
+    if 'whatsapp' in lower or 'whats app' in lower:
+        state['mentions_whatsapp'] = True
+    for i, pattern in enumerate(PHONE_PATTERNS):
+        if state['phone_hits'][i] is None:
+            phone_match = re.search(pattern, content)
+            if phone_match:
+                state['phone_hits'][i] = phone_match.group(0).strip()
+    for i, pattern in enumerate(BUDGET_PATTERNS):
+        if state['budget_hits'][i] is None:
+            budget_match = re.search(pattern, content, re.IGNORECASE)
+            if budget_match:
+                state['budget_hits'][i] = [budget_match.group(1), budget_match.group(2) or '']
+    if '$' in content or 'dollar' in lower or 'dólar' in lower or 'dolar' in lower:
+        state['mentions_usd'] = True
+    if 'aed' in lower:
+        state['mentions_aed'] = True
+    for match in re.finditer(_EXPLICIT_NAME_PATTERN, content, re.IGNORECASE):
+        candidate = match.group(1).strip()
+        if (re.match(r'^[a-zA-Z]{2,30}$', candidate)
+                and candidate.lower() not in NOT_A_NAME):
+            state['name_explicit'] = candidate.title()
+
+    # ── Search criteria ──
+    if _RENT_PATTERN.search(lower):
+        state['saw_rent'] = True
+    if _BUY_PATTERN.search(lower):
+        state['saw_buy'] = True
+    for c in catalog['types']:
+        if c not in state['type_hits'] and re.search(r'\b' + re.escape(c) + r'\b', lower):
+            state['type_hits'].append(c)
+        if len(c) >= 4 and c not in state['type_sub_hits'] and c in lower:
+            state['type_sub_hits'].append(c)
+    found = []
+    for c in sorted(catalog['locations'], key=len, reverse=True):
+        m = re.search(r'\b' + re.escape(c) + r'\b', lower)
+        if m:
+            canonical = catalog['locations'][c]
+            if canonical not in state['locations'] and canonical not in [f[1] for f in found]:
+                found.append((m.start(), canonical))
+    found.sort(key=lambda x: x[0])
+    state['locations'].extend(c for _, c in found)
+    for m in _BED_PATTERN.finditer(content):
+        n = _number_token_to_int(m.group(1))
+        if n:
+            state['min_beds'] = n
+    for m in _BATH_PATTERN.finditer(content):
+        n = _number_token_to_int(m.group(1))
+        if n:
+            state['min_baths'] = n
+
+    # ── Replies to the AI's previous question ──
+    if prev is not None and prev['role'] == 'assistant':
+        prev_content = prev['content']
+        prev_lower = prev_content.lower()
+        if index == 2:
+            state['name_first_turn'] = _first_turn_name(content)
+        if not state['name_context'] and NAME_QUESTION_MATCHER.search(prev_lower):
+            state['name_context'] = _name_question_reply(content)
+        if is_contact_question(prev_content):
+            if not state['contact_question_answered']:
+                state['contact_preference'] = _contact_preference_from_reply(lower)
+                state['contact_question_answered'] = True
+            if (CONTACT_EMAIL_MATCHER.search(lower) and 'whatsapp' not in lower
+                    and not CONTACT_PHONE_MATCHER.search(lower)):
+                state['user_said_email_only'] = True
+        if is_number_question(prev_content):
+            if re.search(r'\+?\d{9,15}', content.strip().replace(' ', '').replace('-', '')):
+                state['gave_number'] = True
+            if NUMBER_DECLINE_MATCHER.search(lower):
+                state['user_declined_number'] = True
+        if not state['viewing_requested'] and VIEWING_OFFER_MATCHER.search(prev_lower):
+            user_reply = re.sub(r'[^\w\sÀ-ÖØ-öø-ÿążćęłńóśźäöüß]', '', lower).strip()
+            if AFFIRMATIVE_MATCHER.match(user_reply):
+                state['viewing_requested'] = True
+    if BOOKING_MATCHER.search(lower):
+        state['viewing_requested'] = True
+
+    # ── Viewing slots ──
+    # FIFO queue of resolved days awaiting a time. Handles:
+    #  - normal 1 day -> 1 time (classic single booking)
+    #  - N days mentioned together -> N times given later in one message
+    #    (paired in order, e.g. "4:00 PM and 6:00 PM")
+    #  - N days mentioned together -> a SINGLE time given later, meaning
+    #    that time applies to ALL of them (e.g. customer replies just
+    #    "2PM" intending it for both viewings - matches what the AI itself
+    #    confirms back to the customer)
+    pending_days = state['pending_days']
+    slots = state['slots']
+    for d in find_days_in_message(lower):
+        if not any(q['iso'] == d['iso'] for q in pending_days):
+            pending_days.append({'iso': d['iso'], 'display': d['display']})
+    times_here = find_all_times(lower)
+    if times_here and pending_days:
+        if len(times_here) == 1 and len(pending_days) > 1:
+            # One time given for multiple pending days - apply to all
+            pairs = [(d, times_here[0]) for d in pending_days]
+        else:
+            pairs = list(zip(pending_days, times_here))
+        for d, t in pairs:
+            if not any(s['iso'] == d['iso'] and s['time'] == t for s in slots):
+                slots.append({'iso': d['iso'], 'display': d['display'], 'time': t,
+                              'property': state['pending_property']})
+        state['pending_days'] = pending_days[len(pairs):]
+
+
+def update_conversation_state(agency_id, state, conversation_history):
+    """Brings `state` up to date with `conversation_history`, scanning only
+    the messages it hasn't seen yet. Falls back to a full rescan when the
+    state is from an older format, the listing catalog changed, or the
+    history is shorter than what was already processed."""
+    catalog = get_listing_catalog(agency_id)
+    if (state.get('version') != CONVERSATION_STATE_VERSION
+            or state.get('catalog_key') != catalog['key']
+            or state.get('processed', 0) > len(conversation_history)):
+        state.clear()
+        state.update(new_conversation_state(catalog['key']))
+    start = state['processed']
+    prev = conversation_history[start - 1] if start else None
+    for index in range(start, len(conversation_history)):
+        msg = conversation_history[index]
+        _observe_message(state, catalog, index, prev, msg)
+        prev = msg
+    state['processed'] = len(conversation_history)
+    return state
+
+
+def build_conversation_state(agency_id, conversation_history):
+    """One-off state for callers that only have a raw history."""
+    return update_conversation_state(agency_id, new_conversation_state(), conversation_history or [])
+
+
+# ─────────────────────────────────────────────────────
+# SESSION REAPER
+# Sessions idle past SESSION_TTL are deleted off the request path, in
+# bounded batches, by whichever process claims the reaper lease - at most
+# one sweep per SESSION_REAP_SECONDS across every web and worker process.
+# ─────────────────────────────────────────────────────
+
+SESSION_TTL = timedelta(minutes=30)
+SESSION_REAP_SECONDS = float(os.getenv("SESSION_REAP_SECONDS", "60"))
+SESSION_REAP_BATCH = int(os.getenv("SESSION_REAP_BATCH", "500"))
+SESSION_REAP_MAX_BATCHES = 20     # per sweep - the next sweep picks up the rest
+
+
+def claim_lease(name, seconds):
+    """True if this process now holds the named lease for `seconds`. Same
+    claim as process_pending_jobs(): a conditional UPDATE that only one
+    process can win once the previous lease has run out."""
+    now = datetime.utcnow()
+    if not db.session.get(MaintenanceLease, name):
+        db.session.add(MaintenanceLease(name=name, holder=None, expires_at=now - timedelta(seconds=1)))
         try:
-            booked = set(json.loads(row.booked_slots or '[]'))
+            db.session.commit()
         except Exception:
-            booked = set()
-        return history, booked
-    print(f"🆕 New session started: {session_key}")
-    return [], set()
+            db.session.rollback()   # another process created it first
+    claimed = MaintenanceLease.query.filter(
+        MaintenanceLease.name == name,
+        MaintenanceLease.expires_at < now
+    ).update({"holder": f"{socket.gethostname()}:{os.getpid()}", "expires_at": now + timedelta(seconds=seconds)},
+             synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
 
 
-def save_session(session_key, history, booked_slots):
-    """Persist conversation history + booked slots to DB."""
+def reap_expired_sessions():
+    """Deletes sessions idle past SESSION_TTL with their messages, slots and
+    state, SESSION_REAP_BATCH keys per commit. Returns how many went, or
+    None if another process has the sweep. Needs an app context."""
     try:
+        if not claim_lease('session_reaper', SESSION_REAP_SECONDS):
+            return None
+        cutoff = datetime.utcnow() - SESSION_TTL
+        total = 0
+        for _ in range(SESSION_REAP_MAX_BATCHES):
+            keys = db.session.scalars(
+                db.select(ConversationSession.session_key)
+                .where(ConversationSession.updated_at < cutoff)
+                .order_by(ConversationSession.updated_at)
+                .limit(SESSION_REAP_BATCH)
+            ).all()
+            if not keys:
+                break
+            for model in (ConversationMessage, SessionBookedSlot, ConversationState, ConversationSession):
+                model.query.filter(model.session_key.in_(keys)).delete(synchronize_session=False)
+            db.session.commit()
+            total += len(keys)
+            if len(keys) < SESSION_REAP_BATCH:
+                break
+        if total:
+            print(f"🧹 {total} expired session(s) cleared")
+        return total
+    except Exception as e:
+        print(f"⚠️ Session reaper error: {e}")
+        db.session.rollback()
+        return 0
+
+
+# ─────────────────────────────────────────────────────
+# SESSION STORE (in-process LRU + write-behind)
+# Hot conversations live in memory, so a turn doesn't re-read its whole
+# history: a cached session is checked against the DB with one indexed
+# MAX(seq) lookup and only reloaded when another process has written to
+# it since. Each turn is written through by default. Writes are
+# append-only: one ConversationMessage INSERT per new message and one
+# SessionBookedSlot per new slot, never a rewrite of the conversation.
+# SESSION_WRITE_BEHIND=1 instead writes dirty sessions back every
+# SESSION_FLUSH_SECONDS, when evicted and at shutdown - only safe when
+# every turn of a conversation lands on the same process (one worker,
+# or sticky routing), so that mode also skips the MAX(seq) check and a
+# hot session costs no DB reads per turn. SESSION_CACHE_SIZE=0 turns the
+# cache off.
+# ─────────────────────────────────────────────────────
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "2000"))
+SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "0") == "1"
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "5"))
+
+
+class SessionStore:
+    def __init__(self, max_sessions, flush_seconds, write_behind=False):
+        self.max_sessions = max_sessions
+        self.flush_seconds = flush_seconds
+        self.write_behind = write_behind and max_sessions > 0
+        self._entries = OrderedDict()     # session_key -> entry, LRU order
+        self._unflushed = {}              # evicted but still dirty
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()   # one writer per process - no duplicate INSERTs
+        self._flusher_pid = None
+
+    def get(self, session_key):
+        """The session's entry, loaded from the DB on a miss. Treat it as
+        read-only - load_chat_session() hands out copies."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_key) or self._unflushed.get(session_key)
+        if entry and now - entry['touched'] > SESSION_TTL.total_seconds():
+            if entry['dirty']:
+                self._write_or_drop(session_key, entry)   # don't lose the unflushed turns
+            self.forget(session_key)
+            entry = None
+        # Write-behind assumes this process owns the conversation - nobody
+        # else can have appended to it.
+        if entry is not None and not self.write_behind and self._stale(session_key, entry):
+            if entry['dirty']:
+                print(f"⚠️ Session {session_key} was written by another process - dropping "
+                      f"{len(entry['history']) - entry['saved_messages']} unsaved message(s)")
+            self.forget(session_key)
+            entry = None
+        if entry is None:
+            entry = self._load(session_key)
+        elif entry['summary_pending']:
+            self._refresh_summary(session_key, entry)
+        with self._lock:
+            entry['touched'] = now
+            if self.max_sessions:
+                self._unflushed.pop(session_key, None)
+                self._entries[session_key] = entry
+                self._entries.move_to_end(session_key)
+                while len(self._entries) > self.max_sessions:
+                    self._evict(next(iter(self._entries)))
+        return entry
+
+    def put(self, session_key, history, booked_slots, state):
+        """Stores the turn's result; save_session() or the flusher writes it
+        to the DB."""
+        with self._lock:
+            entry = self._entries.get(session_key) or self._unflushed.get(session_key)
+        if entry is None:
+            entry = self._saved_in_db(session_key)   # cache off, or evicted mid-turn
+        with self._lock:
+            entry.update(history=history, booked_slots=booked_slots, state=state,
+                         updated_at=datetime.utcnow(), touched=time.monotonic(), is_new=False)
+            entry['rev'] += 1
+            entry['dirty'] = True
+            if self.max_sessions:
+                self._entries[session_key] = entry
+                self._entries.move_to_end(session_key)
+                while len(self._entries) > self.max_sessions:
+                    self._evict(next(iter(self._entries)))
+        if self.write_behind:
+            self._ensure_flusher()
+        return entry
+
+    def write_now(self, session_key, entry):
+        """Writes one session immediately and commits the caller's DB session
+        along with it."""
+        with self._write_lock:
+            rev = entry['rev']
+            try:
+                saved = self._write(session_key, entry)
+                db.session.commit()
+            except Exception:
+                # Most likely another process appended to this session
+                # first - reload it from the DB on the next turn.
+                db.session.rollback()
+                self.forget(session_key)
+                raise
+            self._mark_saved(session_key, entry, rev, saved)
+
+    def forget(self, session_key):
+        with self._lock:
+            self._entries.pop(session_key, None)
+            self._unflushed.pop(session_key, None)
+
+    def mark_summary_pending(self, session_key):
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry:
+                entry['summary_pending'] = True
+
+    def drop_prefix(self, prefix):
+        """Forget every cached session whose key starts with prefix (agency deleted / cleared)."""
+        with self._lock:
+            for store in (self._entries, self._unflushed):
+                for key in [k for k in store if k.startswith(prefix)]:
+                    del store[key]
+
+    def flush(self):
+        """Writes every dirty session, one commit each so a bad row can't
+        hold back the rest. Needs an app context. Returns the count."""
+        with self._lock:
+            batch = [(k, e) for k, e in self._entries.items() if e['dirty']]
+            batch += list(self._unflushed.items())
+        return sum(1 for key, entry in batch if self._write_or_drop(key, entry))
+
+    def _write_or_drop(self, session_key, entry):
+        """Writes a dirty entry. If the DB already has rows this entry
+        would insert, another process wrote the session first: the entry
+        can never be saved, so it is dropped and the session reloaded on
+        its next turn instead of failing every flush from now on."""
+        with self._write_lock:
+            rev = entry['rev']
+            try:
+                saved = self._write(session_key, entry)
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                print(f"⚠️ Session {session_key} was written by another process - dropping "
+                      f"{len(entry['history']) - entry['saved_messages']} unsaved message(s): {e.orig}")
+                self.forget(session_key)
+                return False
+            except Exception as e:
+                print(f"⚠️ Session flush error ({session_key}): {e}")
+                db.session.rollback()
+                return False
+            self._mark_saved(session_key, entry, rev, saved)
+            return True
+
+    def _stale(self, session_key, entry):
+        """True if the DB holds messages this cached entry hasn't seen (or
+        the session was reaped) - one MAX(seq) on the primary key."""
+        last_seq = db.session.query(func.max(ConversationMessage.seq)) \
+            .filter(ConversationMessage.session_key == session_key).scalar()
+        return (0 if last_seq is None else last_seq + 1) != entry['saved_messages']
+
+    def _saved_in_db(self, session_key):
+        """A blank entry whose saved_* match what the DB holds, so put()
+        without a cached entry appends instead of re-inserting."""
+        entry = self._blank()
+        row = db.session.get(ConversationSession, session_key)
+        if row:
+            last_seq = db.session.query(func.max(ConversationMessage.seq)) \
+                .filter(ConversationMessage.session_key == session_key).scalar()
+            entry['saved_messages'] = 0 if last_seq is None else last_seq + 1
+            entry['saved_slots'] = frozenset(db.session.scalars(
+                db.select(SessionBookedSlot.slot_id).where(SessionBookedSlot.session_key == session_key)))
+            entry['legacy'] = last_seq is None and row.history not in (None, '', '[]')
+            entry['summary'], entry['summary_upto'] = row.summary, row.summary_upto or 0
+        return entry
+
+    def _blank(self):
+        return {'history': [], 'booked_slots': set(), 'state': None, 'summary': None,
+                'summary_upto': 0, 'summary_pending': False, 'updated_at': datetime.utcnow(),
+                'touched': time.monotonic(), 'rev': 0, 'dirty': False, 'is_new': True,
+                'saved_messages': 0, 'saved_slots': frozenset(), 'legacy': False}
+
+    def _mark_saved(self, session_key, entry, rev, saved):
+        with self._lock:
+            entry['saved_messages'], entry['saved_slots'] = saved
+            entry['legacy'] = False
+            if entry['rev'] == rev:
+                entry['dirty'] = False
+                if self._unflushed.get(session_key) is entry:
+                    del self._unflushed[session_key]
+
+    def _evict(self, session_key):
+        entry = self._entries.pop(session_key, None)
+        if entry is not None and entry['dirty']:
+            self._unflushed[session_key] = entry
+
+    def _load(self, session_key):
+        entry = self._blank()
+        row = db.session.get(ConversationSession, session_key)
+        if row:
+            entry['is_new'] = False
+            entry['history'] = load_messages(session_key)
+            entry['saved_messages'] = len(entry['history'])
+            slots = set(db.session.scalars(
+                db.select(SessionBookedSlot.slot_id).where(SessionBookedSlot.session_key == session_key)))
+            entry['booked_slots'], entry['saved_slots'] = slots, frozenset(slots)
+            if not entry['history'] and row.history not in (None, '', '[]'):
+                # Session from before messages got their own table - its
+                # blob is migrated on the next write.
+                entry['legacy'] = True
+                entry['saved_messages'], entry['saved_slots'] = 0, frozenset()
+                try:
+                    entry['history'] = json.loads(row.history)
+                    entry['booked_slots'] |= set(json.loads(row.booked_slots or '[]'))
+                except Exception:
+                    pass
+            entry['summary'], entry['summary_upto'] = row.summary, row.summary_upto or 0
+            entry['updated_at'] = row.updated_at or entry['updated_at']
+        state_row = db.session.get(ConversationState, session_key)
+        if state_row:
+            try:
+                entry['state'] = json.loads(state_row.data or '{}')
+            except Exception:
+                pass
+        return entry
+
+    def _refresh_summary(self, session_key, entry):
+        """The summary is written by the job worker, straight to the DB -
+        re-read it (two columns) only while a refresh is outstanding."""
+        row = db.session.query(ConversationSession.summary, ConversationSession.summary_upto) \
+            .filter_by(session_key=session_key).first()
+        if row and (row.summary_upto or 0) > entry['summary_upto']:
+            entry['summary'], entry['summary_upto'] = row.summary, row.summary_upto
+            entry['summary_pending'] = False
+
+    def _write(self, session_key, entry):
+        """Adds the session's unsaved messages/slots to the DB session.
+        Returns what will be saved once committed."""
+        history, slots = entry['history'], frozenset(entry['booked_slots'])
         row = db.session.get(ConversationSession, session_key)
         if not row:
-            row = ConversationSession(session_key=session_key)
+            row = ConversationSession(session_key=session_key, history='[]', booked_slots='[]')
             db.session.add(row)
-        row.history = json.dumps(history)
-        row.booked_slots = json.dumps(sorted(booked_slots))
-        row.updated_at = datetime.utcnow()
-        db.session.commit()
+        elif entry['legacy']:
+            row.history, row.booked_slots = '[]', '[]'
+        db.session.add_all(
+            ConversationMessage(session_key=session_key, seq=seq, role=msg['role'], content=msg['content'])
+            for seq, msg in enumerate(history[entry['saved_messages']:], start=entry['saved_messages']))
+        db.session.add_all(SessionBookedSlot(session_key=session_key, slot_id=slot_id)
+                           for slot_id in slots - entry['saved_slots'])
+        row.updated_at = entry['updated_at']
+        if entry['state'] is not None:
+            state_row = db.session.get(ConversationState, session_key)
+            if not state_row:
+                state_row = ConversationState(session_key=session_key)
+                db.session.add(state_row)
+            state_row.data = json.dumps(entry['state'])
+            state_row.updated_at = entry['updated_at']
+        return len(history), slots
+
+    def _ensure_flusher(self):
+        # Started lazily and per PID - a thread started before gunicorn
+        # forks its workers would not exist in them.
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="session-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            with app.app_context():
+                self.flush()
+                reap_expired_sessions()
+
+
+session_store = SessionStore(SESSION_CACHE_SIZE, SESSION_FLUSH_SECONDS, SESSION_WRITE_BEHIND)
+
+
+def _flush_sessions_at_exit():
+    with app.app_context():
+        session_store.flush()
+
+
+atexit.register(_flush_sessions_at_exit)
+
+
+def load_messages(session_key, start=0, stop=None):
+    """Messages [start, stop) of a session in order - a range read on the
+    (session_key, seq) primary key."""
+    query = db.session.query(ConversationMessage.role, ConversationMessage.content).filter(
+        ConversationMessage.session_key == session_key, ConversationMessage.seq >= start)
+    if stop is not None:
+        query = query.filter(ConversationMessage.seq < stop)
+    return [{'role': role, 'content': content} for role, content in query.order_by(ConversationMessage.seq)]
+
+
+def load_chat_session(session_key):
+    """(history, booked_slots, state, summary, summary_upto) for a turn.
+    Copies, so a turn that fails half-way leaves the cached session as it was."""
+    entry = session_store.get(session_key)
+    if entry['is_new']:
+        print(f"🆕 New session started: {session_key}")
+    state = copy.deepcopy(entry['state']) if entry['state'] else new_conversation_state()
+    summary = entry['summary']
+    return (list(entry['history']), set(entry['booked_slots']), state,
+            summary, entry['summary_upto'] if summary else 0)
+
+
+def save_session(session_key, history, booked_slots, state=None, write_through=False):
+    """Stores the turn's session and commits whatever else the turn queued
+    (jobs, usage log). The session rows themselves are written behind,
+    unless write_through."""
+    try:
+        entry = session_store.put(session_key, history, booked_slots, state)
+        if write_through or not session_store.write_behind:
+            session_store.write_now(session_key, entry)
+        else:
+            db.session.commit()
     except Exception as e:
         print(f"⚠️ Session save error: {e}")
         db.session.rollback()
 
 
-def generate_lead_summary(conversation_history, agency_name):
+# ─────────────────────────────────────────────────────
+# TOKEN-BUDGETED HISTORY WINDOW
+# The model sees the newest messages that fit HISTORY_TOKEN_BUDGET;
+# everything older is replaced by a rolling summary stored on the session
+# (ConversationSession.summary covers history[:summary_upto]), refreshed
+# by the 'session_summary' background job.
+# ─────────────────────────────────────────────────────
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+SUMMARY_REFRESH_MIN_MESSAGES = 6   # messages past the summary before a refresh is queued
+
+
+def estimate_tokens(text):
+    """~4 characters per token for the scripts we support, plus the
+    per-message overhead. The budget only needs to be roughly right, so
+    no tokenizer dependency."""
+    return len(text) // 4 + 4
+
+
+def history_window_start(history, budget=None):
+    """Index of the oldest message that still fits the budget, counting
+    back from the newest. The newest message is always kept."""
+    budget = HISTORY_TOKEN_BUDGET if budget is None else budget
+    used = 0
+    for i in range(len(history) - 1, -1, -1):
+        used += estimate_tokens(history[i]['content'])
+        if used > budget and i < len(history) - 1:
+            return i + 1
+    return 0
+
+
+def build_history_messages(history, summary, summary_upto):
+    """Rolling summary (if needed) + the newest messages within budget.
+    Messages the summary doesn't cover yet are kept - the window runs
+    over budget until the background refresh catches up - but never past
+    twice the budget, so a stalled job worker can't grow prompts forever."""
+    start = min(history_window_start(history), summary_upto if summary else 0)
+    start = max(start, history_window_start(history, 2 * HISTORY_TOKEN_BUDGET))
+    if start == 0 or not summary:
+        return history[start:]
+    return ([{"role": "system", "content": f"Summary of the earlier conversation (older messages omitted): {summary}"}]
+            + history[start:])
+
+
+def queue_summary_refresh(session_key, history, summary_upto):
+    """Queues a summary refresh once enough messages have slid out of the
+    window. Call before the session is saved so both commit together.
+    Returns True if queued - the job reads the history from the DB, so
+    that save must write through."""
+    start = history_window_start(history)
+    if start - summary_upto >= SUMMARY_REFRESH_MIN_MESSAGES:
+        enqueue_job('session_summary', {'session_key': session_key, 'upto': start},
+                    f"session_summary:{session_key}:{start}")
+        session_store.mark_summary_pending(session_key)
+        return True
+    return False
+
+
+def generate_lead_summary(conversation_history, agency_name, fallback=True):
+    """2-3 sentence summary for the lead email. On an OpenAI error returns a
+    placeholder, or re-raises when fallback is False."""
     try:
         conversation_text = "\n".join([
             f"{'Customer' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
@@ -1243,154 +2436,188 @@ Write summary:"""
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"❌ Summary error: {e}")
+        if not fallback:
+            raise
         return "Customer engaged in property conversation."
 
 
-def extract_name_from_context(conversation_history):
-    not_a_name = {
-        'yes', 'no', 'ok', 'okay', 'sure', 'fine', 'good', 'great',
-        'hello', 'hi', 'hey', 'thanks', 'thank', 'please', 'sorry',
-        'email', 'phone', 'whatsapp', 'call', 'text', 'message',
-        'looking', 'interested', 'want', 'need', 'like', 'going',
-        'villa', 'house', 'apartment', 'property', 'condo', 'flat', 'home',
-        'beach', 'miami', 'malibu', 'florida', 'california', 'usa',
-        'within', 'about', 'around', 'budget', 'price', 'cost',
-        'month', 'week', 'year', 'soon', 'asap', 'later', 'today',
-        'just', 'also', 'here', 'there', 'then', 'when', 'where',
-        'what', 'how', 'why', 'who', 'which', 'that', 'this', 'with',
-        'from', 'have', 'been', 'will', 'would', 'could', 'should',
-        'south', 'north', 'east', 'west', 'central', 'downtown',
-        'coconut', 'grove', 'hilton', 'santa', 'monica', 'myrtle',
-        'asking', 'checking', 'getting', 'making', 'trying'
-    }
+def summarize_conversation(previous_summary, messages):
+    """Folds older messages into the session's rolling summary. Unlike the
+    lead summary, errors propagate so the background job retries."""
+    conversation_text = "\n".join(
+        f"{'Customer' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+        for msg in messages
+    )
+    prompt = f"""Update the running summary of a real estate chat with the new messages below.
+Keep EVERY concrete fact: customer name, email, phone/WhatsApp, property type, buy or rent, locations, budget, bedrooms/bathrooms, properties discussed by name, viewings booked (property, date, time), objections and open questions.
+Write in ENGLISH, plain text, at most 120 words.
+Current summary:
+{previous_summary or "(none yet)"}
+New messages:
+{conversation_text}
+Updated summary:"""
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.2, max_tokens=250
+    )
+    return response.choices[0].message.content.strip()
+
+
+NOT_A_NAME = {
+    'yes', 'no', 'ok', 'okay', 'sure', 'fine', 'good', 'great',
+    'hello', 'hi', 'hey', 'thanks', 'thank', 'please', 'sorry',
+    'email', 'phone', 'whatsapp', 'call', 'text', 'message',
+    'looking', 'interested', 'want', 'need', 'like', 'going',
+    'villa', 'house', 'apartment', 'property', 'condo', 'flat', 'home',
+    'beach', 'miami', 'malibu', 'florida', 'california', 'usa',
+    'within', 'about', 'around', 'budget', 'price', 'cost',
+    'month', 'week', 'year', 'soon', 'asap', 'later', 'today',
+    'just', 'also', 'here', 'there', 'then', 'when', 'where',
+    'what', 'how', 'why', 'who', 'which', 'that', 'this', 'with',
+    'from', 'have', 'been', 'will', 'would', 'could', 'should',
+    'south', 'north', 'east', 'west', 'central', 'downtown',
+    'coconut', 'grove', 'hilton', 'santa', 'monica', 'myrtle',
+    'asking', 'checking', 'getting', 'making', 'trying'
+}
 
-    # ── METHOD 0: Language-agnostic — reply to AI's very first message ──
-    # The AI always asks for the name first. history[1]=assistant question,
-    # history[2]=user's name reply. We strip a recognized SELF-INTRODUCTION
-    # PREFIX PHRASE ("I am", "Ich bin", "Jestem"...) rather than a bag of
-    # individually-strippable words, then take the very next token as the
-    # name. This matters because some real first names collide with short
-    # function words in other languages (e.g. "Kim" is also the Polish word
-    # for "who") - a phrase-prefix match only fires when that exact
-    # grammatical construction opens the message, so a name occupying the
-    # NAME position is never mistaken for a filler word it happens to
-    # resemble in an unrelated language.
-    if (len(conversation_history) >= 3
-            and conversation_history[1]['role'] == 'assistant'
-            and conversation_history[2]['role'] == 'user'):
-        candidate_msg = conversation_history[2]['content']
-        cleaned = re.sub(r'[.,!?;:¿¡]', ' ', candidate_msg).strip()
-        cleaned = re.sub(r'\s+', ' ', cleaned)
-
-        for greet in NAME_GREETING_PREFIXES:
-            gm = re.match(r'^' + re.escape(greet) + r'\b\s*', cleaned, re.IGNORECASE)
-            if gm:
-                cleaned = cleaned[gm.end():].strip()
-                break
+NAME_QUESTION_PHRASES = [
+    "what's your name", "what is your name", "whats your name",
+    "your name?", "may i have your name", "can i get your name",
+    "could i get your name", "mind sharing your name",
+    "first name", "tell me your name", "know your name",
+    "who i'm speaking with", "who i am speaking with", "who's this"
+]
+NAME_QUESTION_MATCHER = compile_keywords(NAME_QUESTION_PHRASES)
+
+_EXPLICIT_NAME_PATTERN = r'(?:i\s+am|i\'m|my\s+name\s+is|name\s+is|call\s+me|this\s+is)\s+([a-zA-Z]{2,30})(?:\s|[.,!?]|$)'
+
+
+def _first_turn_name(candidate_msg):
+    """METHOD 0: Language-agnostic — reply to AI's very first message.
+    The AI always asks for the name first. history[1]=assistant question,
+    history[2]=user's name reply. We strip a recognized SELF-INTRODUCTION
+    PREFIX PHRASE ("I am", "Ich bin", "Jestem"...) rather than a bag of
+    individually-strippable words, then take the very next token as the
+    name. This matters because some real first names collide with short
+    function words in other languages (e.g. "Kim" is also the Polish word
+    for "who") - a phrase-prefix match only fires when that exact
+    grammatical construction opens the message, so a name occupying the
+    NAME position is never mistaken for a filler word it happens to
+    resemble in an unrelated language."""
+    cleaned = re.sub(r'[.,!?;:¿¡]', ' ', candidate_msg).strip()
+    cleaned = re.sub(r'\s+', ' ', cleaned)
+
+    for greet in NAME_GREETING_PREFIXES:
+        gm = re.match(r'^' + re.escape(greet) + r'\b\s*', cleaned, re.IGNORECASE)
+        if gm:
+            cleaned = cleaned[gm.end():].strip()
+            break
 
-        for prefix_pattern in NAME_INTRO_PREFIXES:
-            pm = re.match(prefix_pattern, cleaned, re.IGNORECASE)
-            if pm:
-                cleaned = cleaned[pm.end():].strip()
-                break
+    for prefix_pattern in NAME_INTRO_PREFIXES:
+        pm = re.match(prefix_pattern, cleaned, re.IGNORECASE)
+        if pm:
+            cleaned = cleaned[pm.end():].strip()
+            break
 
-        tokens = cleaned.split()
-        if tokens:
-            candidate = tokens[0]
-            if (re.match(r'^[A-Za-zÀ-ÖØ-öø-ÿążćęłńóśźŻĄĆĘŁŃÓŚŹ]{2,30}$', candidate)
-                    and candidate.lower() not in not_a_name):
-                print(f"✅ Name (first-turn, lang-agnostic): {candidate.title()}")
-                return candidate.title()
-
-    name_question_patterns = [
-        "what's your name", "what is your name", "whats your name",
-        "your name?", "may i have your name", "can i get your name",
-        "could i get your name", "mind sharing your name",
-        "first name", "tell me your name", "know your name",
-        "who i'm speaking with", "who i am speaking with", "who's this"
-    ]
-    for i, msg in enumerate(conversation_history):
-        if msg['role'] == 'assistant':
-            ai_text = msg['content'].lower()
-            if any(pattern in ai_text for pattern in name_question_patterns):
-                if i + 1 < len(conversation_history):
-                    next_msg = conversation_history[i + 1]
-                    if next_msg['role'] == 'user':
-                        candidate = next_msg['content'].strip()
-                        candidate = re.sub(
-                            r'^(i\s+am|i\'m|my\s+name\s+is|name\s+is|it\'s|its|call\s+me|this\s+is)\s+',
-                            '', candidate, flags=re.IGNORECASE).strip()
-                        first_word = candidate.split()[0] if candidate.split() else ''
-                        if (first_word and re.match(r'^[a-zA-Z]{2,30}$', first_word)
-                                and first_word.lower() not in not_a_name):
-                            print(f"✅ Name (context): {first_word.title()}")
-                            return first_word.title()
-
-    explicit_pattern = r'(?:i\s+am|i\'m|my\s+name\s+is|name\s+is|call\s+me|this\s+is)\s+([a-zA-Z]{2,30})(?:\s|[.,!?]|$)'
-    found_names = []
-    for msg in conversation_history:
-        if msg['role'] == 'user':
-            for match in re.finditer(explicit_pattern, msg['content'], re.IGNORECASE):
-                candidate = match.group(1).strip()
-                if (re.match(r'^[a-zA-Z]{2,30}$', candidate)
-                        and candidate.lower() not in not_a_name):
-                    found_names.append(candidate.title())
-    if found_names:
-        print(f"✅ Name (explicit): {found_names[-1]}")
-        return found_names[-1]
+    tokens = cleaned.split()
+    if tokens:
+        candidate = tokens[0]
+        if (re.match(r'^[A-Za-zÀ-ÖØ-öø-ÿążćęłńóśźŻĄĆĘŁŃÓŚŹ]{2,30}$', candidate)
+                and candidate.lower() not in NOT_A_NAME):
+            return candidate.title()
+    return None
+
+
+def _name_question_reply(reply):
+    """METHOD 1: the user's answer right after the AI asked for a name."""
+    candidate = reply.strip()
+    candidate = re.sub(
+        r'^(i\s+am|i\'m|my\s+name\s+is|name\s+is|it\'s|its|call\s+me|this\s+is)\s+',
+        '', candidate, flags=re.IGNORECASE).strip()
+    first_word = candidate.split()[0] if candidate.split() else ''
+    if (first_word and re.match(r'^[a-zA-Z]{2,30}$', first_word)
+            and first_word.lower() not in NOT_A_NAME):
+        return first_word.title()
+    return None
+
+
+def extract_name_from_context(conversation_history, state=None):
+    if state is None:
+        state = build_conversation_state(None, conversation_history)
+    if state['name_first_turn']:
+        print(f"✅ Name (first-turn, lang-agnostic): {state['name_first_turn']}")
+        return state['name_first_turn']
+    if state['name_context']:
+        print(f"✅ Name (context): {state['name_context']}")
+        return state['name_context']
+    if state['name_explicit']:
+        print(f"✅ Name (explicit): {state['name_explicit']}")
+        return state['name_explicit']
     print("⚠️ Name: Not found")
     return None
 
 
-def extract_lead_data(agency_id, conversation_history):
-    full_conversation_user = " ".join([
-        msg['content'] for msg in conversation_history if msg['role'] == 'user'
-    ])
+_EMAIL_PATTERN = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b")
+
+PHONE_PATTERNS = [
+    r"\+\d{1,4}[\s\-]?\d{2,4}[\s\-]?\d{3,4}[\s\-]?\d{2,4}",
+    r"\+?\d{9,15}", r"\d{3}[\s\-]?\d{3}[\s\-]?\d{3,4}",
+]
+
+BUDGET_PATTERNS = [
+    r"(\d+(?:\.\d+)?)\s*([MmKk])(?![a-zA-Z])\s*(?:\$|dollars?)?",
+    r"[\$]\s*(\d+(?:\.\d+)?)\s*([MmKk](?![a-zA-Z])|million|thousand|mln|mio)?",
+    r"(\d+(?:\.\d+)?)\s*(million|thousand|lakh|crore|mln|milionów|milionow|mio|millones|millionen|milioni|milhões|milhoes|miljoen|milyon)\s*(?:\$|dollars?|usd|aed|eur|pln)?",
+    r"(?:budget|price|around|afford)\s*[\$]?(\d+(?:\.\d+)?)\s*([MmKk](?![a-zA-Z])|million|thousand|mln)?",
+]
+MILLION_UNITS = ['mln', 'milionów', 'milionow', 'mio', 'millones', 'millionen',
+                 'milioni', 'milhões', 'milhoes', 'miljoen', 'milyon']
+
+CONTACT_EMAIL_WORDS = ['email', 'e-mail', 'mail', 'correo']
+CONTACT_PHONE_WORDS = ['phone', 'call', 'telefon', 'teléfono', 'telefono', 'téléphone', 'telefone']
+NUMBER_DECLINE_WORDS = ['no', 'nope', 'skip', 'pass', 'later', 'not now', "don't", 'prefer not',
+                        'nein', 'nie', 'non', 'não', 'nao', 'hayır', 'hayir', 'nahi', 'nahin']
+CONTACT_EMAIL_MATCHER = compile_keywords(CONTACT_EMAIL_WORDS)
+CONTACT_PHONE_MATCHER = compile_keywords(CONTACT_PHONE_WORDS)
+NUMBER_DECLINE_MATCHER = compile_keywords(NUMBER_DECLINE_WORDS)
+
+
+def _contact_preference_from_reply(user_pref):
+    has_email = bool(CONTACT_EMAIL_MATCHER.search(user_pref))
+    has_whatsapp = 'whatsapp' in user_pref or 'wa' in user_pref.split()
+    has_phone = bool(CONTACT_PHONE_MATCHER.search(user_pref))
+    if has_email and has_whatsapp:
+        return 'email_and_whatsapp'
+    elif has_email and has_phone:
+        return 'email_and_phone'
+    elif has_whatsapp:
+        return 'whatsapp'
+    elif has_phone:
+        return 'phone'
+    elif has_email:
+        return 'email'
+    return None
+
+
+def extract_lead_data(agency_id, conversation_history, state=None):
+    if state is None:
+        state = build_conversation_state(agency_id, conversation_history)
     lead_data = {
         'name': None, 'email': None, 'phone': None,
         'whatsapp_number': None, 'contact_preference': 'email', 'budget': None
     }
-    email_match = re.search(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b", full_conversation_user)
-    if email_match:
-        lead_data['email'] = email_match.group(0)
-
-    lead_data['name'] = extract_name_from_context(conversation_history)
-
-    for i, msg in enumerate(conversation_history):
-        if msg['role'] == 'assistant':
-            if is_contact_question(msg['content']):
-                if i + 1 < len(conversation_history):
-                    next_msg = conversation_history[i + 1]
-                    if next_msg['role'] == 'user':
-                        user_pref = next_msg['content'].lower()
-                        has_email = any(w in user_pref for w in ['email', 'e-mail', 'mail', 'correo'])
-                        has_whatsapp = 'whatsapp' in user_pref or 'wa' in user_pref.split()
-                        has_phone = any(w in user_pref for w in ['phone', 'call', 'telefon', 'teléfono', 'telefono', 'téléphone', 'telefone'])
-                        if has_email and has_whatsapp:
-                            lead_data['contact_preference'] = 'email_and_whatsapp'
-                        elif has_email and has_phone:
-                            lead_data['contact_preference'] = 'email_and_phone'
-                        elif has_whatsapp:
-                            lead_data['contact_preference'] = 'whatsapp'
-                        elif has_phone:
-                            lead_data['contact_preference'] = 'phone'
-                        elif has_email:
-                            lead_data['contact_preference'] = 'email'
-                        break
-
-    whatsapp_keywords = ['whatsapp', 'whats app']
-    mentions_whatsapp = any(kw in full_conversation_user.lower() for kw in whatsapp_keywords)
+    lead_data['email'] = state['email']
+    lead_data['name'] = extract_name_from_context(conversation_history, state)
+    if state['contact_preference']:
+        lead_data['contact_preference'] = state['contact_preference']
+
+    mentions_whatsapp = state['mentions_whatsapp']
     if lead_data['contact_preference'] in ('whatsapp', 'email_and_whatsapp'):
         mentions_whatsapp = True
 
-    phone_patterns = [
-        r"\+\d{1,4}[\s\-]?\d{2,4}[\s\-]?\d{3,4}[\s\-]?\d{2,4}",
-        r"\+?\d{9,15}", r"\d{3}[\s\-]?\d{3}[\s\-]?\d{3,4}",
-    ]
-    for pattern in phone_patterns:
-        phone_match = re.search(pattern, full_conversation_user)
-        if phone_match:
-            phone = phone_match.group(0).strip()
+    for phone in state['phone_hits']:
+        if phone:
             clean = phone.replace('+', '').replace('-', '').replace(' ', '')
             if len(clean) >= 9:
                 if mentions_whatsapp:
@@ -1399,32 +2626,21 @@ def extract_lead_data(agency_id, conversation_history):
                 else:
                     lead_data['phone'] = phone
                     print(f"✅ Phone: {phone}")
-                break
+            break
 
-    budget_patterns = [
-        r"(\d+(?:\.\d+)?)\s*([MmKk])(?![a-zA-Z])\s*(?:\$|dollars?)?",
-        r"[\$]\s*(\d+(?:\.\d+)?)\s*([MmKk](?![a-zA-Z])|million|thousand|mln|mio)?",
-        r"(\d+(?:\.\d+)?)\s*(million|thousand|lakh|crore|mln|milionów|milionow|mio|millones|millionen|milioni|milhões|milhoes|miljoen|milyon)\s*(?:\$|dollars?|usd|aed|eur|pln)?",
-        r"(?:budget|price|around|afford)\s*[\$]?(\d+(?:\.\d+)?)\s*([MmKk](?![a-zA-Z])|million|thousand|mln)?",
-    ]
-    million_units = ['mln', 'milionów', 'milionow', 'mio', 'millones', 'millionen',
-                      'milioni', 'milhões', 'milhoes', 'miljoen', 'milyon']
-    for pattern in budget_patterns:
-        budget_match = re.search(pattern, full_conversation_user, re.IGNORECASE)
-        if budget_match:
-            amount = budget_match.group(1)
-            unit = budget_match.group(2) if len(budget_match.groups()) > 1 and budget_match.group(2) else ''
+    for hit in state['budget_hits']:
+        if hit:
+            amount, unit = hit
             if unit:
                 unit = unit.lower()
                 if unit in ['m', 'million']: unit = 'million'
                 elif unit in ['k', 'thousand']: unit = 'thousand'
             currency = ''
-            low_all = full_conversation_user.lower()
-            if '$' in full_conversation_user or 'dollar' in low_all or 'dólar' in low_all or 'dolar' in low_all:
+            if state['mentions_usd']:
                 currency = 'USD'
-            elif 'aed' in low_all:
+            elif state['mentions_aed']:
                 currency = 'AED'
-            if unit in million_units:
+            if unit in MILLION_UNITS:
                 unit = 'million'
             lead_data['budget'] = f"{amount} {unit} {currency}".strip() if unit else f"{amount} {currency}".strip()
             print(f"✅ Budget: {lead_data['budget']}")
@@ -1434,13 +2650,68 @@ def extract_lead_data(agency_id, conversation_history):
     # among listings actually named in the conversation as a reasonable
     # stand-in for their budget ceiling.
     if not lead_data['budget']:
-        lead_data['budget'] = infer_budget_from_discussed_listings(agency_id, conversation_history)
+        lead_data['budget'] = infer_budget_from_discussed_listings(agency_id, conversation_history, state)
         if lead_data['budget']:
             print(f"✅ Budget (inferred from discussed listings): {lead_data['budget']}")
     return lead_data
 
 
-def extract_appointment_data(agency_id, conversation_history):
+TIME_PATTERNS = [
+    (r'\b10[:.]00\s*(?:am|uhr|h)?\b', '10:00 AM'),
+    (r'\b(10\s*am|10\s*o\'?clock)\b', '10:00 AM'),
+    (r'\b12[:.]00\s*(?:pm|uhr|h)?\b', '12:00 PM'),
+    (r'\b(12\s*pm|noon|12\s*o\'?clock)\b', '12:00 PM'),
+    (r'\b2[:.]00\s*pm\b', '2:00 PM'),
+    (r'\b14[:.]00\s*(?:uhr|h)?\b', '2:00 PM'),
+    (r'\b(2\s*pm|2\s*o\'?clock)\b', '2:00 PM'),
+    (r'\b4[:.]00\s*pm\b', '4:00 PM'),
+    (r'\b16[:.]00\s*(?:uhr|h)?\b', '4:00 PM'),
+    (r'\b(4\s*pm|4\s*o\'?clock)\b', '4:00 PM'),
+    (r'\b6[:.]00\s*pm\b', '6:00 PM'),
+    (r'\b18[:.]00\s*(?:uhr|h)?\b', '6:00 PM'),
+    (r'\b(6\s*pm|6\s*o\'?clock)\b', '6:00 PM'),
+    (r'\bmorning\b', '10:00 AM'),
+    (r'\b(afternoon|midday)\b', '2:00 PM'),
+    (r'\b(evening|late afternoon)\b', '4:00 PM'),
+]
+
+
+def find_all_times(text):
+    """ALL times mentioned in a message, in order - needed to pair
+    'two times in one message' with two pending days (e.g.
+    '4:00 PM and 6:00 PM')."""
+    matches = []
+    for pattern, label in TIME_PATTERNS:
+        for m in re.finditer(pattern, text):
+            matches.append((m.start(), label))
+    matches.sort(key=lambda x: x[0])
+    result, seen_pos = [], set()
+    for pos, label in matches:
+        if pos in seen_pos:
+            continue
+        seen_pos.add(pos)
+        result.append(label)
+    return result
+
+
+def find_days_in_message(text):
+    """ALL days mentioned in a single message, in order. Prefers exact
+    calendar dates (most specific, e.g. 'August 17') when present;
+    falls back to weekday-name mentions (ALL of them, not just the
+    last) only when no specific date is given in that message."""
+    dates = find_all_dates_in_text(text)
+    if dates:
+        return dates
+    result, seen_iso = [], set()
+    for pos, word in keyword_hits(WEEKDAY_MATCHER, text):
+        resolved = resolve_next_date(WEEKDAY_WORDS[word])
+        if resolved and resolved['iso'] not in seen_iso:
+            seen_iso.add(resolved['iso'])
+            result.append(resolved)
+    return result
+
+
+def extract_appointment_data(agency_id, conversation_history, state=None):
     """Extracts viewing intent and ALL requested (date, time, property)
     slots. Date and time are paired following the message flow (day
     mentioned -> time mentioned pairs with that day), so multiple viewings
@@ -1449,170 +2720,28 @@ def extract_appointment_data(agency_id, conversation_history):
     asking for a day, e.g. "Which day for the Boston Luxury Estate?" - the
     customer's reply is just a bare day/time), so each slot gets tagged
     with whichever listing was most recently named by either side."""
-    user_msgs = [m['content'] for m in conversation_history if m['role'] == 'user']
-    user_text = " ".join(user_msgs).lower()
-
-    data = {'requested': False, 'slots': []}
-
-    data['requested'] = any(kw in user_text for kw in BOOKING_KEYWORDS)
-
-    if not data['requested']:
-        for i, msg in enumerate(conversation_history):
-            if msg['role'] == 'assistant':
-                ai_lower = msg['content'].lower()
-                if any(p in ai_lower for p in VIEWING_OFFER_PHRASES):
-                    if i + 1 < len(conversation_history):
-                        next_msg = conversation_history[i + 1]
-                        if next_msg['role'] == 'user':
-                            user_reply = re.sub(r'[^\w\sÀ-ÖØ-öø-ÿążćęłńóśźäöüß]', '', next_msg['content'].lower()).strip()
-                            if any(user_reply == w or user_reply.startswith(w + ' ') for w in AFFIRMATIVE_WORDS):
-                                data['requested'] = True
-                                break
-
-    time_patterns = [
-        (r'\b10[:.]00\s*(?:am|uhr|h)?\b', '10:00 AM'),
-        (r'\b(10\s*am|10\s*o\'?clock)\b', '10:00 AM'),
-        (r'\b12[:.]00\s*(?:pm|uhr|h)?\b', '12:00 PM'),
-        (r'\b(12\s*pm|noon|12\s*o\'?clock)\b', '12:00 PM'),
-        (r'\b2[:.]00\s*pm\b', '2:00 PM'),
-        (r'\b14[:.]00\s*(?:uhr|h)?\b', '2:00 PM'),
-        (r'\b(2\s*pm|2\s*o\'?clock)\b', '2:00 PM'),
-        (r'\b4[:.]00\s*pm\b', '4:00 PM'),
-        (r'\b16[:.]00\s*(?:uhr|h)?\b', '4:00 PM'),
-        (r'\b(4\s*pm|4\s*o\'?clock)\b', '4:00 PM'),
-        (r'\b6[:.]00\s*pm\b', '6:00 PM'),
-        (r'\b18[:.]00\s*(?:uhr|h)?\b', '6:00 PM'),
-        (r'\b(6\s*pm|6\s*o\'?clock)\b', '6:00 PM'),
-        (r'\bmorning\b', '10:00 AM'),
-        (r'\b(afternoon|midday)\b', '2:00 PM'),
-        (r'\b(evening|late afternoon)\b', '4:00 PM'),
-    ]
-
-    def find_all_times(text):
-        """ALL times mentioned in a message, in order - needed to pair
-        'two times in one message' with two pending days (e.g.
-        '4:00 PM and 6:00 PM')."""
-        matches = []
-        for pattern, label in time_patterns:
-            for m in re.finditer(pattern, text):
-                matches.append((m.start(), label))
-        matches.sort(key=lambda x: x[0])
-        result, seen_pos = [], set()
-        for pos, label in matches:
-            if pos in seen_pos:
-                continue
-            seen_pos.add(pos)
-            result.append(label)
-        return result
-
-    def find_days_in_message(text):
-        """ALL days mentioned in a single message, in order. Prefers exact
-        calendar dates (most specific, e.g. 'August 17') when present;
-        falls back to weekday-name mentions (ALL of them, not just the
-        last) only when no specific date is given in that message."""
-        dates = find_all_dates_in_text(text)
-        if dates:
-            return dates
-        positions = []
-        for word, normalized in WEEKDAY_WORDS.items():
-            for m in re.finditer(r'\b' + re.escape(word) + r'\b', text):
-                positions.append((m.start(), normalized))
-        positions.sort(key=lambda x: x[0])
-        result, seen_iso = [], set()
-        for pos, day_word in positions:
-            resolved = resolve_next_date(day_word)
-            if resolved and resolved['iso'] not in seen_iso:
-                seen_iso.add(resolved['iso'])
-                result.append(resolved)
-        return result
+    if state is None:
+        state = build_conversation_state(agency_id, conversation_history)
+    return {'requested': state['viewing_requested'],
+            'slots': [dict(s) for s in state['slots']]}
+
+
+def contact_step_completed(conversation_history, state=None):
+    if state is None:
+        state = build_conversation_state(None, conversation_history)
+    if state['user_said_email_only']: return True
+    if state['asked_number'] and (state['gave_number'] or state['user_declined_number']): return True
+    if state['asked_contact_pref'] and state['user_msg_count'] >= 10: return True
+    return False
 
-    # FIFO queue of resolved days awaiting a time. Handles:
-    #  - normal 1 day -> 1 time (classic single booking)
-    #  - N days mentioned together -> N times given later in one message
-    #    (paired in order, e.g. "4:00 PM and 6:00 PM")
-    #  - N days mentioned together -> a SINGLE time given later, meaning
-    #    that time applies to ALL of them (e.g. customer replies just
-    #    "2PM" intending it for both viewings - matches what the AI itself
-    #    confirms back to the customer)
-    pending_days = []
-    pending_property = None
-    for msg in conversation_history:
-        # Property mentions can come from EITHER side - the AI almost
-        # always names the property right before asking for a day.
-        titles_here = detect_listing_titles_in_text(agency_id, msg['content'])
-        if titles_here:
-            pending_property = titles_here[-1]
-
-        if msg['role'] != 'user':
-            continue
 
-        text = msg['content'].lower()
-        days_here = find_days_in_message(text)
-        times_here = find_all_times(text)
-
-        for d in days_here:
-            if not any(q['iso'] == d['iso'] for q in pending_days):
-                pending_days.append(d)
-
-        if times_here and pending_days:
-            if len(times_here) == 1 and len(pending_days) > 1:
-                # One time given for multiple pending days - apply to all
-                t = times_here[0]
-                for d in pending_days:
-                    if not any(s['iso'] == d['iso'] and s['time'] == t for s in data['slots']):
-                        data['slots'].append({'iso': d['iso'], 'display': d['display'], 'time': t, 'property': pending_property})
-                pending_days = []
-            else:
-                pair_count = min(len(times_here), len(pending_days))
-                for i in range(pair_count):
-                    d, t = pending_days[i], times_here[i]
-                    if not any(s['iso'] == d['iso'] and s['time'] == t for s in data['slots']):
-                        data['slots'].append({'iso': d['iso'], 'display': d['display'], 'time': t, 'property': pending_property})
-                pending_days = pending_days[pair_count:]
-    return data
-
-
-def contact_step_completed(conversation_history):
-    asked_contact_pref = False
-    asked_number = False
-    gave_number = False
-    user_said_email_only = False
-    user_declined_number = False
-
-    email_words = ['email', 'e-mail', 'mail', 'correo']
-    phone_words = ['phone', 'call', 'telefon', 'teléfono', 'telefono', 'téléphone', 'telefone']
-
-    for i, msg in enumerate(conversation_history):
-        if msg['role'] == 'assistant':
-            if is_contact_question(msg['content']):
-                asked_contact_pref = True
-                if i + 1 < len(conversation_history):
-                    next_msg = conversation_history[i + 1]
-                    if next_msg['role'] == 'user':
-                        user_text = next_msg['content'].lower()
-                        has_email_word = any(w in user_text for w in email_words)
-                        has_wa = 'whatsapp' in user_text
-                        has_phone_word = any(w in user_text for w in phone_words)
-                        if has_email_word and not has_wa and not has_phone_word:
-                            user_said_email_only = True
-            if is_number_question(msg['content']):
-                asked_number = True
-                if i + 1 < len(conversation_history):
-                    next_msg = conversation_history[i + 1]
-                    if next_msg['role'] == 'user':
-                        user_text = next_msg['content'].strip()
-                        if re.search(r'\+?\d{9,15}', user_text.replace(' ', '').replace('-', '')):
-                            gave_number = True
-                        decline_words = ['no', 'nope', 'skip', 'pass', 'later', 'not now', "don't", 'prefer not',
-                                          'nein', 'nie', 'non', 'não', 'nao', 'hayır', 'hayir', 'nahi', 'nahin']
-                        if any(w in user_text.lower() for w in decline_words):
-                            user_declined_number = True
-
-    if user_said_email_only: return True
-    if asked_number and (gave_number or user_declined_number): return True
-    user_msg_count = len([m for m in conversation_history if m['role'] == 'user'])
-    if asked_contact_pref and user_msg_count >= 10: return True
-    return False
+OBJECTION_MATCHERS = {
+    'price': compile_keywords(['expensive', 'too much', 'costly', "can't afford", 'cannot afford', 'high price', 'over budget', 'out of my budget']),
+    'timing': compile_keywords(['not ready', 'not sure', 'need time', 'thinking about it', 'maybe later', 'unsure']),
+    'indecision': compile_keywords(['torn', 'confused', 'cant decide', "can't decide"]),
+    'trust': compile_keywords(['scam', 'legit', 'is this real', 'can i trust', 'safe', 'reliable'])
+}
+URGENCY_MATCHER = compile_keywords(['asap', 'urgent', 'soon', 'quickly', 'this week', 'this month', 'within', 'month', 'week'])
 
 
 def detect_objection(user_message):
@@ -1621,14 +2750,8 @@ def detect_objection(user_message):
     if re.search(r'\d', user_message):
         return None
 
-    objections = {
-        'price': ['expensive', 'too much', 'costly', "can't afford", 'cannot afford', 'high price', 'over budget', 'out of my budget'],
-        'timing': ['not ready', 'not sure', 'need time', 'thinking about it', 'maybe later', 'unsure'],
-        'indecision': ['torn', 'confused', 'cant decide', "can't decide"],
-        'trust': ['scam', 'legit', 'is this real', 'can i trust', 'safe', 'reliable']
-    }
-    for objection_type, keywords in objections.items():
-        if any(keyword in user_message_lower for keyword in keywords):
+    for objection_type, matcher in OBJECTION_MATCHERS.items():
+        if matcher.search(user_message_lower):
             return objection_type
     return None
 
@@ -1652,19 +2775,20 @@ def analyze_lead_quality(lead_data, conversation_history):
     if has_budget: score += 1
     if has_phone: score += 1
     full_text = " ".join([msg['content'].lower() for msg in conversation_history if msg['role'] == 'user'])
-    urgency = ['asap', 'urgent', 'soon', 'quickly', 'this week', 'this month', 'within', 'month', 'week']
-    if any(kw in full_text for kw in urgency):
+    if URGENCY_MATCHER.search(full_text):
         score = min(score + 1, 5)
     print(f"📊 Quality: Name={has_name}, Phone={has_phone}, Budget={has_budget} → {score}/5")
     return min(score, 5)
 
 
-def is_lead_qualified(lead_data, conversation_history, has_booking=False):
+def is_lead_qualified(lead_data, conversation_history, has_booking=False, state=None):
+    if state is None:
+        state = build_conversation_state(None, conversation_history)
     has_email = bool(lead_data.get('email'))
     has_name = bool(lead_data.get('name'))
     has_budget = bool(lead_data.get('budget'))
-    message_count = len([msg for msg in conversation_history if msg['role'] == 'user'])
-    contact_done = contact_step_completed(conversation_history)
+    message_count = state['user_msg_count']
+    contact_done = contact_step_completed(conversation_history, state)
     is_qualified = (has_email and has_name and has_budget and message_count >= 7 and contact_done)
     # Alternate path: a booked viewing with name+email is inherently qualified
     if not is_qualified and has_booking and has_email and has_name:
@@ -1693,6 +2817,8 @@ class Agency(db.Model):
     status = db.Column(db.String(50), default="Active")
     webhook_url = db.Column(db.String(500))
     max_viewings_per_slot = db.Column(db.Integer, default=2)
+    catalog_version = db.Column(db.Integer, default=0)   # bumped on every listing write
+    availability_version = db.Column(db.Integer, default=0)   # bumped on every booking/capacity change
     # ── Tier & Paddle billing (Step 4A) ──
     tier = db.Column(db.String(20), default='solo')
     parent_id = db.Column(db.Integer, nullable=True)          # branch → HQ agency id
@@ -1711,10 +2837,20 @@ class Agency(db.Model):
 
 
 class Lead(db.Model):
+    __table_args__ = (
+        db.Index('ix_lead_agency_score', 'agency_id', 'intent_score', 'created_at'),        # /admin, export
+        db.Index('ix_lead_agency_agent', 'agency_id', 'agent_id', 'intent_score', 'created_at'),  # agent dashboard, round-robin
+        db.Index('ix_lead_agency_email', 'agency_id', 'email'),                             # resolve_lead_identity
+        db.Index('ix_lead_agency_email_norm', 'agency_id', 'email_norm'),                   # shared-client lookups
+        db.Index('ix_lead_agency_created', 'agency_id', 'created_at'),                      # /api/leads?sort=newest
+        db.Index('ix_lead_follow_up_1', 'follow_up_1_sent', 'created_at'),
+        db.Index('ix_lead_follow_up_7', 'follow_up_7_sent', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     agency_id = db.Column(db.Integer, nullable=False)
     name = db.Column(db.String(100))
     email = db.Column(db.String(100))
+    email_norm = db.Column(db.String(100))            # normalize_email(email) - set by the validator below
     phone = db.Column(db.String(50))
     whatsapp_number = db.Column(db.String(50))
     contact_preference = db.Column(db.String(20), default='email')
@@ -1722,19 +2858,40 @@ class Lead(db.Model):
     message = db.Column(db.Text)
     intent_score = db.Column(db.Integer, default=1)
     lead_status = db.Column(db.String(20), default='new')
-    notes = db.Column(db.Text, default='[]')
+    notes = db.Column(db.Text, default='[]')          # legacy blob - notes now live in LeadNote
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Asia/Karachi')))
     follow_up_1_sent = db.Column(db.Integer, default=0)
     follow_up_7_sent = db.Column(db.Integer, default=0)
     agent_id = db.Column(db.Integer, nullable=True)   # assigned agent (Tier 2/3)
 
+    @validates('email')
+    def _set_email_norm(self, key, value):
+        self.email_norm = normalize_email(value)
+        return value
+
+class LeadNote(db.Model):
+    """One row per note on a lead - added with a single INSERT."""
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, nullable=False, index=True)
+    agency_id = db.Column(db.Integer, nullable=False, index=True)
+    author = db.Column(db.String(100))
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Asia/Karachi')))
+
 class Appointment(db.Model):
+    __table_args__ = (
+        db.Index('ix_appointment_agency_slot', 'agency_id', 'appointment_date_iso', 'appointment_time', 'status'),
+        db.Index('ix_appointment_agent_slot', 'agent_id', 'appointment_date_iso', 'appointment_time', 'status'),
+        db.Index('ix_appointment_agency_created', 'agency_id', 'created_at'),              # /appointments
+        db.Index('ix_appointment_agency_email_norm', 'agency_id', 'email_norm'),           # related appointments
+    )
     id = db.Column(db.Integer, primary_key=True)
     agency_id = db.Column(db.Integer, nullable=False)
     lead_id = db.Column(db.Integer, nullable=True)
     agent_id = db.Column(db.Integer, nullable=True)   # whose calendar (Tier 2/3)
     customer_name = db.Column(db.String(100))
     customer_email = db.Column(db.String(150))
+    email_norm = db.Column(db.String(150))             # normalize_email(customer_email)
     appointment_date = db.Column(db.String(100))       # Display: "Monday, July 13, 2026"
     appointment_date_iso = db.Column(db.String(20))    # Query: "2026-07-13"
     appointment_time = db.Column(db.String(50))
@@ -1743,8 +2900,16 @@ class Appointment(db.Model):
     notes = db.Column(db.Text, default='')
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Asia/Karachi')))
 
+    @validates('customer_email')
+    def _set_email_norm(self, key, value):
+        self.email_norm = normalize_email(value)
+        return value
+
 
 class Listing(db.Model):
+    __table_args__ = (
+        db.Index('ix_listing_agency_status', 'agency_id', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     agency_id = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String(200), nullable=False)
@@ -1762,15 +2927,101 @@ class Listing(db.Model):
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Asia/Karachi')))
 
 
+class SlotCount(db.Model):
+    """Live (non-cancelled) bookings per slot, for the agency's capacity
+    ('agency') and for each agent's calendar ('agent'). See SLOT RESERVATIONS."""
+    kind = db.Column(db.String(10), primary_key=True)
+    owner_id = db.Column(db.Integer, primary_key=True)
+    date_iso = db.Column(db.String(20), primary_key=True)
+    time_label = db.Column(db.String(50), primary_key=True)
+    booked = db.Column(db.Integer, default=0, nullable=False)
+
+
 class ConversationSession(db.Model):
     session_key = db.Column(db.String(120), primary_key=True)
-    history = db.Column(db.Text, default='[]')
-    booked_slots = db.Column(db.Text, default='[]')
+    history = db.Column(db.Text, default='[]')          # legacy blob - messages now live in ConversationMessage
+    booked_slots = db.Column(db.Text, default='[]')     # legacy blob - see SessionBookedSlot
+    summary = db.Column(db.Text)                        # rolling summary of history[:summary_upto]
+    summary_upto = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)   # reaper range scan
+
+
+class ConversationMessage(db.Model):
+    """One row per chat message, appended - never rewritten."""
+    session_key = db.Column(db.String(120), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)       # 0-based position in the conversation
+    role = db.Column(db.String(20), nullable=False)
+    content = db.Column(db.Text, default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SessionBookedSlot(db.Model):
+    """Slots already auto-booked (or rejected) in a chat session - "iso|time"."""
+    session_key = db.Column(db.String(120), primary_key=True)
+    slot_id = db.Column(db.String(40), primary_key=True)
+
+
+class ConversationState(db.Model):
+    """Incrementally-updated extraction results for a ConversationSession
+    (same session_key) - see update_conversation_state()."""
+    session_key = db.Column(db.String(120), primary_key=True)
+    data = db.Column(db.Text, default='{}')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SchemaVersion(db.Model):
+    """One row per applied migration - see run_migrations()."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MaintenanceLease(db.Model):
+    """Named lease so periodic maintenance runs in one process at a time -
+    see claim_lease()."""
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(120))
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class BackgroundJob(db.Model):
+    """Outbox row for a deferred side effect - see process_pending_jobs()."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, default='{}')
+    idempotency_key = db.Column(db.String(200), unique=True, nullable=False)
+    status = db.Column(db.String(20), default='pending')   # pending / running / done / failed
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=5)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class ChatCompletionLog(db.Model):
+    """One row per chat model call: token usage incl. how much of the
+    prompt was served from the provider's prompt cache, and latency."""
+    id = db.Column(db.Integer, primary_key=True)
+    agency_id = db.Column(db.Integer, nullable=False, index=True)
+    session_key = db.Column(db.String(120))
+    model = db.Column(db.String(50))
+    prompt_tokens = db.Column(db.Integer, default=0)
+    cached_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    latency_ms = db.Column(db.Integer)
+    first_token_ms = db.Column(db.Integer)          # streaming only
+    streamed = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
 class Agent(db.Model):
     """Sub-accounts for Tier 2 (agency) and Tier 3 (corporation branches)."""
+    __table_args__ = (
+        db.Index('ix_agent_agency_status', 'agency_id', 'status'),
+        db.Index('ix_agent_email', 'email'),                                               # agent login
+    )
     id = db.Column(db.Integer, primary_key=True)
     agency_id = db.Column(db.Integer, nullable=False)
     name = db.Column(db.String(100), nullable=False)
@@ -1778,13 +3029,185 @@ class Agent(db.Model):
     password_hash = db.Column(db.String(200))
     status = db.Column(db.String(20), default='active')   # active / disabled
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    lead_count = db.Column(db.Integer, default=0, nullable=False)          # leads assigned
+    appointment_count = db.Column(db.Integer, default=0, nullable=False)   # non-cancelled bookings
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
-    
+
+
+# ─────────────────────────────────────────────────────
+# AGENT WORKLOAD COUNTERS
+# Agent.lead_count / appointment_count follow every Lead and Appointment
+# insert, reassignment, status change and delete from a flush hook, in the
+# same transaction as the change - round-robin and slot assignment read
+# them instead of counting rows per agent. Bulk query.update()/delete()
+# skip the hook; the places that use one call recount_agent_workload().
+# ─────────────────────────────────────────────────────
+
+def _before_after(obj, attr):
+    hist = db.inspect(obj).attrs[attr].history
+    if not hist.has_changes():
+        value = getattr(obj, attr)
+        return value, value
+    return (hist.deleted[0] if hist.deleted else None), (hist.added[0] if hist.added else None)
+
+
+def _workload_owner(obj, when):
+    """(agent_id, column) this row counts against at `when` ('before' or
+    'after' the flush), or None if it counts against nobody."""
+    pick = 0 if when == 'before' else 1
+    agent_id = _before_after(obj, 'agent_id')[pick]
+    if not agent_id:
+        return None
+    if isinstance(obj, Lead):
+        return agent_id, 'lead_count'
+    if _before_after(obj, 'status')[pick] == 'cancelled':
+        return None
+    return agent_id, 'appointment_count'
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def track_agent_workload(session, flush_context, instances):
+    deltas = defaultdict(lambda: defaultdict(int))
+    for obj in session.new:
+        if isinstance(obj, (Lead, Appointment)) and (owner := _workload_owner(obj, 'after')):
+            deltas[owner[0]][owner[1]] += 1
+    for obj in session.deleted:
+        if isinstance(obj, (Lead, Appointment)) and (owner := _workload_owner(obj, 'before')):
+            deltas[owner[0]][owner[1]] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, (Lead, Appointment)) and session.is_modified(obj):
+            before, after = _workload_owner(obj, 'before'), _workload_owner(obj, 'after')
+            if before != after:
+                if before:
+                    deltas[before[0]][before[1]] -= 1
+                if after:
+                    deltas[after[0]][after[1]] += 1
+    agent = Agent.__table__
+    for agent_id, columns in deltas.items():
+        values = {col: agent.c[col] + n for col, n in columns.items() if n}
+        if values:
+            session.connection().execute(agent.update().where(agent.c.id == agent_id).values(**values))
+
+
+def recount_agent_workload(agency_id):
+    """Recomputes every counter for the agency's agents from the rows."""
+    leads = db.select(func.count(Lead.id)).where(Lead.agent_id == Agent.id).scalar_subquery()
+    appts = db.select(func.count(Appointment.id)).where(
+        Appointment.agent_id == Agent.id, Appointment.status != 'cancelled').scalar_subquery()
+    db.session.execute(db.update(Agent).where(Agent.agency_id == agency_id)
+                       .values(lead_count=leads, appointment_count=appts)
+                       .execution_options(synchronize_session=False))
+
+
+# ─────────────────────────────────────────────────────
+# SLOT RESERVATIONS
+# Every booking, reassignment and un-cancel claims its places through
+# reserve_slot(): a conditional UPDATE on the slot's SlotCount row
+# (booked < capacity), so two workers racing for the last place serialize
+# on that row and only one gets it - Postgres row lock, SQLite write lock.
+# Releases (cancel, delete, reassign away) are applied by the flush hook.
+# ─────────────────────────────────────────────────────
+
+def _slot_holdings(appt, when):
+    """SlotCount keys the appointment occupies 'before' or 'after' the flush."""
+    pick = 0 if when == 'before' else 1
+    date_iso = _before_after(appt, 'appointment_date_iso')[pick]
+    time_label = _before_after(appt, 'appointment_time')[pick]
+    if not date_iso or not time_label or _before_after(appt, 'status')[pick] == 'cancelled':
+        return set()
+    keys = {('agency', _before_after(appt, 'agency_id')[pick], date_iso, time_label)}
+    agent_id = _before_after(appt, 'agent_id')[pick]
+    if agent_id:
+        keys.add(('agent', agent_id, date_iso, time_label))
+    return keys
+
+
+def _ensure_slot_rows(conn, keys):
+    if keys:
+        insert = (postgresql if conn.dialect.name == 'postgresql' else sqlite).insert
+        conn.execute(insert(SlotCount.__table__).on_conflict_do_nothing(),
+                     [dict(kind=k, owner_id=o, date_iso=d, time_label=t, booked=0) for k, o, d, t in keys])
+
+
+def _bump_slot(conn, key, delta, below=None):
+    slot = SlotCount.__table__
+    stmt = slot.update().where(slot.c.kind == key[0], slot.c.owner_id == key[1],
+                               slot.c.date_iso == key[2], slot.c.time_label == key[3]) \
+        .values(booked=slot.c.booked + delta)
+    if below is not None:
+        stmt = stmt.where(slot.c.booked < below)
+    return conn.execute(stmt).rowcount == 1
+
+
+SLOT_TAKEN_ERRORS = {
+    'full': "That slot has been fully booked since - pick another time.",
+    'agent_busy': "The assigned agent already has a booking at that time.",
+}
+
+
+def reserve_slot(appt, agency):
+    """Claims the places `appt` is about to take - one of the agency's
+    capacity and, with an agent, that agent's calendar at the slot - in
+    the current transaction. Returns None on success, else 'full' or
+    'agent_busy' with nothing claimed."""
+    with db.session.no_autoflush:
+        keys = _slot_holdings(appt, 'after') - _slot_holdings(appt, 'before')
+        if not keys:
+            return None
+        capacity = get_slot_capacity(agency)
+        conn = db.session.connection()
+        _ensure_slot_rows(conn, keys)
+        claimed = []
+        for key in sorted(keys):   # fixed lock order across bookings
+            if not _bump_slot(conn, key, 1, below=capacity if key[0] == 'agency' else 1):
+                for done in claimed:
+                    _bump_slot(conn, done, -1)
+                return 'full' if key[0] == 'agency' else 'agent_busy'
+            claimed.append(key)
+    appt._slot_reserved = keys
+    return None
+
+
+def reserve_slot_with_agent(appt, agency, preferred_agent_id=None):
+    """reserve_slot() for a booking whose agent pick_agent_for_slot()
+    chooses; picks again if a parallel booking takes that agent first.
+    Returns (reason, agent)."""
+    for _ in range(3):
+        agent = pick_agent_for_slot(agency, appt.appointment_date_iso, appt.appointment_time, preferred_agent_id)
+        appt.agent_id = agent.id if agent else None
+        reason = reserve_slot(appt, agency)
+        if reason != 'agent_busy':
+            return reason, agent
+    appt.agent_id = None
+    return reserve_slot(appt, agency), None
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def track_slot_counts(session, flush_context, instances):
+    deltas = defaultdict(int)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Appointment):
+            continue
+        reserved = vars(obj).pop('_slot_reserved', set())
+        before = set() if obj in session.new else _slot_holdings(obj, 'before')
+        after = set() if obj in session.deleted else _slot_holdings(obj, 'after')
+        for key in before - after:
+            deltas[key] -= 1
+        for key in after - before - reserved:
+            deltas[key] += 1   # not through reserve_slot - counted, not capped
+    if any(deltas.values()):
+        conn = session.connection()
+        _ensure_slot_rows(conn, [key for key, n in deltas.items() if n > 0])
+        for key in sorted(deltas):
+            if deltas[key]:
+                _bump_slot(conn, key, deltas[key])
+
+
 # -------------------------
 # ROUTES
 # -------------------------
@@ -1817,19 +3240,217 @@ def owner_login():
     else:
         return redirect("/owner-login?error=Invalid+password")
 
+# ─────────────────────────────────────────────────────
+# DASHBOARD LISTS (keyset pagination)
+# /admin, /appointments and /listings render the first page; the rest is
+# fetched from the /api/... endpoints below as the user scrolls. Pages are
+# keyset-paginated - the cursor carries the last row's sort key - so every
+# page is an indexed range read, however deep the user scrolls.
+# ─────────────────────────────────────────────────────
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# sort name -> (key expressions ending in the unique id, descending?)
+LEAD_SORTS = {
+    'score':  ((Lead.intent_score, Lead.created_at, Lead.id), True),
+    'newest': ((Lead.created_at, Lead.id), True),
+}
+APPOINTMENT_SORTS = {
+    'newest': ((Appointment.created_at, Appointment.id), True),
+    'date':   ((func.coalesce(Appointment.appointment_date_iso, ''), Appointment.id), False),
+}
+LISTING_SORTS = {
+    'status':     ((Listing.status, func.coalesce(Listing.price_numeric, -1), Listing.id), False),
+    'price':      ((func.coalesce(Listing.price_numeric, -1), Listing.id), False),
+    'price_desc': ((func.coalesce(Listing.price_numeric, -1), Listing.id), True),
+    'newest':     ((Listing.id,), True),
+}
+
+
+def encode_cursor(values):
+    values = [{'$dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return [datetime.fromisoformat(v['$dt']) if isinstance(v, dict) else v for v in values]
+
+
+def keyset_page(query, sort, cursor=None, limit=PAGE_SIZE):
+    """One page of `query` in `sort` order. Returns (rows, next_cursor) -
+    next_cursor is None on the last page."""
+    keys, descending = sort
+    if cursor:
+        after = decode_cursor(cursor)
+        query = query.filter(tuple_(*keys) < tuple_(*after) if descending else tuple_(*keys) > tuple_(*after))
+    results = query.add_columns(*keys).order_by(
+        *[k.desc() if descending else k.asc() for k in keys]
+    ).limit(limit + 1).all()
+    next_cursor = encode_cursor(results[limit - 1][1:]) if len(results) > limit else None
+    return [r[0] for r in results[:limit]], next_cursor
+
+
+def page_args(args, sorts, default_sort):
+    """(sort, cursor, limit) from the query string."""
+    sort = sorts.get(args.get('sort'), sorts[default_sort])
+    limit = min(max(args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return sort, args.get('cursor') or None, limit
+
+
+def _agent_filter(column, value):
+    return column.is_(None) if value == 'none' else column == int(value)
+
+
+def filtered_leads(agency_id, args):
+    query = Lead.query.filter(Lead.agency_id == agency_id)
+    status = args.get('status', 'all')
+    if status == 'new':
+        query = query.filter(or_(Lead.lead_status == 'new', Lead.lead_status.is_(None)))
+    elif status != 'all':
+        query = query.filter(Lead.lead_status == status)
+    if args.get('quality', 'all') != 'all':
+        query = query.filter(Lead.intent_score == int(args['quality']))
+    if args.get('agent', 'all') != 'all':
+        query = query.filter(_agent_filter(Lead.agent_id, args['agent']))
+    if args.get('q'):
+        like = f"%{args['q'].strip()}%"
+        query = query.filter(or_(Lead.name.ilike(like), Lead.email.ilike(like), Lead.budget.ilike(like)))
+    return query
+
+
+def filtered_appointments(agency_id, args):
+    query = Appointment.query.filter(Appointment.agency_id == agency_id)
+    if args.get('status', 'all') != 'all':
+        query = query.filter(Appointment.status == args['status'])
+    if args.get('agent', 'all') != 'all':
+        query = query.filter(_agent_filter(Appointment.agent_id, args['agent']))
+    if args.get('q'):
+        like = f"%{args['q'].strip()}%"
+        query = query.filter(or_(Appointment.customer_name.ilike(like), Appointment.customer_email.ilike(like)))
+    return query
+
+
+def filtered_listings(agency_id, args):
+    query = Listing.query.filter(Listing.agency_id == agency_id)
+    if args.get('status', 'all') != 'all':
+        query = query.filter(Listing.status == args['status'])
+    if args.get('q'):
+        like = f"%{args['q'].strip()}%"
+        query = query.filter(or_(Listing.title.ilike(like), Listing.location.ilike(like),
+                                 Listing.property_type.ilike(like), Listing.features.ilike(like)))
+    return query
+
+
+def status_counts(model, status_column, agency_id):
+    """{status: count} for the agency's stat cards - one grouped query."""
+    return dict(db.session.query(status_column, func.count(model.id))
+                .filter(model.agency_id == agency_id).group_by(status_column).all())
+
+
+def lead_stats(agency_id):
+    total, hot, high, closed = db.session.query(
+        func.count(Lead.id),
+        func.count(Lead.id).filter(Lead.intent_score == 5),
+        func.count(Lead.id).filter(Lead.intent_score >= 4),
+        func.count(Lead.id).filter(Lead.lead_status == 'closed'),
+    ).filter(Lead.agency_id == agency_id).one()
+    return {'total': total, 'hot': hot, 'high': high, 'closed': closed}
+
+
+def lead_to_dict(lead):
+    return {"id": lead.id, "name": lead.name, "email": lead.email, "phone": lead.phone,
+            "whatsapp_number": lead.whatsapp_number, "budget": lead.budget,
+            "intent_score": lead.intent_score or 1, "lead_status": lead.lead_status or "new",
+            "agent_id": lead.agent_id, "created_at": lead.created_at.isoformat() if lead.created_at else None}
+
+
+def appointment_to_dict(appt):
+    return {"id": appt.id, "customer_name": appt.customer_name, "customer_email": appt.customer_email,
+            "appointment_date": appt.appointment_date, "appointment_date_iso": appt.appointment_date_iso,
+            "appointment_time": appt.appointment_time, "property_interest": appt.property_interest,
+            "status": appt.status, "agent_id": appt.agent_id, "notes": appt.notes or "",
+            "created_at": appt.created_at.isoformat() if appt.created_at else None}
+
+
+def listing_to_dict(l):
+    return {"id": l.id, "title": l.title, "location": l.location, "price_raw": l.price_raw,
+            "price": l.price_numeric, "bedrooms": l.bedrooms, "bathrooms": l.bathrooms,
+            "property_type": l.property_type, "status": l.status}
+
+
+def page_response(items, next_cursor, to_dict, partial, **context):
+    """JSON page; with ?html=1 also the rendered rows, from the same partial
+    the page itself uses for its first page."""
+    payload = {"items": [to_dict(i) for i in items], "next_cursor": next_cursor}
+    if request.args.get('html'):
+        payload["html"] = render_template(partial, **context)
+    return jsonify(payload)
+
+
+@app.route("/api/leads/<int:agency_id>")
+@replica_read
+def api_leads(agency_id):
+    agency = db.session.get(Agency, agency_id)
+    if not agency:
+        return jsonify({"error": "Agency not found"}), 404
+    try:
+        sort, cursor, limit = page_args(request.args, LEAD_SORTS, 'score')
+        leads, next_cursor = keyset_page(filtered_leads(agency_id, request.args), sort, cursor, limit)
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid filter or cursor"}), 400
+    return page_response(leads, next_cursor, lead_to_dict, "partials/lead_rows.html",
+                         leads=leads, agency=agency, now=datetime.utcnow(),
+                         offset=request.args.get('offset', 0, type=int))
+
+
+@app.route("/api/appointments/<int:agency_id>")
+@replica_read
+def api_appointments(agency_id):
+    agency = db.session.get(Agency, agency_id)
+    if not agency:
+        return jsonify({"error": "Agency not found"}), 404
+    try:
+        sort, cursor, limit = page_args(request.args, APPOINTMENT_SORTS, 'newest')
+        appts, next_cursor = keyset_page(filtered_appointments(agency_id, request.args), sort, cursor, limit)
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid filter or cursor"}), 400
+    agents = Agent.query.filter_by(agency_id=agency_id).order_by(Agent.name.asc()).all() \
+        if request.args.get('html') else []
+    return page_response(appts, next_cursor, appointment_to_dict, "partials/appointment_cards.html",
+                         appointments=appts, agency=agency, agents=agents)
+
+
+@app.route("/api/listings/<int:agency_id>")
+@replica_read
+def api_listings(agency_id):
+    agency = db.session.get(Agency, agency_id)
+    if not agency:
+        return jsonify({"error": "Agency not found"}), 404
+    try:
+        sort, cursor, limit = page_args(request.args, LISTING_SORTS, 'status')
+        rows, next_cursor = keyset_page(filtered_listings(agency_id, request.args), sort, cursor, limit)
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid filter or cursor"}), 400
+    return page_response(rows, next_cursor, listing_to_dict, "partials/listing_cards.html",
+                         listings=rows, agency=agency)
+
+
 @app.route("/admin")
+@replica_read
 def admin():
     agency_id = request.args.get("agency_id")
     if not agency_id:
         return redirect("/owner-login?error=Please+login+first")
     try:
-        leads = Lead.query.filter_by(
-            agency_id=int(agency_id)
-        ).order_by(Lead.intent_score.desc(), Lead.created_at.desc()).all()
         agency = db.session.get(Agency, int(agency_id))
         if not agency:
             return redirect("/owner-login?error=Agency+not+found")
-        return render_template("admin.html", leads=leads, agency=agency, now=datetime.utcnow())
+        leads, next_cursor = keyset_page(filtered_leads(agency.id, {}), LEAD_SORTS['score'])
+        agents = Agent.query.filter_by(agency_id=agency.id).order_by(Agent.name.asc()).all()
+        return render_template("admin.html", leads=leads, next_cursor=next_cursor, stats=lead_stats(agency.id),
+                               agents=agents, agency=agency, now=datetime.utcnow(), offset=0)
     except Exception as e:
         print(f"❌ ADMIN ERROR: {e}")
         return redirect("/owner-login?error=Something+went+wrong")
@@ -1912,14 +3533,32 @@ def delete_agency(agency_id):
     if not agency:
         return jsonify({"error": "Agency not found"}), 404
     Lead.query.filter_by(agency_id=agency_id).delete()
+    LeadNote.query.filter_by(agency_id=agency_id).delete()
     Appointment.query.filter_by(agency_id=agency_id).delete()
+    SlotCount.query.filter_by(kind='agency', owner_id=agency_id).delete()
     Listing.query.filter_by(agency_id=agency_id).delete()
+    SlotCount.query.filter(
+        SlotCount.kind == 'agent',
+        SlotCount.owner_id.in_(db.session.query(Agent.id).filter_by(agency_id=agency_id))
+    ).delete(synchronize_session=False)
     Agent.query.filter_by(agency_id=agency_id).delete()
+    ChatCompletionLog.query.filter_by(agency_id=agency_id).delete()
     ConversationSession.query.filter(
         ConversationSession.session_key.like(f"{agency_id}_%")
     ).delete(synchronize_session=False)
+    ConversationState.query.filter(
+        ConversationState.session_key.like(f"{agency_id}_%")
+    ).delete(synchronize_session=False)
+    ConversationMessage.query.filter(
+        ConversationMessage.session_key.like(f"{agency_id}_%")
+    ).delete(synchronize_session=False)
+    SessionBookedSlot.query.filter(
+        SessionBookedSlot.session_key.like(f"{agency_id}_%")
+    ).delete(synchronize_session=False)
     db.session.delete(agency)
     db.session.commit()
+    _listing_catalogs.pop(agency_id, None)
+    session_store.drop_prefix(f"{agency_id}_")
     return jsonify({"message": "Agency deleted"})
 
 @app.route("/agency/<int:agency_id>")
@@ -1961,20 +3600,10 @@ def add_lead_note(lead_id):
         note_text = data.get("note", "").strip()
         if not note_text:
             return jsonify({"error": "Note cannot be empty"}), 400
-        try:
-            notes = json.loads(lead.notes or '[]')
-        except:
-            notes = []
-        new_note = {
-            "id": len(notes) + 1,
-            "text": note_text,
-            "author": "Owner",
-            "timestamp": datetime.now(pytz.timezone('Asia/Karachi')).strftime('%B %d, %Y at %I:%M %p')
-        }
-        notes.append(new_note)
-        lead.notes = json.dumps(notes)
+        note = add_lead_note_row(lead, note_text, "Owner")
         db.session.commit()
-        return jsonify({"success": True, "note": new_note, "total_notes": len(notes)})
+        total = LeadNote.query.filter_by(lead_id=lead.id).count()
+        return jsonify({"success": True, "note": note_to_dict(note), "total_notes": total})
     except Exception as e:
         return jsonify({"error": "Failed to add note"}), 500
 
@@ -1985,14 +3614,10 @@ def delete_lead_note(lead_id, note_id):
         lead = db.session.get(Lead, lead_id)
         if not lead:
             return jsonify({"error": "Lead not found"}), 404
-        try:
-            notes = json.loads(lead.notes or '[]')
-        except:
-            notes = []
-        notes = [n for n in notes if n.get('id') != note_id]
-        lead.notes = json.dumps(notes)
+        LeadNote.query.filter_by(id=note_id, lead_id=lead.id).delete()
         db.session.commit()
-        return jsonify({"success": True, "total_notes": len(notes)})
+        total = LeadNote.query.filter_by(lead_id=lead.id).count()
+        return jsonify({"success": True, "total_notes": total})
     except Exception as e:
         return jsonify({"error": "Failed to delete note"}), 500
 
@@ -2003,10 +3628,7 @@ def get_lead_detail(lead_id):
         lead = db.session.get(Lead, lead_id)
         if not lead:
             return jsonify({"error": "Lead not found"}), 404
-        try:
-            notes = json.loads(lead.notes or '[]')
-        except:
-            notes = []
+        notes = load_lead_notes([lead.id])[lead.id]
         clean_num = clean_whatsapp_number(lead.whatsapp_number)
         wa_link = f"https://wa.me/{clean_num}" if clean_num else None
 
@@ -2059,6 +3681,7 @@ def bulk_delete_leads():
             if lead:
                 db.session.delete(lead)
                 deleted += 1
+        LeadNote.query.filter(LeadNote.lead_id.in_([int(i) for i in lead_ids])).delete(synchronize_session=False)
         db.session.commit()
         return jsonify({"success": True, "deleted": deleted})
     except Exception as e:
@@ -2070,16 +3693,16 @@ def bulk_delete_leads():
 # ─────────────────────────────────────────────────────
 
 @app.route("/appointments/<int:agency_id>")
+@replica_read
 def appointments(agency_id):
     agency = db.session.get(Agency, agency_id)
     if not agency:
         return redirect("/owner-login?error=Agency+not+found")
-    appts = Appointment.query.filter_by(
-        agency_id=agency_id
-    ).order_by(Appointment.created_at.desc()).all()
+    appts, next_cursor = keyset_page(filtered_appointments(agency_id, {}), APPOINTMENT_SORTS['newest'])
     agents = Agent.query.filter_by(agency_id=agency_id).order_by(Agent.name.asc()).all()
     agent_names = {a.id: a.name for a in agents}
-    return render_template("appointments.html", agency=agency, appointments=appts,
+    return render_template("appointments.html", agency=agency, appointments=appts, next_cursor=next_cursor,
+                           stats=status_counts(Appointment, Appointment.status, agency_id),
                            agents=agents, agent_names=agent_names)
 
 @app.route("/reassign-appointment/<int:appt_id>", methods=["POST"])
@@ -2097,10 +3720,11 @@ def reassign_appointment(appt_id):
         agent = db.session.get(Agent, int(new_agent_id))
         if not agent or agent.agency_id != appt.agency_id:
             return jsonify({"error": "Invalid agent"}), 400
-        if appt.appointment_date_iso and appt.appointment_time:
-            if agent_busy_at(agent.id, appt.appointment_date_iso, appt.appointment_time) and appt.agent_id != agent.id:
-                return jsonify({"error": f"{agent.name} already has a booking at that time"}), 409
+        agency = db.session.get(Agency, appt.agency_id)
         appt.agent_id = agent.id
+        if reserve_slot(appt, agency):
+            db.session.rollback()
+            return jsonify({"error": f"{agent.name} already has a booking at that time"}), 409
         db.session.commit()
         print(f"✅ Appointment {appt_id} reassigned → agent {agent.name}")
         return jsonify({"success": True, "agent_id": agent.id})
@@ -2152,29 +3776,22 @@ def book_appointment():
 
         max_slot = get_slot_capacity(agency)
         if date_iso and time_label:
-            booked = slot_booked_count(int(agency_id), date_iso, time_label)
+            booked = slot_occupancy(int(agency_id), date_iso, date_iso)[(date_iso, time_label)]
             if booked >= max_slot:
                 return jsonify({"error": f"This slot is full ({booked}/{max_slot} booked). Please choose another time."}), 409
 
         # Agent assignment (Tier 2/3)
-        agent_id = None
-        if (agency.tier or 'solo') != 'solo':
-            requested_agent = data.get("agent_id")
-            if requested_agent:
-                agent = db.session.get(Agent, int(requested_agent))
-                if not agent or agent.agency_id != int(agency_id):
-                    return jsonify({"error": "Invalid agent"}), 400
-                if date_iso and time_label and agent_busy_at(agent.id, date_iso, time_label):
-                    return jsonify({"error": f"{agent.name} already has a booking at that time. Pick another agent or slot."}), 409
-                agent_id = agent.id
-            else:
-                chosen = pick_agent_for_slot(agency, date_iso, time_label)
-                agent_id = chosen.id if chosen else None
+        agent = None
+        requested_agent = data.get("agent_id")
+        if (agency.tier or 'solo') != 'solo' and requested_agent:
+            agent = db.session.get(Agent, int(requested_agent))
+            if not agent or agent.agency_id != int(agency_id):
+                return jsonify({"error": "Invalid agent"}), 400
 
         appt = Appointment(
             agency_id=int(agency_id),
             lead_id=data.get("lead_id"),
-            agent_id=agent_id,
+            agent_id=agent.id if agent else None,
             customer_name=data.get("customer_name", ""),
             customer_email=data.get("customer_email", ""),
             appointment_date=display_date,
@@ -2184,9 +3801,18 @@ def book_appointment():
             status="pending",
             notes=data.get("notes", "")
         )
+        if agent or (agency.tier or 'solo') == 'solo':
+            reason = reserve_slot(appt, agency)
+        else:
+            reason, agent = reserve_slot_with_agent(appt, agency)
+        if reason:
+            db.session.rollback()
+            if reason == 'agent_busy':
+                return jsonify({"error": f"{agent.name} already has a booking at that time. Pick another agent or slot."}), 409
+            return jsonify({"error": f"This slot is full ({max_slot}/{max_slot} booked). Please choose another time."}), 409
         db.session.add(appt)
         db.session.commit()
-        print(f"✅ Appointment booked: ID {appt.id} for {appt.customer_name} on {display_date} (agent: {agent_id})")
+        print(f"✅ Appointment booked: ID {appt.id} for {appt.customer_name} on {display_date} (agent: {appt.agent_id})")
         send_appointment_confirmation(agency, appt)
         return jsonify({
             "success": True, "appointment_id": appt.id,
@@ -2208,7 +3834,11 @@ def update_appointment_status(appt_id):
         new_status = data.get("status", "pending")
         if new_status not in ['pending', 'confirmed', 'cancelled', 'completed']:
             return jsonify({"error": "Invalid status"}), 400
+        agency = db.session.get(Agency, appt.agency_id)
         appt.status = new_status
+        if reason := reserve_slot(appt, agency):   # un-cancelling takes the slot back
+            db.session.rollback()
+            return jsonify({"error": SLOT_TAKEN_ERRORS[reason]}), 409
         db.session.commit()
         return jsonify({"success": True, "status": new_status})
     except Exception as e:
@@ -2243,6 +3873,7 @@ def get_appointments_count(agency_id):
 # ─────────────────────────────────────────────────────
 
 @app.route("/agents/<int:agency_id>")
+@replica_read
 def agents_page(agency_id):
     agency = db.session.get(Agency, agency_id)
     if not agency:
@@ -2250,7 +3881,7 @@ def agents_page(agency_id):
     if (agency.tier or 'solo') == 'solo':
         return redirect(f"/admin?agency_id={agency_id}")
     agents = Agent.query.filter_by(agency_id=agency_id).order_by(Agent.created_at.asc()).all()
-    lead_counts = {a.id: Lead.query.filter_by(agency_id=agency_id, agent_id=a.id).count() for a in agents}
+    lead_counts = {a.id: a.lead_count for a in agents}
     limits = get_tier_limits(agency)
     return render_template("agents.html", agency=agency, agents=agents,
                            lead_counts=lead_counts, limits=limits)
@@ -2307,6 +3938,9 @@ def delete_agent(agent_id):
         # Unassign their leads (leads stay with the agency)
         Lead.query.filter_by(agent_id=agent_id).update({"agent_id": None})
         Appointment.query.filter_by(agent_id=agent_id).update({"agent_id": None})
+        # The bulk update skips track_slot_counts - drop the calendar by hand
+        # so an agent that later reuses this id starts free.
+        SlotCount.query.filter_by(kind='agent', owner_id=agent_id).delete()
         db.session.delete(agent)
         db.session.commit()
         return jsonify({"success": True})
@@ -2328,57 +3962,56 @@ def agent_login():
     return redirect("/agent-login?error=Invalid+credentials")
 
 
-@app.route("/agent-dashboard/<int:agent_id>")
-def agent_dashboard(agent_id):
-    agent = db.session.get(Agent, agent_id)
-    if not agent:
-        return redirect("/agent-login?error=Agent+not+found")
-    agency = db.session.get(Agency, agent.agency_id)
-    my_leads = Lead.query.filter_by(agency_id=agent.agency_id, agent_id=agent_id)\
+def load_agent_dashboard(agent):
+    """Everything agent_dashboard.html needs, in a fixed number of queries
+    however many leads and appointments the agent has."""
+    my_leads = Lead.query.filter_by(agency_id=agent.agency_id, agent_id=agent.id)\
         .order_by(Lead.intent_score.desc(), Lead.created_at.desc()).all()
-    my_appts = Appointment.query.filter_by(agency_id=agent.agency_id, agent_id=agent_id)\
+    my_appts = Appointment.query.filter_by(agency_id=agent.agency_id, agent_id=agent.id)\
         .order_by(Appointment.created_at.desc()).all()
-    all_agents = Agent.query.filter_by(agency_id=agent.agency_id).all()
-    agent_names = {a.id: a.name for a in all_agents}
+    agent_names = {a.id: a.name for a in Agent.query.filter_by(agency_id=agent.agency_id)}
+
     # Cross-agent visibility: for each of my leads, show ALL appointments tied
     # to that customer's email agency-wide, so I see what other agents did too.
-    related_by_lead = {lead.id: get_related_appointments(agent.agency_id, lead.email) for lead in my_leads}
-
-    # Parse each lead's notes server-side so the template can render them
-    # directly (with author attribution) without a separate AJAX call.
-    leads_notes = {}
-    for lead in my_leads:
-        try:
-            leads_notes[lead.id] = json.loads(lead.notes or '[]')
-        except Exception:
-            leads_notes[lead.id] = []
+    related = load_related_appointments(agent.agency_id, (lead.email for lead in my_leads))
+    related_by_lead = {lead.id: related.get(lead.email_norm, []) for lead in my_leads}
 
     # "I'm handling a viewing for someone else's lead" awareness: for each
     # of MY appointments, check if the customer is also a lead owned by a
     # DIFFERENT agent, so that context - AND the owner's/lead-owner's notes -
     # surfaces right on my appointment card, even though that lead never
     # appears on my own dashboard.
-    all_agency_leads = Lead.query.filter_by(agency_id=agent.agency_id).all()
-    leads_by_email = {l.email.strip().lower(): l for l in all_agency_leads if l.email}
+    appt_emails = {appt.email_norm for appt in my_appts if appt.email_norm}
+    leads_by_email = {l.email_norm: l for l in Lead.query.filter(
+        Lead.agency_id == agent.agency_id, Lead.email_norm.in_(appt_emails)
+    ).order_by(Lead.id.asc())} if appt_emails else {}
     appt_lead_owner = {}
-    appt_owner_lead_notes = {}
+    appt_owning_lead = {}
     for appt in my_appts:
-        if appt.customer_email:
-            owning_lead = leads_by_email.get(appt.customer_email.strip().lower())
-            if owning_lead and owning_lead.agent_id and owning_lead.agent_id != agent.id:
-                owner_agent = db.session.get(Agent, owning_lead.agent_id)
-                if owner_agent:
-                    appt_lead_owner[appt.id] = owner_agent.name
-                try:
-                    appt_owner_lead_notes[appt.id] = json.loads(owning_lead.notes or '[]')
-                except Exception:
-                    appt_owner_lead_notes[appt.id] = []
+        owning_lead = leads_by_email.get(appt.email_norm)
+        if owning_lead and owning_lead.agent_id and owning_lead.agent_id != agent.id:
+            if owning_lead.agent_id in agent_names:
+                appt_lead_owner[appt.id] = agent_names[owning_lead.agent_id]
+            appt_owning_lead[appt.id] = owning_lead.id
+
+    # Notes for my leads and for those owning leads, parsed server-side so
+    # the template renders them directly (with author attribution).
+    notes = load_lead_notes({lead.id for lead in my_leads} | set(appt_owning_lead.values()))
+    return dict(leads=my_leads, appointments=my_appts, agent_names=agent_names,
+                related_by_lead=related_by_lead,
+                leads_notes={lead.id: notes[lead.id] for lead in my_leads},
+                appt_lead_owner=appt_lead_owner,
+                appt_owner_lead_notes={appt_id: notes[lead_id] for appt_id, lead_id in appt_owning_lead.items()})
 
-    return render_template("agent_dashboard.html", agent=agent, agency=agency,
-                           leads=my_leads, appointments=my_appts,
-                           agent_names=agent_names, related_by_lead=related_by_lead,
-                           leads_notes=leads_notes, appt_lead_owner=appt_lead_owner,
-                           appt_owner_lead_notes=appt_owner_lead_notes)
+
+@app.route("/agent-dashboard/<int:agent_id>")
+@replica_read
+def agent_dashboard(agent_id):
+    agent = db.session.get(Agent, agent_id)
+    if not agent:
+        return redirect("/agent-login?error=Agent+not+found")
+    agency = db.session.get(Agency, agent.agency_id)
+    return render_template("agent_dashboard.html", agent=agent, agency=agency, **load_agent_dashboard(agent))
 
 
 # ─────────────────────────────────────────────────────
@@ -2415,17 +4048,7 @@ def agent_add_lead_note(lead_id):
         if not note_text:
             return jsonify({"error": "Note cannot be empty"}), 400
         acting_agent = db.session.get(Agent, int(agent_id))
-        try:
-            notes = json.loads(lead.notes or '[]')
-        except:
-            notes = []
-        notes.append({
-            "id": len(notes) + 1,
-            "text": note_text,
-            "author": acting_agent.name if acting_agent else "Agent",
-            "timestamp": datetime.now(pytz.timezone('Asia/Karachi')).strftime('%B %d, %Y at %I:%M %p')
-        })
-        lead.notes = json.dumps(notes)
+        add_lead_note_row(lead, note_text, acting_agent.name if acting_agent else "Agent")
         db.session.commit()
         return jsonify({"success": True})
     except Exception:
@@ -2443,7 +4066,11 @@ def agent_update_appointment_status(appt_id):
         new_status = data.get("status", "pending")
         if new_status not in ['pending', 'confirmed', 'cancelled', 'completed']:
             return jsonify({"error": "Invalid status"}), 400
+        agency = db.session.get(Agency, appt.agency_id)
         appt.status = new_status
+        if reason := reserve_slot(appt, agency):
+            db.session.rollback()
+            return jsonify({"error": SLOT_TAKEN_ERRORS[reason]}), 409
         db.session.commit()
         acting_agent = db.session.get(Agent, int(agent_id))
         notify_other_agents_of_update(appt, acting_agent, f"changed an appointment status to '{new_status}'")
@@ -2501,14 +4128,14 @@ def infer_listing_purpose(title, description, explicit=None):
 
 
 @app.route("/listings/<int:agency_id>")
+@replica_read
 def listings(agency_id):
     agency = db.session.get(Agency, agency_id)
     if not agency:
         return redirect("/owner-login?error=Agency+not+found")
-    all_listings = Listing.query.filter_by(
-        agency_id=agency_id
-    ).order_by(Listing.status.asc(), Listing.price_numeric.asc()).all()
-    return render_template("listings.html", agency=agency, listings=all_listings)
+    first_page, next_cursor = keyset_page(filtered_listings(agency_id, {}), LISTING_SORTS['status'])
+    return render_template("listings.html", agency=agency, listings=first_page, next_cursor=next_cursor,
+                           stats=status_counts(Listing, Listing.status, agency_id))
 
 
 @app.route("/add-listing/<int:agency_id>", methods=["POST"])
@@ -2535,6 +4162,7 @@ def add_listing(agency_id):
             status="available"
         )
         db.session.add(listing)
+        invalidate_listing_catalog(agency_id)
         db.session.commit()
         print(f"✅ Listing added: {listing.title} (ID {listing.id})")
         return jsonify({"success": True, "listing_id": listing.id, "title": listing.title})
@@ -2600,6 +4228,7 @@ def upload_listings(agency_id):
             except Exception as row_err:
                 errors.append(f"Row {i}: {str(row_err)}")
                 continue
+        invalidate_listing_catalog(agency_id)
         db.session.commit()
         print(f"✅ CSV upload: {added} listings added for agency {agency_id}")
         return jsonify({
@@ -2624,6 +4253,7 @@ def toggle_listing_status(listing_id):
         if new_status not in ['available', 'sold', 'pending']:
             return jsonify({"error": "Invalid status"}), 400
         listing.status = new_status
+        invalidate_listing_catalog(listing.agency_id)
         db.session.commit()
         return jsonify({"success": True, "status": new_status})
     except Exception as e:
@@ -2637,6 +4267,7 @@ def delete_listing(listing_id):
         if not listing:
             return jsonify({"error": "Listing not found"}), 404
         db.session.delete(listing)
+        invalidate_listing_catalog(listing.agency_id)
         db.session.commit()
         return jsonify({"success": True})
     except Exception as e:
@@ -2647,6 +4278,7 @@ def delete_listing(listing_id):
 def delete_all_listings(agency_id):
     try:
         count = Listing.query.filter_by(agency_id=agency_id).delete()
+        invalidate_listing_catalog(agency_id)
         db.session.commit()
         return jsonify({"success": True, "deleted": count})
     except Exception as e:
@@ -2674,38 +4306,13 @@ def get_listings_api(agency_id):
 
 # ─────────────────────────────────────────────────────
 
-@app.route("/chat", methods=["POST", "OPTIONS"])
-def chat():
-    if request.method == "OPTIONS":
-        return "", 200
-    clean_expired_sessions()
-    try:
-        data = request.get_json(force=True)
-        user_message = data.get("message", "").strip()
-        agency_id = int(data.get("agency_id"))
-        widget_session_id = data.get("session_id")
-        if widget_session_id:
-            session_key = f"{agency_id}_{widget_session_id}"
-        else:
-            visitor_ip = request.remote_addr or "unknown"
-            user_agent = request.headers.get('User-Agent', '')
-            session_hash = hashlib.md5(f"{visitor_ip}{user_agent}".encode()).hexdigest()[:12]
-            session_key = f"{agency_id}_{session_hash}"
-        if not user_message:
-            return jsonify({"error": "Message required"}), 400
-        agency = db.session.get(Agency, agency_id)
-        if not agency:
-            return jsonify({"error": "Invalid agency ID"}), 400
-
-        history, booked_slots = load_session(session_key)
-        history.append({"role": "user", "content": user_message})
-
-        max_slot = get_slot_capacity(agency)
-        listings_context = get_listings_context(agency_id, history)
-        availability_context = get_availability_context(agency_id, max_slot)
-
-        system_prompt = f"""You are {agency.assistant_name}, a real estate consultant at {agency.name}.
-{listings_context}
+def build_static_prompt(agency):
+    """The per-agency instruction block. It depends only on the agency's
+    name and assistant name, so it is byte-identical on every turn and
+    the provider can serve it from its prompt cache. Anything that
+    changes per turn (listings, availability, objection hints) goes
+    AFTER it - see prepare_chat_turn()."""
+    return f"""You are {agency.assistant_name}, a real estate consultant at {agency.name}.
 
 GOLDEN RULE - ONE QUESTION PER MESSAGE:
 - Never ask two questions in one response. Ever.
@@ -2730,7 +4337,7 @@ PACE - LET THE CLIENT LEAD:
 - Never interrogate. One relaxed question at a time.
 
 PROPERTY RECOMMENDATIONS:
-- The list below has ALREADY been filtered and ranked by the customer's stated budget, property type, bedroom/bathroom count, and buy/rent preference. Only recommend properties from THIS list - never invent or approximate one that isn't shown.
+- The listings below have ALREADY been filtered and ranked by the customer's stated budget, property type, bedroom/bathroom count, and buy/rent preference. Only recommend properties from THIS list - never invent or approximate one that isn't shown.
 - If the customer hasn't given a location yet, that's fine - go ahead and offer from the list, since it already reflects their budget and type across all locations.
 - Mention matches by name with price and key features in 1-2 sentences, then ask ONE question: "Would you like to know more?"
 - If the list is empty: "We don't have anything matching that combination right now, but I can keep an eye out and get back to you with options." Even with no match, STILL continue the normal information flow afterward - ask for budget if you don't have it yet, then email, then contact preference - so we can follow up once something becomes available. Do not end the conversation early just because nothing matched right now.
@@ -2738,9 +4345,8 @@ PROPERTY RECOMMENDATIONS:
 
 VIEWING FLOW - ONE PROPERTY AT A TIME, ONE STEP AT A TIME:
 - If client selects a property FROM THE LISTINGS and shows interest, offer a viewing in its OWN message: "Would you like to see it in person?" and STOP - wait for their answer. Do NOT list any days in this same message.
-{availability_context}
 - STRICT SEQUENCE for EACH property being booked:
-  1. Only after they confirm they want a viewing, ask which DAY works, and list ONLY the day names with their dates from the availability above (e.g. "Monday Aug 17, Tuesday Aug 18, Wednesday Aug 19, Thursday Aug 20, Friday Aug 21, Saturday Aug 22"). Do NOT list any time slots yet - that comes after they pick a day.
+  1. Only after they confirm they want a viewing, ask which DAY works, and list ONLY the day names with their dates from the VIEWING AVAILABILITY below (e.g. "Monday Aug 17, Tuesday Aug 18, Wednesday Aug 19, Thursday Aug 20, Friday Aug 21, Saturday Aug 22"). Do NOT list any time slots yet - that comes after they pick a day.
   2. Once they pick a day, THEN list the open time slots for THAT DAY ONLY (e.g. "10:00 AM, 12:00 PM, 2:00 PM, 4:00 PM, 6:00 PM").
   3. Once they pick a time, confirm that ONE property's booking by name: "You're booked for [Property Name] on [full date] at [Time]."
 - NEVER list multiple days' worth of time slots in a single message. NEVER dump every day and every time slot together - this is overwhelming and error-prone. One day list, then later one time list, per property.
@@ -2783,166 +4389,441 @@ HANDLING HESITATION:
 LANGUAGE:
 - Detect the visitor's language and respond in that same language throughout
 - When mentioning viewing time slots in another language, keep the exact time format like 10:00 AM, 2:00 PM so the customer can reply with it
+"""
 
-Respond naturally in plain text only:"""
 
-        objection = detect_objection(user_message)
-        objection_context = ""
-        if objection:
-            suggested_response = generate_objection_response(objection, agency.name)
-            if suggested_response:
-                objection_context = f"\n\nNOTE: User expressed a '{objection}' concern. Respond with empathy: '{suggested_response}'"
+def chat_session_key(agency_id, widget_session_id=None, visitor_ip=None, user_agent=''):
+    """The widget's per-page-load session_id, else a visitor fingerprint."""
+    if widget_session_id:
+        return f"{agency_id}_{widget_session_id}"
+    visitor_ip = visitor_ip or "unknown"
+    session_hash = hashlib.md5(f"{visitor_ip}{user_agent}".encode()).hexdigest()[:12]
+    return f"{agency_id}_{session_hash}"
+
+
+def prepare_chat_turn(data, visitor_ip=None, user_agent=''):
+    """Everything a /chat turn does BEFORE the model is called: resolves the
+    session, appends the user's message and builds the prompt. Returns
+    (turn, None) on success or (None, error_response). visitor_ip and
+    user_agent only key the session when the widget sent no session_id."""
+    user_message = data.get("message", "").strip()
+    agency_id = int(data.get("agency_id"))
+    session_key = chat_session_key(agency_id, data.get("session_id"), visitor_ip, user_agent)
+    if not user_message:
+        return None, (jsonify({"error": "Message required"}), 400)
+    agency = db.session.get(Agency, agency_id)
+    if not agency:
+        return None, (jsonify({"error": "Invalid agency ID"}), 400)
+
+    history, booked_slots, conv_state, summary, summary_upto = load_chat_session(session_key)
+    history.append({"role": "user", "content": user_message})
+    update_conversation_state(agency_id, conv_state, history)
+
+    availability = get_availability(agency)
+    max_slot = availability['capacity']
+    listings_context = get_listings_context(agency_id, history, conv_state)
+    availability_context = availability['context']
+
+    # Static prefix first, per-turn blocks after it: prompt caching only
+    # matches an identical prefix.
+    system_prompt = (build_static_prompt(agency)
+                     + f"{listings_context}\n{availability_context}\n\n"
+                     + "Respond naturally in plain text only:")
+
+    objection = detect_objection(user_message)
+    objection_context = ""
+    if objection:
+        suggested_response = generate_objection_response(objection, agency.name)
+        if suggested_response:
+            objection_context = f"\n\nNOTE: User expressed a '{objection}' concern. Respond with empathy: '{suggested_response}'"
+
+    messages = ([{"role": "system", "content": system_prompt + objection_context}]
+                + build_history_messages(history, summary, summary_upto))
+    return {
+        "agency": agency, "agency_id": agency_id, "session_key": session_key,
+        "history": history, "booked_slots": booked_slots, "conv_state": conv_state,
+        "max_slot": max_slot, "messages": messages, "summary_upto": summary_upto,
+    }, None
 
-        messages = [{"role": "system", "content": system_prompt + objection_context}] + history[-20:]
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=350,
-            presence_penalty=0.8,
-            frequency_penalty=0.5
-        )
-        ai_reply = response.choices[0].message.content.strip()
-        history.append({"role": "assistant", "content": ai_reply})
 
-        lead_data = extract_lead_data(agency_id, history)
+CHAT_COMPLETION_ARGS = dict(
+    model="gpt-4o-mini",
+    temperature=0.7,
+    max_tokens=350,
+    presence_penalty=0.8,
+    frequency_penalty=0.5
+)
 
-        # ─── Auto-appointment: books ALL requested slots (multi-property support) ───
-        appt_data = extract_appointment_data(agency_id, history)
 
-        if (appt_data['requested']
-                and appt_data['slots']
-                and lead_data.get('email')
-                and lead_data.get('name')):
-            today_pk = datetime.now(PK_TZ).date()
-            for slot in appt_data['slots']:
-                slot_id = f"{slot['iso']}|{slot['time']}"
-                if slot_id in booked_slots:
-                    continue
-                slot_date = datetime.strptime(slot['iso'], '%Y-%m-%d').date()
-                # Only block genuinely nonsensical dates (past, or wildly far
-                # out) - NOT a tight 7-day ceiling. The availability list
-                # shown to the customer is recalculated fresh from "now" on
-                # every message, so a date that was validly offered can
-                # legitimately fall outside a narrow window by the time
-                # they confirm it later in the same conversation (customers
-                # often take minutes or hours between replies). Rejecting
-                # a date the AI already confirmed to the customer, silently,
-                # is worse than allowing a generous buffer here - the
-                # capacity check right below remains the real business
-                # constraint.
-                if (slot_date - today_pk).days > 30 or slot_date < today_pk:
-                    print(f"⚠️ Date out of sane range: {slot['display']} - not auto-booking")
-                    booked_slots.add(slot_id)
-                    continue
-                booked = slot_booked_count(agency_id, slot['iso'], slot['time'])
-                if booked >= max_slot:
-                    print(f"⚠️ Slot full ({booked}/{max_slot}): {slot['display']} at {slot['time']} - not booking")
-                    booked_slots.add(slot_id)
-                    continue
-                existing_appt = Appointment.query.filter_by(
-                    agency_id=agency_id,
-                    customer_email=lead_data['email'],
-                    appointment_date_iso=slot['iso'],
-                    appointment_time=slot['time']
-                ).first()
-                if existing_appt:
-                    booked_slots.add(slot_id)
-                    continue
-                try:
-                    canonical_name, existing_lead_id = resolve_lead_identity(
-                        agency_id, lead_data['email'], lead_data.get('name'))
-                    preferred_id = None
-                    if existing_lead_id:
-                        lead_row = db.session.get(Lead, existing_lead_id)
-                        if lead_row:
-                            preferred_id = lead_row.agent_id
-                    chosen_agent = pick_agent_for_slot(agency, slot['iso'], slot['time'], preferred_id)
-                    if chosen_agent:
-                        print(f"👥 Appointment → agent {chosen_agent.name} (ID {chosen_agent.id})")
-                    new_appt = Appointment(
-                        agency_id=agency_id,
-                        agent_id=chosen_agent.id if chosen_agent else None,
-                        lead_id=existing_lead_id,
-                        customer_name=canonical_name,
-                        customer_email=lead_data['email'],
-                        appointment_date=slot['display'],
-                        appointment_date_iso=slot['iso'],
-                        appointment_time=slot['time'],
-                        property_interest=slot.get('property') or ((lead_data.get('budget') or '') + ' property viewing'),
-                        status='pending'
-                    )
-                    db.session.add(new_appt)
-                    db.session.commit()
-                    booked_slots.add(slot_id)
-                    print(f"✅ Appointment auto-booked: {new_appt.customer_name} | {slot['display']} at {slot['time']} ({booked + 1}/{max_slot})")
-                    send_appointment_confirmation(agency, new_appt)
-                    if chosen_agent:
-                        notify_agent(chosen_agent,
-                            f"📅 New Viewing Assigned - {new_appt.customer_name}",
-                            f"Hi {chosen_agent.name},\n\nA viewing was booked and assigned to you:\n\nCustomer: {new_appt.customer_name}\nEmail: {new_appt.customer_email}\nDate: {new_appt.appointment_date}\nTime: {new_appt.appointment_time}\n\nLogin: https://luxury-leads-ai.onrender.com/agent-login")
-                except Exception as appt_err:
-                    print(f"⚠️ Auto-appointment error: {appt_err}")
-                    db.session.rollback()
-
-        if is_lead_qualified(lead_data, history, has_booking=bool(booked_slots)):
+def completion_usage(usage, latency_ms, first_token_ms=None, streamed=False):
+    """Flattens an OpenAI `usage` object into what ChatCompletionLog stores.
+    Streams only report usage when asked via stream_options."""
+    details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'cached_tokens': getattr(details, 'cached_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'latency_ms': int(latency_ms),
+        'first_token_ms': int(first_token_ms) if first_token_ms is not None else None,
+        'streamed': streamed,
+    }
+
+
+def log_chat_completion(turn):
+    """Queues the turn's usage row; committed together with the session."""
+    usage = turn.get("usage")
+    if not usage:
+        return
+    db.session.add(ChatCompletionLog(agency_id=turn["agency_id"], session_key=turn["session_key"],
+                                     model=CHAT_COMPLETION_ARGS["model"], **usage))
+    print(f"🧮 Prompt cache: {usage['cached_tokens']}/{usage['prompt_tokens']} tokens cached, "
+          f"{usage['latency_ms']}ms (agency {turn['agency_id']})")
+
+
+def book_chat_slot(agency, lead_data, slot):
+    """Books one {'iso', 'time', 'display', 'property'} slot for a chat's
+    customer: agent picked and the place reserved atomically, the
+    confirmation and agent emails queued in the same commit. Returns the
+    Appointment, or None if a parallel booking took the last place."""
+    canonical_name, existing_lead_id = resolve_lead_identity(
+        agency.id, lead_data['email'], lead_data.get('name'))
+    preferred_id = None
+    if existing_lead_id:
+        lead_row = db.session.get(Lead, existing_lead_id)
+        if lead_row:
+            preferred_id = lead_row.agent_id
+    new_appt = Appointment(
+        agency_id=agency.id,
+        lead_id=existing_lead_id,
+        customer_name=canonical_name,
+        customer_email=lead_data['email'],
+        appointment_date=slot['display'],
+        appointment_date_iso=slot['iso'],
+        appointment_time=slot['time'],
+        property_interest=slot.get('property') or ((lead_data.get('budget') or '') + ' property viewing'),
+        status='pending'
+    )
+    # Any occupancy read before this is a snapshot - this is the real check.
+    reason, chosen_agent = reserve_slot_with_agent(new_appt, agency, preferred_id)
+    if reason:
+        db.session.rollback()
+        return None
+    if chosen_agent:
+        print(f"👥 Appointment → agent {chosen_agent.name} (ID {chosen_agent.id})")
+    db.session.add(new_appt)
+    db.session.flush()
+    # Emails go out via the job queue, committed atomically
+    # with the appointment itself.
+    enqueue_appointment_confirmation(new_appt.id)
+    if chosen_agent:
+        enqueue_job('notify_agent', {
+            'agent_id': chosen_agent.id,
+            'subject': f"📅 New Viewing Assigned - {new_appt.customer_name}",
+            'body': f"Hi {chosen_agent.name},\n\nA viewing was booked and assigned to you:\n\nCustomer: {new_appt.customer_name}\nEmail: {new_appt.customer_email}\nDate: {new_appt.appointment_date}\nTime: {new_appt.appointment_time}\n\nLogin: https://luxury-leads-ai.onrender.com/agent-login",
+        }, f"appointment_assigned:{new_appt.id}:{chosen_agent.id}")
+    db.session.commit()
+    return new_appt
+
+
+def save_qualified_lead(agency, lead_data, history, booked_slots, conv_state):
+    """Saves (or silently enriches) the chat's lead once it qualifies."""
+    if not is_lead_qualified(lead_data, history, has_booking=bool(booked_slots), state=conv_state):
+        return
+    agency_id = agency.id
+    try:
+        canonical_name, existing_lead_id = resolve_lead_identity(
+            agency_id, lead_data['email'], lead_data.get('name'))
+        existing_lead = db.session.get(Lead, existing_lead_id) if existing_lead_id else None
+        if existing_lead:
+            updated = False
+            if not existing_lead.whatsapp_number and lead_data.get('whatsapp_number'):
+                existing_lead.whatsapp_number = lead_data['whatsapp_number']
+                existing_lead.contact_preference = lead_data['contact_preference']
+                updated = True
+            if not existing_lead.phone and lead_data.get('phone'):
+                existing_lead.phone = lead_data['phone']
+                existing_lead.contact_preference = lead_data['contact_preference']
+                updated = True
+            if updated:
+                db.session.commit()
+                print(f"✅ Lead {existing_lead.id} silently updated")
+            else:
+                print(f"⚠️ Duplicate: {lead_data['email']}")
+        else:
+            quality_score = analyze_lead_quality(lead_data, history)
+            assigned = assign_next_agent(agency)
+            lead = Lead(
+                agency_id=agency_id,
+                agent_id=assigned.id if assigned else None,
+                name=canonical_name,
+                email=lead_data['email'],
+                phone=lead_data.get('phone'),
+                whatsapp_number=lead_data.get('whatsapp_number'),
+                contact_preference=lead_data.get('contact_preference', 'email'),
+                budget=lead_data['budget'],
+                intent_score=quality_score,
+                lead_status='new',
+                notes='[]'
+            )
+            db.session.add(lead)
+            db.session.flush()
+            # The AI summary (a second OpenAI call) and everything that
+            # includes it - lead email, CRM webhook, agent notice - run
+            # in the job worker, not on the visitor's request.
+            enqueue_job('lead_summary', {'lead_id': lead.id, 'history': history},
+                        f"lead_summary:{lead.id}")
+            db.session.commit()
+            print(f"✅ Lead saved: ID {lead.id} | Score: {quality_score}/5")
+    except Exception as save_err:
+        print(f"❌ Lead save error: {save_err}")
+        db.session.rollback()
+
+
+def finish_chat_turn(turn, ai_reply):
+    """Everything a /chat turn does AFTER the reply is known: lead +
+    appointment extraction, auto-booking, lead saving and persisting the
+    session. Shared by the blocking and the streaming endpoint."""
+    agency = turn["agency"]
+    agency_id = turn["agency_id"]
+    session_key = turn["session_key"]
+    history = turn["history"]
+    booked_slots = turn["booked_slots"]
+    conv_state = turn["conv_state"]
+    max_slot = turn["max_slot"]
+
+    history.append({"role": "assistant", "content": ai_reply})
+    update_conversation_state(agency_id, conv_state, history)
+
+    lead_data = extract_lead_data(agency_id, history, conv_state)
+
+    # ─── Auto-appointment: books ALL requested slots (multi-property support) ───
+    appt_data = extract_appointment_data(agency_id, history, conv_state)
+
+    if (appt_data['requested']
+            and appt_data['slots']
+            and lead_data.get('email')
+            and lead_data.get('name')):
+        today_pk = datetime.now(PK_TZ).date()
+        # One grouped query covers every requested slot. Fetched here rather
+        # than reused from prepare_chat_turn, since other customers may
+        # have booked while the model was answering.
+        pending = [s for s in appt_data['slots'] if f"{s['iso']}|{s['time']}" not in booked_slots]
+        occupancy = (slot_occupancy(agency_id, min(s['iso'] for s in pending), max(s['iso'] for s in pending))
+                     if pending else defaultdict(int))
+        for slot in appt_data['slots']:
+            slot_id = f"{slot['iso']}|{slot['time']}"
+            if slot_id in booked_slots:
+                continue
+            slot_date = datetime.strptime(slot['iso'], '%Y-%m-%d').date()
+            # Only block genuinely nonsensical dates (past, or wildly far
+            # out) - NOT a tight 7-day ceiling. The availability list
+            # shown to the customer is recalculated fresh from "now" on
+            # every message, so a date that was validly offered can
+            # legitimately fall outside a narrow window by the time
+            # they confirm it later in the same conversation (customers
+            # often take minutes or hours between replies). Rejecting
+            # a date the AI already confirmed to the customer, silently,
+            # is worse than allowing a generous buffer here - the
+            # capacity check right below remains the real business
+            # constraint.
+            if (slot_date - today_pk).days > 30 or slot_date < today_pk:
+                print(f"⚠️ Date out of sane range: {slot['display']} - not auto-booking")
+                booked_slots.add(slot_id)
+                continue
+            booked = occupancy[(slot['iso'], slot['time'])]
+            if booked >= max_slot:
+                print(f"⚠️ Slot full ({booked}/{max_slot}): {slot['display']} at {slot['time']} - not booking")
+                booked_slots.add(slot_id)
+                continue
+            existing_appt = Appointment.query.filter_by(
+                agency_id=agency_id,
+                customer_email=lead_data['email'],
+                appointment_date_iso=slot['iso'],
+                appointment_time=slot['time']
+            ).first()
+            if existing_appt:
+                booked_slots.add(slot_id)
+                continue
             try:
-                canonical_name, existing_lead_id = resolve_lead_identity(
-                    agency_id, lead_data['email'], lead_data.get('name'))
-                existing_lead = db.session.get(Lead, existing_lead_id) if existing_lead_id else None
-                if existing_lead:
-                    updated = False
-                    if not existing_lead.whatsapp_number and lead_data.get('whatsapp_number'):
-                        existing_lead.whatsapp_number = lead_data['whatsapp_number']
-                        existing_lead.contact_preference = lead_data['contact_preference']
-                        updated = True
-                    if not existing_lead.phone and lead_data.get('phone'):
-                        existing_lead.phone = lead_data['phone']
-                        existing_lead.contact_preference = lead_data['contact_preference']
-                        updated = True
-                    if updated:
-                        db.session.commit()
-                        print(f"✅ Lead {existing_lead.id} silently updated")
-                    else:
-                        print(f"⚠️ Duplicate: {lead_data['email']}")
-                else:
-                    ai_summary = generate_lead_summary(history, agency.name)
-                    quality_score = analyze_lead_quality(lead_data, history)
-                    assigned = assign_next_agent(agency)
-                    lead = Lead(
-                        agency_id=agency_id,
-                        agent_id=assigned.id if assigned else None,
-                        name=canonical_name,
-                        email=lead_data['email'],
-                        phone=lead_data.get('phone'),
-                        whatsapp_number=lead_data.get('whatsapp_number'),
-                        contact_preference=lead_data.get('contact_preference', 'email'),
-                        budget=lead_data['budget'],
-                        message=ai_summary,
-                        intent_score=quality_score,
-                        lead_status='new',
-                        notes='[]'
-                    )
-                    db.session.add(lead)
-                    db.session.commit()
-                    print(f"✅ Lead saved: ID {lead.id} | Score: {quality_score}/5")
-                    send_lead_email(agency, lead)
-                    send_crm_webhook(agency, lead)
-                    if lead.agent_id:
-                        assigned_agent = db.session.get(Agent, lead.agent_id)
-                        notify_agent(assigned_agent,
-                            f"🎯 New Lead Assigned - {lead.name}",
-                            f"Hi {assigned_agent.name},\n\nA new lead was assigned to you:\n\nName: {lead.name}\nEmail: {lead.email}\nBudget: {lead.budget}\n\nLogin: https://luxury-leads-ai.onrender.com/agent-login")
-            except Exception as save_err:
-                print(f"❌ Lead save error: {save_err}")
+                new_appt = book_chat_slot(agency, lead_data, slot)
+                booked_slots.add(slot_id)
+                if not new_appt:
+                    print(f"⚠️ Slot taken by a parallel booking: {slot['display']} at {slot['time']} - not booking")
+                    continue
+                occupancy[(slot['iso'], slot['time'])] += 1
+                print(f"✅ Appointment auto-booked: {new_appt.customer_name} | {slot['display']} at {slot['time']} ({booked + 1}/{max_slot})")
+            except Exception as appt_err:
+                print(f"⚠️ Auto-appointment error: {appt_err}")
                 db.session.rollback()
 
-        save_session(session_key, history, booked_slots)
-        return jsonify({"reply": ai_reply})
+    # Viewing wanted, customer known, no time named yet: the widget offers
+    # its slot picker instead of another round of "which day works?".
+    turn["slot_picker"] = bool(appt_data['requested'] and not appt_data['slots']
+                               and not booked_slots
+                               and lead_data.get('email') and lead_data.get('name'))
+
+    save_qualified_lead(agency, lead_data, history, booked_slots, conv_state)
+
+    log_chat_completion(turn)
+    summary_queued = queue_summary_refresh(session_key, history, turn["summary_upto"])
+    save_session(session_key, history, booked_slots, conv_state, write_through=summary_queued)
+
+
+@app.route("/chat", methods=["POST", "OPTIONS"])
+def chat():
+    if request.method == "OPTIONS":
+        return "", 200
+    try:
+        turn, error = prepare_chat_turn(request.get_json(force=True), request.remote_addr,
+                                        request.headers.get('User-Agent', ''))
+        if error:
+            return error
+        started = time.perf_counter()
+        response = client.chat.completions.create(messages=turn["messages"], **CHAT_COMPLETION_ARGS)
+        turn["usage"] = completion_usage(response.usage, (time.perf_counter() - started) * 1000)
+        ai_reply = response.choices[0].message.content.strip()
+        finish_chat_turn(turn, ai_reply)
+        return jsonify({"reply": ai_reply, "slot_picker": turn["slot_picker"]})
+    except Exception as e:
+        print(f"❌ CHAT ERROR: {e}")
+        return jsonify({"error": "Connection issue"}), 500
+
+
+@app.route("/chat-stream", methods=["POST", "OPTIONS"])
+def chat_stream():
+    """Streaming variant of /chat for the widget: newline-delimited JSON,
+    one {"delta": "..."} line per model token as it arrives, then a final
+    {"done": true, "reply": "...", "slot_picker": bool} line. Lead/appointment extraction runs
+    once the stream completes, exactly as in /chat."""
+    if request.method == "OPTIONS":
+        return "", 200
+    try:
+        turn, error = prepare_chat_turn(request.get_json(force=True), request.remote_addr,
+                                        request.headers.get('User-Agent', ''))
+        if error:
+            return error
     except Exception as e:
         print(f"❌ CHAT ERROR: {e}")
         return jsonify({"error": "Connection issue"}), 500
 
+    def generate():
+        parts, usage, first_token_ms = [], None, None
+        try:
+            started = time.perf_counter()
+            stream = client.chat.completions.create(messages=turn["messages"], stream=True,
+                                                    stream_options={"include_usage": True},
+                                                    **CHAT_COMPLETION_ARGS)
+            for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000
+                    parts.append(delta)
+                    yield json.dumps({"delta": delta}) + "\n"
+            turn["usage"] = completion_usage(usage, (time.perf_counter() - started) * 1000,
+                                             first_token_ms, streamed=True)
+            ai_reply = "".join(parts).strip()
+            finish_chat_turn(turn, ai_reply)
+            yield json.dumps({"done": True, "reply": ai_reply, "slot_picker": turn["slot_picker"]}) + "\n"
+        except Exception as e:
+            print(f"❌ CHAT STREAM ERROR: {e}")
+            db.session.rollback()
+            yield json.dumps({"error": "Connection issue"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ─────────────────────────────────────────────────────
+# WIDGET SLOT PICKER
+# Once the customer wants a viewing and has given name + email, the
+# widget shows the open slots as buttons and books the tap directly -
+# no model round-trips spent on "which day?" / "which time?". The pick
+# is written into the chat session as an ordinary user message, so the
+# conversation state, booked_slots and lead qualification see it exactly
+# as if it had been typed.
+# ─────────────────────────────────────────────────────
+
+@app.route("/widget/availability/<int:agency_id>", methods=["GET"])
+def widget_availability(agency_id):
+    """Open viewing slots from the availability snapshot - no queries
+    while the snapshot is current."""
+    agency = db.session.get(Agency, agency_id)
+    if not agency:
+        return jsonify({"error": "Invalid agency ID"}), 400
+    availability = get_availability(agency)
+    return jsonify({"days": [
+        {"date": d.strftime('%Y-%m-%d'), "label": d.strftime('%a, %b %d'), "slots": list(open_slots)}
+        for d, open_slots in availability['days']
+        if open_slots and (d - availability['today']).days <= AVAILABILITY_PROMPT_DAYS
+    ]})
+
+
+@app.route("/widget/book", methods=["POST", "OPTIONS"])
+def widget_book():
+    if request.method == "OPTIONS":
+        return "", 200
+    try:
+        data = request.get_json(force=True)
+        agency_id = int(data.get("agency_id"))
+        date_iso = (data.get("date") or "").strip()
+        slot_time = (data.get("time") or "").strip()
+        agency = db.session.get(Agency, agency_id)
+        if not agency:
+            return jsonify({"error": "Invalid agency ID"}), 400
+        availability = get_availability(agency)
+        open_slots = {d.strftime('%Y-%m-%d'): s for d, s in availability['days']}
+        if slot_time not in TIME_SLOTS or date_iso not in open_slots:
+            return jsonify({"error": "Invalid date or time"}), 400
+
+        session_key = chat_session_key(agency_id, data.get("session_id"), request.remote_addr,
+                                       request.headers.get('User-Agent', ''))
+        history, booked_slots, conv_state, _, summary_upto = load_chat_session(session_key)
+        update_conversation_state(agency_id, conv_state, history)
+        lead_data = extract_lead_data(agency_id, history, conv_state)
+        if not (lead_data.get('name') and lead_data.get('email')):
+            return jsonify({"error": "Name and email required"}), 400
+
+        display = datetime.strptime(date_iso, '%Y-%m-%d').strftime('%A, %B %d, %Y')
+        slot = {'iso': date_iso, 'display': display, 'time': slot_time,
+                'property': data.get('property') or conv_state['pending_property']}
+        slot_id = f"{date_iso}|{slot_time}"
+        existing_appt = Appointment.query.filter_by(
+            agency_id=agency_id, customer_email=lead_data['email'],
+            appointment_date_iso=date_iso, appointment_time=slot_time).first()
+        if not existing_appt:
+            # The snapshot answers "full" without touching the DB;
+            # reserve_slot_with_agent() stays the real check.
+            if slot_time not in open_slots[date_iso]:
+                return jsonify({"error": "That slot was just taken - please pick another"}), 409
+            existing_appt = book_chat_slot(agency, lead_data, slot)
+            if not existing_appt:
+                return jsonify({"error": "That slot was just taken - please pick another"}), 409
+            print(f"✅ Appointment booked from picker: {existing_appt.customer_name} | {display} at {slot_time}")
+
+        reply = (f"You're all set, {lead_data['name']}! Your viewing is booked for {display} at {slot_time}. "
+                 f"A confirmation is on its way to {lead_data['email']}.")
+        if slot_id not in booked_slots:
+            # A day named earlier without a time would otherwise pair with
+            # this message's time and become a second slot.
+            conv_state['pending_days'] = []
+            history.append({"role": "user", "content": f"I'd like to book a viewing on {display} at {slot_time}."})
+            history.append({"role": "assistant", "content": reply})
+            booked_slots.add(slot_id)
+            update_conversation_state(agency_id, conv_state, history)
+            save_qualified_lead(agency, lead_data, history, booked_slots, conv_state)
+            summary_queued = queue_summary_refresh(session_key, history, summary_upto)
+            save_session(session_key, history, booked_slots, conv_state, write_through=summary_queued)
+        return jsonify({"success": True, "reply": reply, "appointment_id": existing_appt.id})
+    except Exception as e:
+        print(f"❌ WIDGET BOOK ERROR: {e}")
+        db.session.rollback()
+        return jsonify({"error": "Connection issue"}), 500
+
 
 @app.route("/delete-lead/<int:lead_id>", methods=["DELETE"])
 def delete_lead(lead_id):
@@ -2951,6 +4832,7 @@ def delete_lead(lead_id):
         if not lead:
             return jsonify({"error": "Lead not found"}), 404
         db.session.delete(lead)
+        LeadNote.query.filter_by(lead_id=lead_id).delete()
         db.session.commit()
         return jsonify({"message": "Lead deleted"})
     except Exception as e:
@@ -2963,8 +4845,20 @@ def clear_all_leads(agency_id):
         ConversationSession.query.filter(
             ConversationSession.session_key.like(f"{agency_id}_%")
         ).delete(synchronize_session=False)
+        ConversationState.query.filter(
+            ConversationState.session_key.like(f"{agency_id}_%")
+        ).delete(synchronize_session=False)
+        ConversationMessage.query.filter(
+            ConversationMessage.session_key.like(f"{agency_id}_%")
+        ).delete(synchronize_session=False)
+        SessionBookedSlot.query.filter(
+            SessionBookedSlot.session_key.like(f"{agency_id}_%")
+        ).delete(synchronize_session=False)
         deleted_count = Lead.query.filter_by(agency_id=agency_id).delete()
+        LeadNote.query.filter_by(agency_id=agency_id).delete()
+        recount_agent_workload(agency_id)
         db.session.commit()
+        session_store.drop_prefix(f"{agency_id}_")
         return jsonify({"message": f"{deleted_count} leads deleted"})
     except Exception as e:
         db.session.rollback()
@@ -2972,6 +4866,7 @@ def clear_all_leads(agency_id):
 
 
 @app.route("/export/<int:agency_id>")
+@replica_read
 def export_leads(agency_id):
     try:
         leads = Lead.query.filter_by(
@@ -3033,6 +4928,7 @@ def pricing():
 
 
 @app.route("/analytics/<int:agency_id>")
+@replica_read
 def analytics(agency_id):
     agency = db.session.get(Agency, agency_id)
     if not agency:
@@ -3076,6 +4972,39 @@ def analytics(agency_id):
         date_values=date_values, this_month=this_month, last_month=last_month)
 
 
+@app.route("/prompt-cache-stats/<int:agency_id>")
+@replica_read
+def prompt_cache_stats(agency_id):
+    """Last-30-days model usage for an agency: how much of the prompt was
+    served from cache, and latency with vs without a cache hit. ?days=
+    picks another window, 1 to 365."""
+    days = min(max(request.args.get("days", 30, type=int), 1), 365)
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = db.session.query(
+        ChatCompletionLog.cached_tokens > 0,
+        func.count(ChatCompletionLog.id),
+        func.sum(ChatCompletionLog.prompt_tokens),
+        func.sum(ChatCompletionLog.cached_tokens),
+        func.avg(ChatCompletionLog.latency_ms),
+        func.avg(ChatCompletionLog.first_token_ms),
+    ).filter(
+        ChatCompletionLog.agency_id == agency_id,
+        ChatCompletionLog.created_at >= since
+    ).group_by(ChatCompletionLog.cached_tokens > 0).all()
+    stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+    for hit, calls, prompt_tokens, cached_tokens, avg_latency, avg_first_token in rows:
+        stats["calls"] += calls
+        stats["prompt_tokens"] += prompt_tokens or 0
+        stats["cached_tokens"] += cached_tokens or 0
+        stats["cache_hit" if hit else "cache_miss"] = {
+            "calls": calls,
+            "avg_latency_ms": round(avg_latency) if avg_latency is not None else None,
+            "avg_first_token_ms": round(avg_first_token) if avg_first_token is not None else None,
+        }
+    stats["cached_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0
+    return jsonify(stats)
+
+
 @app.route("/update-agency-webhook/<int:agency_id>", methods=["POST"])
 def update_agency_webhook(agency_id):
     agency = db.session.get(Agency, agency_id)
@@ -3094,126 +5023,365 @@ def send_followups():
 
 
 # -------------------------
-# DATABASE INIT
+# SCHEMA MIGRATIONS
+# Ordered, numbered steps - each runs once and is recorded in
+# schema_version. Applied by `python migrate_db.py`, never at import: a
+# worker starting up only reads the current version. Never edit or
+# reorder a released step; append a new one. Steps spell out their own
+# DDL (or use the frozen snapshot below) - never the live models, which
+# would change what an old step does every time a model changes.
 # -------------------------
-with app.app_context():
-    db.create_all()
-    print("✅ Database ready")
-    try:
-        from sqlalchemy import text, inspect
-        inspector = inspect(db.engine)
-        lead_cols = [col['name'] for col in inspector.get_columns('lead')]
-        agency_cols = [col['name'] for col in inspector.get_columns('agency')]
-        appt_cols = [col['name'] for col in inspector.get_columns('appointment')]
-
-        if 'intent_score' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN intent_score INTEGER DEFAULT 1;"))
-            db.session.commit()
-        if 'whatsapp_number' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN whatsapp_number VARCHAR(50);"))
-            db.session.commit()
-        if 'contact_preference' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN contact_preference VARCHAR(20) DEFAULT 'email';"))
-            db.session.commit()
-        if 'follow_up_1_sent' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN follow_up_1_sent INTEGER DEFAULT 0;"))
-            db.session.commit()
-        if 'follow_up_7_sent' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN follow_up_7_sent INTEGER DEFAULT 0;"))
-            db.session.commit()
-        if 'webhook_url' not in agency_cols:
-            db.session.execute(text("ALTER TABLE agency ADD COLUMN webhook_url VARCHAR(500);"))
-            db.session.commit()
-        if 'lead_status' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN lead_status VARCHAR(20) DEFAULT 'new';"))
-            db.session.commit()
-        if 'notes' not in lead_cols:
-            db.session.execute(text("ALTER TABLE lead ADD COLUMN notes TEXT DEFAULT '[]';"))
-            db.session.commit()
 
-        if 'max_viewings_per_slot' not in agency_cols:
-            db.session.execute(text("ALTER TABLE agency ADD COLUMN max_viewings_per_slot INTEGER DEFAULT 2;"))
-            db.session.commit()
-            print("✅ Migration: max_viewings_per_slot added")
-        if 'appointment_date_iso' not in appt_cols:
-            db.session.execute(text("ALTER TABLE appointment ADD COLUMN appointment_date_iso VARCHAR(20);"))
-            db.session.commit()
-            print("✅ Migration: appointment_date_iso added")
-
-            # STEP 4A MIGRATIONS - Tier + Paddle fields
-        for col, ddl in [
-            ('tier', "ALTER TABLE agency ADD COLUMN tier VARCHAR(20) DEFAULT 'solo';"),
-            ('parent_id', "ALTER TABLE agency ADD COLUMN parent_id INTEGER;"),
-            ('paddle_customer_id', "ALTER TABLE agency ADD COLUMN paddle_customer_id VARCHAR(100);"),
-            ('paddle_subscription_id', "ALTER TABLE agency ADD COLUMN paddle_subscription_id VARCHAR(100);"),
-            ('subscription_status', "ALTER TABLE agency ADD COLUMN subscription_status VARCHAR(20) DEFAULT 'active';"),
-            ('trial_ends_at', "ALTER TABLE agency ADD COLUMN trial_ends_at TIMESTAMP;"),
-            ('billing_email', "ALTER TABLE agency ADD COLUMN billing_email VARCHAR(150);"),
-        ]:
-            if col not in agency_cols:
-                db.session.execute(text(ddl))
-                db.session.commit()
-                print(f"✅ Migration: agency.{col} added")
+def _schema_v1():
+    """The tables as they were when versioning began (migrations 1-9).
+    Frozen - a new column or table gets a new step, not an entry here."""
+    md = db.MetaData()
+    C, Int, Str, Text, Float, When = db.Column, db.Integer, db.String, db.Text, db.Float, db.DateTime
+    db.Table('agency', md,
+             C('id', Int, primary_key=True), C('name', Str(100), nullable=False), C('prompt', Text),
+             C('assistant_name', Str(100)), C('owner_name', Str(100)), C('email', Str(150), nullable=False),
+             C('whatsapp', Str(50)), C('password_hash', Str(200)), C('subscription_type', Str(50)),
+             C('status', Str(50)), C('webhook_url', Str(500)), C('max_viewings_per_slot', Int),
+             C('catalog_version', Int), C('tier', Str(20)), C('parent_id', Int),
+             C('paddle_customer_id', Str(100)), C('paddle_subscription_id', Str(100)),
+             C('subscription_status', Str(20)), C('trial_ends_at', When), C('billing_email', Str(150)),
+             C('created_at', When))
+    db.Table('lead', md,
+             C('id', Int, primary_key=True), C('agency_id', Int, nullable=False), C('name', Str(100)),
+             C('email', Str(100)), C('phone', Str(50)), C('whatsapp_number', Str(50)),
+             C('contact_preference', Str(20)), C('budget', Str(50)), C('message', Text),
+             C('intent_score', Int), C('lead_status', Str(20)), C('notes', Text), C('created_at', When),
+             C('follow_up_1_sent', Int), C('follow_up_7_sent', Int), C('agent_id', Int))
+    db.Table('appointment', md,
+             C('id', Int, primary_key=True), C('agency_id', Int, nullable=False), C('lead_id', Int),
+             C('agent_id', Int), C('customer_name', Str(100)), C('customer_email', Str(150)),
+             C('appointment_date', Str(100)), C('appointment_date_iso', Str(20)),
+             C('appointment_time', Str(50)), C('property_interest', Str(200)), C('status', Str(20)),
+             C('notes', Text), C('created_at', When))
+    db.Table('listing', md,
+             C('id', Int, primary_key=True), C('agency_id', Int, nullable=False),
+             C('title', Str(200), nullable=False), C('location', Str(200)), C('price_raw', Str(100)),
+             C('price', Float), C('price_numeric', Float), C('bedrooms', Int), C('bathrooms', Float),
+             C('property_type', Str(50)), C('listing_purpose', Str(10)), C('features', Str(500)),
+             C('description', Text), C('status', Str(20)), C('created_at', When))
+    db.Table('conversation_session', md,
+             C('session_key', Str(120), primary_key=True), C('history', Text), C('booked_slots', Text),
+             C('summary', Text), C('summary_upto', Int), C('updated_at', When, index=True))
+    db.Table('conversation_message', md,
+             C('session_key', Str(120), primary_key=True), C('seq', Int, primary_key=True),
+             C('role', Str(20), nullable=False), C('content', Text), C('created_at', When))
+    db.Table('session_booked_slot', md,
+             C('session_key', Str(120), primary_key=True), C('slot_id', Str(40), primary_key=True))
+    db.Table('conversation_state', md,
+             C('session_key', Str(120), primary_key=True), C('data', Text), C('updated_at', When))
+    db.Table('schema_version', md,
+             C('version', Int, primary_key=True, autoincrement=False), C('description', Str(200)),
+             C('applied_at', When))
+    db.Table('maintenance_lease', md,
+             C('name', Str(50), primary_key=True), C('holder', Str(120)),
+             C('expires_at', When, nullable=False))
+    db.Table('background_job', md,
+             C('id', Int, primary_key=True), C('kind', Str(50), nullable=False), C('payload', Text),
+             C('idempotency_key', Str(200), unique=True, nullable=False), C('status', Str(20)),
+             C('attempts', Int), C('max_attempts', Int), C('run_after', When, index=True),
+             C('locked_at', When), C('last_error', Text), C('created_at', When), C('updated_at', When))
+    db.Table('chat_completion_log', md,
+             C('id', Int, primary_key=True), C('agency_id', Int, nullable=False, index=True),
+             C('session_key', Str(120)), C('model', Str(50)), C('prompt_tokens', Int),
+             C('cached_tokens', Int), C('completion_tokens', Int), C('latency_ms', Int),
+             C('first_token_ms', Int), C('streamed', db.Boolean), C('created_at', When, index=True))
+    db.Table('agent', md,
+             C('id', Int, primary_key=True), C('agency_id', Int, nullable=False),
+             C('name', Str(100), nullable=False), C('email', Str(150), nullable=False),
+             C('password_hash', Str(200)), C('status', Str(20)), C('created_at', When))
+    return md
+
+
+def _add_columns(conn, table, columns):
+    existing = {col['name'] for col in db.inspect(conn).get_columns(table)}
+    for col, ddl in columns:
+        if col not in existing:
+            conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {col} {ddl};"))
+            print(f"✅ Migration: {table}.{col} added")
+
+
+def _create_indexes(conn, *indexes):
+    """(name, table, columns) - spelled out so a step keeps creating exactly
+    what it did when released."""
+    for name, table, columns in indexes:
+        conn.execute(db.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns});"))
+        print(f"✅ Migration: index {name}")
+
+
+def _m001_base_tables(conn):
+    # A new database gets every table as of versioning here; the steps
+    # below fill in columns that databases created before it are missing,
+    # and every later table/column arrives through its own step.
+    _schema_v1().create_all(conn)
+
+
+def _m002_lead_contact_columns(conn):
+    _add_columns(conn, 'lead', [
+        ('intent_score', "INTEGER DEFAULT 1"),
+        ('whatsapp_number', "VARCHAR(50)"),
+        ('contact_preference', "VARCHAR(20) DEFAULT 'email'"),
+        ('follow_up_1_sent', "INTEGER DEFAULT 0"),
+        ('follow_up_7_sent', "INTEGER DEFAULT 0"),
+        ('lead_status', "VARCHAR(20) DEFAULT 'new'"),
+        ('notes', "TEXT DEFAULT '[]'"),
+    ])
+    _add_columns(conn, 'agency', [('webhook_url', "VARCHAR(500)")])
 
-        print("✅ All migrations complete")
-    except Exception as e:
-        print(f"⚠️ Migration error: {e}")
-        db.session.rollback()
 
-            # ── STEP 4B MIGRATIONS (self-contained) ──
-    try:
-        from sqlalchemy import text as _text, inspect as _inspect
-        _insp = _inspect(db.engine)
-        _lead_cols = [c['name'] for c in _insp.get_columns('lead')]
-        _appt_cols = [c['name'] for c in _insp.get_columns('appointment')]
+def _m003_catalog_and_slot_columns(conn):
+    _add_columns(conn, 'agency', [
+        ('catalog_version', "INTEGER DEFAULT 0"),
+        ('max_viewings_per_slot', "INTEGER DEFAULT 2"),
+    ])
+    _add_columns(conn, 'appointment', [('appointment_date_iso', "VARCHAR(20)")])
+
+
+def _m004_agency_billing_columns(conn):
+    _add_columns(conn, 'agency', [
+        ('tier', "VARCHAR(20) DEFAULT 'solo'"),
+        ('parent_id', "INTEGER"),
+        ('paddle_customer_id', "VARCHAR(100)"),
+        ('paddle_subscription_id', "VARCHAR(100)"),
+        ('subscription_status', "VARCHAR(20) DEFAULT 'active'"),
+        ('trial_ends_at', "TIMESTAMP"),
+        ('billing_email', "VARCHAR(150)"),
+    ])
 
-        if 'agent_id' not in _lead_cols:
-            db.session.execute(_text("ALTER TABLE lead ADD COLUMN agent_id INTEGER;"))
-            db.session.commit()
-            print("✅ Migration: lead.agent_id added")
-        else:
-            print("✔ lead.agent_id already exists")
 
-        if 'agent_id' not in _appt_cols:
-            db.session.execute(_text("ALTER TABLE appointment ADD COLUMN agent_id INTEGER;"))
-            db.session.commit()
-            print("✅ Migration: appointment.agent_id added")
-        else:
-            print("✔ appointment.agent_id already exists")
-    except Exception as e:
-        print(f"⚠️ 4B migration error: {e}")
-        db.session.rollback()
+def _m005_agents_and_listing_purpose(conn):
+    _add_columns(conn, 'lead', [('agent_id', "INTEGER")])
+    _add_columns(conn, 'appointment', [('agent_id', "INTEGER")])
+    _add_columns(conn, 'listing', [('listing_purpose', "VARCHAR(10) DEFAULT 'sale'")])
 
-    # ── STEP 4C.1 MIGRATIONS (self-contained) ──
-    try:
-        from sqlalchemy import text as _text2, inspect as _inspect2
-        _insp2 = _inspect2(db.engine)
-        _listing_cols = [c['name'] for c in _insp2.get_columns('listing')]
-        if 'listing_purpose' not in _listing_cols:
-            db.session.execute(_text2("ALTER TABLE listing ADD COLUMN listing_purpose VARCHAR(10) DEFAULT 'sale';"))
-            db.session.commit()
-            print("✅ Migration: listing.listing_purpose added")
-        else:
-            print("✔ listing.listing_purpose already exists")
-    except Exception as e:
-        print(f"⚠️ 4C.1 migration error: {e}")
-        db.session.rollback()
 
-    # ── STEP 4C.2 MIGRATIONS (self-contained) ──
-    # Upgrades bathrooms from INTEGER to FLOAT so half-baths (e.g. 4.5)
-    # survive instead of being silently truncated to 4.
-    try:
-        from sqlalchemy import text as _text3
-        db.session.execute(_text3("ALTER TABLE listing ALTER COLUMN bathrooms TYPE FLOAT USING bathrooms::float;"))
-        db.session.commit()
+def _m006_listing_bathrooms_float(conn):
+    # Half-baths (e.g. 4.5) were truncated to 4. SQLite stores the float
+    # as-is whatever the declared type, so only Postgres needs the change.
+    if conn.dialect.name != 'postgresql':
+        return
+    bathrooms = next(c for c in db.inspect(conn).get_columns('listing') if c['name'] == 'bathrooms')
+    if not isinstance(bathrooms['type'], db.Float):
+        conn.execute(db.text("ALTER TABLE listing ALTER COLUMN bathrooms TYPE FLOAT USING bathrooms::float;"))
         print("✅ Migration: listing.bathrooms upgraded to FLOAT")
-    except Exception as e:
+
+
+def _m007_session_summary_columns(conn):
+    _add_columns(conn, 'conversation_session', [
+        ('summary', "TEXT"),
+        ('summary_upto', "INTEGER DEFAULT 0"),
+    ])
+
+
+def _m008_session_reaper_index(conn):
+    conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_conversation_session_updated_at "
+                         "ON conversation_session (updated_at);"))
+
+
+def _m009_pre_versioning_columns(conn):
+    # The oldest databases predate even the ALTERs above (e.g. lead without
+    # created_at) - add any column a table still lacks, nullable, from the
+    # schema as of versioning.
+    inspector = db.inspect(conn)
+    for table in _schema_v1().sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        _add_columns(conn, table.name, [(col.name, col.type.compile(dialect=conn.dialect))
+                                        for col in table.columns if col.name not in existing])
+
+
+def _m010_tenant_query_indexes(conn):
+    # Derived from the hot queries: every lead/appointment/listing read is
+    # scoped by agency_id and then filtered or ordered on the columns below.
+    _create_indexes(conn,
+                    ('ix_lead_agency_score', 'lead', 'agency_id, intent_score, created_at'),
+                    ('ix_lead_agency_agent', 'lead', 'agency_id, agent_id, intent_score, created_at'),
+                    ('ix_lead_agency_email', 'lead', 'agency_id, email'),
+                    ('ix_lead_follow_up_1', 'lead', 'follow_up_1_sent, created_at'),
+                    ('ix_lead_follow_up_7', 'lead', 'follow_up_7_sent, created_at'),
+                    ('ix_appointment_agency_slot', 'appointment',
+                     'agency_id, appointment_date_iso, appointment_time, status'),
+                    ('ix_appointment_agent_slot', 'appointment',
+                     'agent_id, appointment_date_iso, appointment_time, status'),
+                    ('ix_appointment_agency_created', 'appointment', 'agency_id, created_at'),
+                    ('ix_listing_agency_status', 'listing', 'agency_id, status'),
+                    ('ix_agent_agency_status', 'agent', 'agency_id, status'),
+                    ('ix_agent_email', 'agent', 'email'))
+
+
+def _m011_lead_notes_table(conn):
+    # Moves every lead's JSON notes blob into LeadNote rows, oldest first,
+    # keeping author and timestamp. The blob is emptied once copied.
+    md = db.MetaData()
+    lead_note = db.Table('lead_note', md,
+                         db.Column('id', db.Integer, primary_key=True),
+                         db.Column('lead_id', db.Integer, nullable=False, index=True),
+                         db.Column('agency_id', db.Integer, nullable=False, index=True),
+                         db.Column('author', db.String(100)),
+                         db.Column('text', db.Text, nullable=False),
+                         db.Column('created_at', db.DateTime))
+    lead_note.create(conn, checkfirst=True)
+    lead = _schema_v1().tables['lead']
+    rows = conn.execute(db.select(lead.c.id, lead.c.agency_id, lead.c.notes, lead.c.created_at)
+                        .where(lead.c.notes.isnot(None), lead.c.notes.notin_(['', '[]']))).all()
+    copied = 0
+    for lead_id, agency_id, blob, lead_created in rows:
+        try:
+            notes = json.loads(blob)
+        except Exception:
+            continue
+        values = []
+        for note in notes:
+            try:
+                created = datetime.strptime(note.get('timestamp') or '', NOTE_TIMESTAMP_FORMAT)
+            except ValueError:
+                created = lead_created
+            values.append(dict(lead_id=lead_id, agency_id=agency_id, author=note.get('author'),
+                               text=note.get('text') or '', created_at=created))
+        if values:
+            conn.execute(lead_note.insert(), values)
+            copied += len(values)
+        conn.execute(lead.update().where(lead.c.id == lead_id).values(notes='[]'))
+    print(f"✅ Migration: {copied} note(s) from {len(rows)} lead(s) copied to lead_note")
+
+
+def _m012_email_norm_columns(conn):
+    # Backfilled with the SQL equivalent of normalize_email(); new rows get
+    # it from the model validators.
+    _add_columns(conn, 'lead', [('email_norm', "VARCHAR(100)")])
+    _add_columns(conn, 'appointment', [('email_norm', "VARCHAR(150)")])
+    conn.execute(db.text("UPDATE lead SET email_norm = NULLIF(LOWER(TRIM(email)), '');"))
+    conn.execute(db.text("UPDATE appointment SET email_norm = NULLIF(LOWER(TRIM(customer_email)), '');"))
+    _create_indexes(conn, ('ix_lead_agency_email_norm', 'lead', 'agency_id, email_norm'),
+                    ('ix_appointment_agency_email_norm', 'appointment', 'agency_id, email_norm'))
+
+
+def _m013_keyset_sort_columns(conn):
+    # Keyset pages compare (sort key..., id) tuples, and a NULL in a sort
+    # key drops the row from every page after the first - fill the gaps.
+    now = datetime.now(PK_TZ).replace(tzinfo=None)
+    conn.execute(db.text("UPDATE lead SET intent_score = 1 WHERE intent_score IS NULL;"))
+    conn.execute(db.text("UPDATE lead SET created_at = :now WHERE created_at IS NULL;"), {"now": now})
+    conn.execute(db.text("UPDATE appointment SET created_at = :now WHERE created_at IS NULL;"), {"now": now})
+    conn.execute(db.text("UPDATE listing SET status = 'available' WHERE status IS NULL;"))
+    _create_indexes(conn, ('ix_lead_agency_created', 'lead', 'agency_id, created_at'))
+
+
+def _m014_agent_workload_counters(conn):
+    _add_columns(conn, 'agent', [('lead_count', "INTEGER NOT NULL DEFAULT 0"),
+                                 ('appointment_count', "INTEGER NOT NULL DEFAULT 0")])
+    conn.execute(db.text(
+        "UPDATE agent SET "
+        "lead_count = (SELECT COUNT(*) FROM lead WHERE lead.agent_id = agent.id), "
+        "appointment_count = (SELECT COUNT(*) FROM appointment WHERE appointment.agent_id = agent.id "
+        "AND appointment.status != 'cancelled');"))
+
+
+def _m015_slot_counts(conn):
+    db.Table('slot_count', db.MetaData(),
+             db.Column('kind', db.String(10), primary_key=True),
+             db.Column('owner_id', db.Integer, primary_key=True),
+             db.Column('date_iso', db.String(20), primary_key=True),
+             db.Column('time_label', db.String(50), primary_key=True),
+             db.Column('booked', db.Integer, nullable=False)).create(conn, checkfirst=True)
+    live = "FROM appointment WHERE status != 'cancelled' AND appointment_date_iso IS NOT NULL " \
+           "AND appointment_date_iso != '' AND appointment_time IS NOT NULL AND appointment_time != ''"
+    conn.execute(db.text(
+        "INSERT INTO slot_count (kind, owner_id, date_iso, time_label, booked) "
+        f"SELECT 'agency', agency_id, appointment_date_iso, appointment_time, COUNT(*) {live} "
+        "GROUP BY agency_id, appointment_date_iso, appointment_time;"))
+    conn.execute(db.text(
+        "INSERT INTO slot_count (kind, owner_id, date_iso, time_label, booked) "
+        f"SELECT 'agent', agent_id, appointment_date_iso, appointment_time, COUNT(*) {live} "
+        "AND agent_id IS NOT NULL GROUP BY agent_id, appointment_date_iso, appointment_time;"))
+
+
+def _m016_availability_version(conn):
+    _add_columns(conn, 'agency', [('availability_version', "INTEGER DEFAULT 0")])
+
+
+def _m017_counter_defaults(conn):
+    # Migration 9 used to add any missing column straight from the live
+    # models - nullable, no default - so an older database that reached it
+    # after 14/16 existed got agent.lead_count, appointment_count and
+    # agency.availability_version before those steps could add them
+    # properly. Fill the NULLs; Postgres also gets the default/NOT NULL.
+    conn.execute(db.text("UPDATE agent SET lead_count = 0 WHERE lead_count IS NULL;"))
+    conn.execute(db.text("UPDATE agent SET appointment_count = 0 WHERE appointment_count IS NULL;"))
+    conn.execute(db.text("UPDATE agency SET availability_version = 0 WHERE availability_version IS NULL;"))
+    if conn.dialect.name == 'postgresql':
+        for table, col, not_null in (('agent', 'lead_count', True), ('agent', 'appointment_count', True),
+                                     ('agency', 'availability_version', False)):
+            conn.execute(db.text(f"ALTER TABLE {table} ALTER COLUMN {col} SET DEFAULT 0;"))
+            if not_null:
+                conn.execute(db.text(f"ALTER TABLE {table} ALTER COLUMN {col} SET NOT NULL;"))
+
+
+MIGRATIONS = [
+    (1, "base tables", _m001_base_tables),
+    (2, "lead contact / follow-up columns, agency webhook", _m002_lead_contact_columns),
+    (3, "catalog version, slot capacity, appointment ISO date", _m003_catalog_and_slot_columns),
+    (4, "agency tier and billing columns", _m004_agency_billing_columns),
+    (5, "agent assignment, listing purpose", _m005_agents_and_listing_purpose),
+    (6, "listing.bathrooms as FLOAT", _m006_listing_bathrooms_float),
+    (7, "conversation summary columns", _m007_session_summary_columns),
+    (8, "conversation_session.updated_at index", _m008_session_reaper_index),
+    (9, "columns missing from pre-versioning databases", _m009_pre_versioning_columns),
+    (10, "tenant query indexes (lead, appointment, listing, agent)", _m010_tenant_query_indexes),
+    (11, "lead_note table, backfilled from lead.notes", _m011_lead_notes_table),
+    (12, "normalized email on lead and appointment", _m012_email_norm_columns),
+    (13, "keyset sort columns backfilled, lead created_at index", _m013_keyset_sort_columns),
+    (14, "agent workload counters", _m014_agent_workload_counters),
+    (15, "slot_count table, backfilled from live appointments", _m015_slot_counts),
+    (16, "agency availability version", _m016_availability_version),
+    (17, "workload counter / availability version defaults", _m017_counter_defaults),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_schema_version():
+    """Highest applied migration - 0 for a database from before versioning."""
+    try:
+        return db.session.scalar(db.select(func.max(SchemaVersion.version))) or 0
+    except Exception:
         db.session.rollback()
-        print(f"✔ listing.bathrooms FLOAT migration skipped (already applied or n/a): {e}")
+        return 0
+
+
+def run_migrations():
+    """Applies every pending step in order, each in its own transaction
+    together with its schema_version row. Returns the versions applied."""
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    done = current_schema_version()
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= done:
+            continue
+        print(f"🔄 Migration {version}: {description}")
+        with db.engine.begin() as conn:
+            step(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()))
+        applied.append(version)
+    return applied
+
+
+with app.app_context():
+    _schema_version = current_schema_version()
+    if _schema_version < SCHEMA_VERSION:
+        print(f"⚠️ Database schema is at v{_schema_version}, this code expects v{SCHEMA_VERSION} "
+              f"- run: python migrate_db.py")
 
 # -------------------------
 # RUN
 # -------------------------
 if __name__ == "__main__":
+    with app.app_context():
+        run_migrations()
     port = int(os.getenv("PORT", 10000))
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+Async Serving Mode (ASGI)
+/chat and /chat-stream are served natively async: the OpenAI call is
+awaited with AsyncOpenAI, so a conversation waiting on the model holds
+no worker thread. The short DB phases before and after the model call
+run on a small thread pool sized to the SQLAlchemy connection pool.
+Every other route is the unchanged Flask app.
+
+Run:  uvicorn asgi:application --workers 2
+  or: gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 2
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from openai import AsyncOpenAI
+
+from app import (app, db, Agency, CHAT_COMPLETION_ARGS, prepare_chat_turn,
+                 finish_chat_turn, completion_usage)
+
+# Default SQLAlchemy pool is 5 connections + 10 overflow - keep DB threads
+# within it so a burst of turns queues here instead of on the pool.
+DB_THREADS = int(os.getenv("ASYNC_DB_THREADS", "8"))
+
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+flask_app = WsgiToAsgi(app)
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="chat-db")
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+def _in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+async def run_db(fn, *args):
+    """Runs a blocking DB step on the pool, inside its own app context."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _in_app_context, fn, *args)
+
+
+def _prepare(data, visitor_ip, user_agent):
+    turn, error = prepare_chat_turn(data, visitor_ip, user_agent)
+    if error:
+        response, status = error
+        return None, (status, response.get_json())
+    return turn, None
+
+
+def _finish(turn, ai_reply):
+    # The session that loaded the agency closed with the prepare step's
+    # app context - re-attach it to this one.
+    turn["agency"] = db.session.get(Agency, turn["agency_id"])
+    finish_chat_turn(turn, ai_reply)
+
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body or b"{}")
+
+
+def _visitor(scope):
+    client = scope.get("client")
+    headers = dict(scope.get("headers") or [])
+    return (client[0] if client else None,
+            headers.get(b"user-agent", b"").decode("latin-1"))
+
+
+async def _send_json(send, status, payload):
+    await send({"type": "http.response.start", "status": status,
+                "headers": CORS_HEADERS + [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+
+async def chat(scope, receive, send):
+    try:
+        turn, error = await run_db(_prepare, await _read_json(receive), *_visitor(scope))
+        if error:
+            return await _send_json(send, *error)
+        started = time.perf_counter()
+        response = await async_client.chat.completions.create(messages=turn["messages"], **CHAT_COMPLETION_ARGS)
+        turn["usage"] = completion_usage(response.usage, (time.perf_counter() - started) * 1000)
+        ai_reply = response.choices[0].message.content.strip()
+        await run_db(_finish, turn, ai_reply)
+    except Exception as e:
+        print(f"❌ CHAT ERROR: {e}")
+        return await _send_json(send, 500, {"error": "Connection issue"})
+    await _send_json(send, 200, {"reply": ai_reply, "slot_picker": turn["slot_picker"]})
+
+
+async def chat_stream(scope, receive, send):
+    """Same NDJSON protocol as the Flask /chat-stream route."""
+    try:
+        turn, error = await run_db(_prepare, await _read_json(receive), *_visitor(scope))
+    except Exception as e:
+        print(f"❌ CHAT ERROR: {e}")
+        return await _send_json(send, 500, {"error": "Connection issue"})
+    if error:
+        return await _send_json(send, *error)
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": CORS_HEADERS + [(b"content-type", b"application/x-ndjson"),
+                                           (b"cache-control", b"no-cache"),
+                                           (b"x-accel-buffering", b"no")]})
+
+    async def emit(payload, more_body=True):
+        await send({"type": "http.response.body", "body": (json.dumps(payload) + "\n").encode(),
+                    "more_body": more_body})
+
+    parts, usage, first_token_ms = [], None, None
+    try:
+        started = time.perf_counter()
+        stream = await async_client.chat.completions.create(messages=turn["messages"], stream=True,
+                                                            stream_options={"include_usage": True},
+                                                            **CHAT_COMPLETION_ARGS)
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - started) * 1000
+                parts.append(delta)
+                await emit({"delta": delta})
+        turn["usage"] = completion_usage(usage, (time.perf_counter() - started) * 1000,
+                                         first_token_ms, streamed=True)
+        ai_reply = "".join(parts).strip()
+        await run_db(_finish, turn, ai_reply)
+        await emit({"done": True, "reply": ai_reply, "slot_picker": turn["slot_picker"]}, more_body=False)
+    except Exception as e:
+        print(f"❌ CHAT STREAM ERROR: {e}")
+        await emit({"error": "Connection issue"}, more_body=False)
+
+
+ASYNC_ROUTES = {"/chat": chat, "/chat-stream": chat_stream}
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _db_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    handler = ASYNC_ROUTES.get(scope.get("path"))
+    if handler and scope["type"] == "http" and scope["method"] == "POST":
+        return await handler(scope, receive, send)
+    # OPTIONS preflights (CORS) and every other route
+    return await flask_app(scope, receive, send)
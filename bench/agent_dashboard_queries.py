@@ -0,0 +1,113 @@
+"""
+Agent Dashboard Query Count
+Seeds one agent per size (1, 10 and 100 leads/appointments, each with
+notes, related appointments and leads owned by a colleague) and counts
+the SQL statements load_agent_dashboard() and GET /agent-dashboard/<id>
+run. Fails if the count grows with the agent's book.
+
+Run:  python bench/agent_dashboard_queries.py
+      DATABASE_URL=postgresql://... python bench/agent_dashboard_queries.py
+Defaults to a throwaway SQLite file in the temp directory, reseeded
+on every run.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import event
+
+ROOT = Path(__file__).resolve().parent.parent
+DB_FILE = Path(tempfile.gettempdir()) / "luxury_leads_bench_dashboard.db"
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{DB_FILE}")
+sys.path.insert(0, str(ROOT))
+
+if os.environ["DATABASE_URL"] == f"sqlite:///{DB_FILE}" and DB_FILE.exists():
+    DB_FILE.unlink()
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as A
+
+SIZES = (1, 10, 100)
+
+
+def seed(size):
+    """One agency with the measured agent and a colleague; returns the agent id."""
+    agency = A.Agency(name=f"Agency {size}", email=f"agency{size}@x.com", tier="agency")
+    A.db.session.add(agency)
+    A.db.session.flush()
+    me = A.Agent(agency_id=agency.id, name="Me", email=f"me{size}@x.com")
+    colleague = A.Agent(agency_id=agency.id, name="Colleague", email=f"colleague{size}@x.com")
+    A.db.session.add_all([me, colleague])
+    A.db.session.flush()
+    day = datetime.utcnow().date()
+    for i in range(size):
+        mine = A.Lead(agency_id=agency.id, agent_id=me.id, name=f"Mine {i}",
+                      email=f"mine{i}@mail.com", intent_score=i % 5 + 1)
+        theirs = A.Lead(agency_id=agency.id, agent_id=colleague.id, name=f"Theirs {i}",
+                        email=f"theirs{i}@mail.com", intent_score=3)
+        A.db.session.add_all([mine, theirs])
+        A.db.session.flush()
+        A.add_lead_note_row(mine, f"Called {i}", "Me")
+        A.add_lead_note_row(theirs, f"Prefers mornings {i}", "Colleague")
+        slot = (day + timedelta(days=i + 1)).isoformat()
+        A.db.session.add_all([
+            # My viewing for a colleague's lead, and their viewing for mine.
+            A.Appointment(agency_id=agency.id, agent_id=me.id, customer_name=theirs.name,
+                          customer_email=theirs.email, appointment_date=slot, appointment_date_iso=slot,
+                          appointment_time="10:00 AM", status="confirmed"),
+            A.Appointment(agency_id=agency.id, agent_id=colleague.id, customer_name=mine.name,
+                          customer_email=mine.email, appointment_date=slot, appointment_date_iso=slot,
+                          appointment_time="2:00 PM", status="pending"),
+        ])
+    A.db.session.commit()
+    return me.id
+
+
+@contextlib.contextmanager
+def count_statements():
+    counter = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter.append(statement)
+
+    event.listen(A.db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(A.db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def main():
+    client = A.app.test_client()
+    counts = {}
+    with A.app.app_context():
+        with contextlib.redirect_stdout(io.StringIO()):
+            A.run_migrations()
+        agents = {size: seed(size) for size in SIZES}
+        for size, agent_id in agents.items():
+            A.db.session.expunge_all()
+            agent = A.db.session.get(A.Agent, agent_id)
+            with count_statements() as loader:
+                data = A.load_agent_dashboard(agent)
+            assert len(data["leads"]) == size and len(data["appointments"]) == size, size
+            assert len(data["appt_lead_owner"]) == size, size
+            with count_statements() as page:
+                response = client.get(f"/agent-dashboard/{agent_id}")
+            assert response.status_code == 200, (size, response.status_code)
+            counts[size] = (len(loader), len(page))
+
+    print(f"{'leads/appts':>12} {'loader':>8} {'page':>8}")
+    for size, (loader, page) in counts.items():
+        print(f"{size:12} {loader:8} {page:8}")
+    assert len(set(counts.values())) == 1, f"query count grows with the agent's book: {counts}"
+    print("✅ Query count is constant")
+
+
+if __name__ == "__main__":
+    main()
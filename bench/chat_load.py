@@ -0,0 +1,124 @@
+"""
+Chat Load Comparison
+Starts bench/fake_llm.py, then serves the app twice, each time with
+LOAD_WORKERS processes: sync Flask under gunicorn, then
+`uvicorn asgi:application`. Both are pointed at the fake model via
+OPENAI_BASE_URL. Fires bursts of concurrent /chat and /chat-stream
+turns at each and prints wall time and latency per mode. Every turn
+must succeed in both modes.
+
+Run:  python bench/chat_load.py
+      LOAD_LEVELS=20,100,300 LOAD_WORKERS=4 FAKE_LLM_DELAY=2 python bench/chat_load.py
+      DATABASE_URL=postgresql://... python bench/chat_load.py
+Defaults to a throwaway SQLite file in the temp directory, recreated
+on every run. Needs gunicorn and uvicorn (requirements.txt).
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+DB_FILE = Path(tempfile.gettempdir()) / "luxury_leads_bench_load.db"
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{DB_FILE}")
+os.environ.pop("BREVO_API_KEY", None)
+sys.path.insert(0, str(ROOT))
+
+if os.environ["DATABASE_URL"] == f"sqlite:///{DB_FILE}" and DB_FILE.exists():
+    DB_FILE.unlink()
+
+LEVELS = [int(n) for n in os.getenv("LOAD_LEVELS", "20,100").split(",")]
+WORKERS = os.getenv("LOAD_WORKERS", "2")
+FAKE_PORT, APP_PORT = 8100, 8101
+MODES = {
+    "gunicorn sync": [sys.executable, "-m", "gunicorn", "app:app", "-w", WORKERS,
+                      "-b", f"127.0.0.1:{APP_PORT}", "--timeout", "600"],
+    "uvicorn asgi": [sys.executable, "-m", "uvicorn", "asgi:application", "--workers", WORKERS,
+                     "--port", str(APP_PORT), "--log-level", "warning"],
+}
+
+
+def seed():
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as A
+        with A.app.app_context():
+            A.run_migrations()
+            agency = A.Agency(name="Load Agency", email=f"load{os.getpid()}@x.com",
+                              assistant_name="Ava", tier="solo")
+            A.db.session.add(agency)
+            A.db.session.commit()
+            return agency.id
+
+
+@contextlib.contextmanager
+def serve(command, port, env):
+    """Runs a server process until the block exits; waits for it to listen."""
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/", timeout=2)
+                break
+            except httpx.TransportError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError(f"{command[2]} did not start")
+                time.sleep(0.3)
+        yield
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+async def burst(path, n, agency_id):
+    async def turn(client, i):
+        started = time.perf_counter()
+        response = await client.post(path, json={"message": "Hi, I'm looking for a villa", "agency_id": agency_id,
+                                                 "session_id": f"load-{path}-{n}-{time.time_ns()}-{i}"})
+        return time.perf_counter() - started, response.status_code == 200 and b'"reply"' in response.content
+
+    limits = httpx.Limits(max_connections=n + 10)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{APP_PORT}", timeout=600, limits=limits) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(turn(client, i) for i in range(n)))
+        wall = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    return dict(ok=sum(ok for _, ok in results), wall=wall,
+                p50=statistics.median(latencies), p95=latencies[max(int(0.95 * n) - 1, 0)])
+
+
+def main():
+    agency_id = seed()
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{FAKE_PORT}/v1", FAKE_LLM_PORT=str(FAKE_PORT))
+    runs = [(path, n) for n in LEVELS for path in ("/chat", "/chat-stream")]
+    results = {}
+    with serve([sys.executable, "bench/fake_llm.py"], FAKE_PORT, env):
+        for mode, command in MODES.items():
+            print(f"🚀 {mode} ({WORKERS} workers)")
+            with serve(command, APP_PORT, env):
+                for path, n in runs:
+                    results[mode, path, n] = asyncio.run(burst(path, n, agency_id))
+                    print(f"   {path} x{n}: {results[mode, path, n]['wall']:.1f}s")
+
+    print(f"\n{'concurrent turns':22}" + "".join(f"{mode:>34}" for mode in MODES))
+    for path, n in runs:
+        cells = ["{wall:.1f}s wall, p95 {p95:.1f}s, {ok}/{n} ok".format(n=n, **results[mode, path, n])
+                 for mode in MODES]
+        print(f"{n:>4} {path:17}" + "".join(f"{cell:>34}" for cell in cells))
+    failed = [key for key, r in results.items() if r["ok"] != key[2]]
+    assert not failed, f"turns failed: {failed}"
+    print("✅ Every turn succeeded in both modes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Fake LLM Server
+A minimal OpenAI-compatible /v1/chat/completions endpoint (plain and
+streamed) that waits FAKE_LLM_DELAY seconds before answering, so the
+serving modes can be load-tested without an API key or real latency
+noise. Used by bench/chat_load.py.
+
+Run:  python bench/fake_llm.py                       (port 8100)
+      FAKE_LLM_DELAY=2 FAKE_LLM_PORT=9000 python bench/fake_llm.py
+Then point the app at it:  OPENAI_BASE_URL=http://127.0.0.1:8100/v1
+"""
+
+import asyncio
+import json
+import os
+import time
+
+DELAY = float(os.getenv("FAKE_LLM_DELAY", "1.0"))
+PORT = int(os.getenv("FAKE_LLM_PORT", "8100"))
+REPLY = "Lovely to meet you! What kind of property are you looking for?"
+USAGE = {"prompt_tokens": 1200, "completion_tokens": 14, "total_tokens": 1214,
+         "prompt_tokens_details": {"cached_tokens": 1024}}
+
+
+def completion():
+    return {"id": "fake", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY},
+                         "finish_reason": "stop"}],
+            "usage": USAGE}
+
+
+def chunks():
+    base = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake"}
+    for word in REPLY.split(" "):
+        yield dict(base, choices=[{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}])
+    yield dict(base, choices=[], usage=USAGE)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    if not scope["path"].endswith("/chat/completions"):
+        await send({"type": "http.response.start", "status": 404, "headers": []})
+        return await send({"type": "http.response.body", "body": b""})
+
+    await asyncio.sleep(DELAY)
+    if json.loads(body or b"{}").get("stream"):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream")]})
+        for chunk in chunks():
+            await send({"type": "http.response.body", "body": f"data: {json.dumps(chunk)}\n\n".encode(),
+                        "more_body": True})
+        return await send({"type": "http.response.body", "body": b"data: [DONE]\n\n"})
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": json.dumps(completion()).encode()})
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=PORT, log_level="warning")
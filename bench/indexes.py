@@ -0,0 +1,187 @@
+"""
+Index Benchmark
+Seeds a database with 100k leads, 50k appointments and 20k listings
+across 20 agencies, then times the agency-scoped queries and pages
+without the tenant indexes (before) and with them (after).
+
+Run:  python bench/indexes.py
+      BENCH_SCALE=0.1 python bench/indexes.py      (10k / 5k / 2k rows)
+      DATABASE_URL=postgresql://... python bench/indexes.py
+Defaults to a throwaway SQLite file in the temp directory, reseeded
+on every run.
+"""
+
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DB_FILE = Path(tempfile.gettempdir()) / "luxury_leads_bench_indexes.db"
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{DB_FILE}")
+sys.path.insert(0, str(ROOT))
+
+if os.environ["DATABASE_URL"] == f"sqlite:///{DB_FILE}" and DB_FILE.exists():
+    DB_FILE.unlink()
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as A
+
+SCALE = float(os.getenv("BENCH_SCALE", "1"))
+LEADS, APPOINTMENTS, LISTINGS = int(100_000 * SCALE), int(50_000 * SCALE), int(20_000 * SCALE)
+AGENCIES, AGENTS_PER_AGENCY = 20, 5
+AGENCY, AGENT = 7, (7 - 1) * AGENTS_PER_AGENCY + 2
+INDEXED_TABLES = ("lead", "appointment", "listing", "agent")
+
+rnd = random.Random(7)
+
+
+def seed():
+    insert = lambda model, rows: A.db.session.execute(model.__table__.insert(), rows)
+    now = datetime.utcnow()
+    today = now.date()
+
+    def agent_of(agency_id):
+        return rnd.choice([None] + [(agency_id - 1) * AGENTS_PER_AGENCY + k for k in range(1, AGENTS_PER_AGENCY + 1)])
+
+    insert(A.Agency, [dict(id=a, name=f"Agency {a}", email=f"a{a}@x.com", tier="agency", assistant_name="Ava",
+                           prompt="You are a luxury real estate assistant.", catalog_version=0,
+                           availability_version=0, max_viewings_per_slot=2)
+                      for a in range(1, AGENCIES + 1)])
+    insert(A.Agent, [dict(id=(a - 1) * AGENTS_PER_AGENCY + k, agency_id=a, name=f"Agent {a}-{k}",
+                          email=f"ag{a}_{k}@x.com", status="active", created_at=now,
+                          lead_count=0, appointment_count=0)
+                     for a in range(1, AGENCIES + 1) for k in range(1, AGENTS_PER_AGENCY + 1)])
+    insert(A.Lead, [dict(agency_id=i % AGENCIES + 1, name=f"Lead {i}", email=f"lead{i}@mail.com",
+                         email_norm=f"lead{i}@mail.com", budget="$2M", message="...",
+                         intent_score=rnd.randint(1, 5), lead_status="new", notes="[]",
+                         created_at=now - timedelta(minutes=i), follow_up_1_sent=1, follow_up_7_sent=i % 2,
+                         agent_id=agent_of(i % AGENCIES + 1))
+                    for i in range(LEADS)])
+    insert(A.Appointment, [dict(agency_id=i % AGENCIES + 1, agent_id=agent_of(i % AGENCIES + 1),
+                                customer_name=f"Lead {i * 2}", customer_email=f"lead{i * 2}@mail.com",
+                                email_norm=f"lead{i * 2}@mail.com", appointment_date="x",
+                                appointment_date_iso=(today + timedelta(days=rnd.randint(-300, 30))).isoformat(),
+                                appointment_time=rnd.choice(A.TIME_SLOTS),
+                                status=rnd.choice(["pending", "confirmed", "cancelled"]), notes="",
+                                created_at=now - timedelta(minutes=i))
+                           for i in range(APPOINTMENTS)])
+    insert(A.Listing, [dict(agency_id=i % AGENCIES + 1, title=f"Residence {i} Estate", location="Miami",
+                            price_raw="$2,000,000", price=2_000_000 + i, price_numeric=2_000_000 + i,
+                            bedrooms=4, bathrooms=3.5, status=rnd.choice(["available", "available", "sold"]),
+                            listing_purpose="sale", created_at=now)
+                       for i in range(LISTINGS)])
+    A.db.session.commit()
+    for a in range(1, AGENCIES + 1):
+        A.recount_agent_workload(a)
+    A.db.session.commit()
+
+
+def tenant_indexes():
+    return [ix for name in INDEXED_TABLES for ix in A.db.metadata.tables[name].indexes]
+
+
+def set_indexes(enabled):
+    with A.db.engine.begin() as conn:
+        for ix in tenant_indexes():
+            if enabled:
+                ix.create(conn, checkfirst=True)
+            else:
+                ix.drop(conn, checkfirst=True)
+        conn.execute(A.db.text("ANALYZE"))
+
+
+def median_ms(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def query_timings():
+    L, P = A.Lead, A.Appointment
+    today = datetime.utcnow().date()
+    return {
+        "slot_occupancy, 14 days": lambda: A.slot_occupancy(
+            AGENCY, today.isoformat(), (today + timedelta(days=14)).isoformat()),
+        "lead by email (identity)": lambda: L.query.filter_by(
+            agency_id=AGENCY, email_norm="lead4006@mail.com").first(),
+        "leads per agent (recount)": lambda: [L.query.filter_by(agency_id=AGENCY, agent_id=a).count()
+                                             for a in range(31, 36)],
+        "agent calendar slot": lambda: P.query.filter(
+            P.agent_id == AGENT, P.appointment_date_iso == today.isoformat(),
+            P.appointment_time == "10:00 AM", P.status != "cancelled").first(),
+        "admin leads, top 50": lambda: L.query.filter_by(agency_id=AGENCY).order_by(
+            L.intent_score.desc(), L.created_at.desc()).limit(50).all(),
+        "appointments, newest 50": lambda: P.query.filter_by(agency_id=AGENCY).order_by(
+            P.created_at.desc()).limit(50).all(),
+        "available listings": lambda: A.Listing.query.filter_by(agency_id=AGENCY, status="available").count(),
+        "follow-up day 7 scan": lambda: L.query.filter(
+            L.follow_up_7_sent == 0, L.created_at <= datetime(2000, 1, 1)).all(),
+    }
+
+
+def page_timings(client):
+    turn = iter(range(10 ** 6))
+
+    def chat():
+        i = next(turn)
+        return client.post("/chat", json={"message": f"I'm Jo, jo{i}@mail.com - can I view a villa on Monday at 10am?",
+                                          "agency_id": AGENCY, "session_id": f"bench{i}"})
+    return {
+        "/chat turn": chat,
+        "/admin": lambda: client.get(f"/admin?agency_id={AGENCY}"),
+        "/api/leads page": lambda: client.get(f"/api/leads/{AGENCY}"),
+        "/appointments": lambda: client.get(f"/appointments/{AGENCY}"),
+        "/agent-dashboard": lambda: client.get(f"/agent-dashboard/{AGENT}"),
+    }
+
+
+def fake_completion(**kwargs):
+    usage = types.SimpleNamespace(prompt_tokens=0, completion_tokens=0, prompt_tokens_details=None)
+    message = types.SimpleNamespace(content="Lovely - which area are you considering?")
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+
+def measure(client):
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for label, fn in query_timings().items():
+            results[label] = median_ms(fn, 30)
+        for label, fn in page_timings(client).items():
+            response = fn()   # also warms the catalog/availability snapshots
+            assert response.status_code < 400, (label, response.status_code)
+            results[label] = median_ms(fn, 5)
+    return results
+
+
+def main():
+    A.client.chat.completions.create = fake_completion
+    with A.app.app_context():
+        print(f"🌱 Seeding {LEADS} leads, {APPOINTMENTS} appointments, {LISTINGS} listings "
+              f"({A.db.engine.dialect.name})")
+        with contextlib.redirect_stdout(io.StringIO()):
+            A.run_migrations()
+        seed()
+        client = A.app.test_client()
+        set_indexes(False)
+        before = measure(client)
+        set_indexes(True)
+        after = measure(client)
+    print(f"\n{'median ms':30} {'before':>10} {'after':>10}")
+    for label in before:
+        print(f"{label:30} {before[label]:10.1f} {after[label]:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
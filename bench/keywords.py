@@ -0,0 +1,142 @@
+"""
+Keyword Matcher Benchmark
+Times the compiled keyword dictionaries (compile_keywords /
+keyword_hits) against the loops they replaced - `any(kw in text)` per
+entry, and a fresh `re.finditer` per WEEKDAY_WORDS entry - over a
+generated corpus of chat messages, and asserts both give the same
+answer on every message.
+
+Run:  python bench/keywords.py
+      BENCH_MESSAGES=20000 python bench/keywords.py
+"""
+
+import contextlib
+import io
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+sys.path.insert(0, str(ROOT))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as A
+
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "3000"))
+
+# The lists the objection/urgency/contact checks used to spell out inline.
+OBJECTIONS = {
+    'price': ['expensive', 'too much', 'costly', "can't afford", 'cannot afford', 'high price', 'over budget', 'out of my budget'],
+    'timing': ['not ready', 'not sure', 'need time', 'thinking about it', 'maybe later', 'unsure'],
+    'indecision': ['torn', 'confused', 'cant decide', "can't decide"],
+    'trust': ['scam', 'legit', 'is this real', 'can i trust', 'safe', 'reliable'],
+}
+URGENCY = ['asap', 'urgent', 'soon', 'quickly', 'this week', 'this month', 'within', 'month', 'week']
+CONTACT_QUESTION = ["best way to reach you", "how can i reach you", "reach you",
+                    "contact you", "whatsapp, phone, or email", "phone, or email"]
+CONTACT_CHANNEL = ['email', 'e-mail', 'mail', 'correo', 'phone', 'telefon', 'teléfono', 'telefono',
+                   'téléphone', 'telephone', 'telefone', 'telefoon', 'numer', 'número', 'numero']
+NUMBER_QUESTION = ["whatsapp number", "phone number", "your number", "share your number", "what's your"]
+NUMBER_WORDS = ['nummer', 'número', 'numero', 'numéro', 'numer', 'numara']
+
+# (label, word list, compiled matcher) for every substring-semantics check.
+SUBSTRING_CHECKS = [
+    ("booking", A.BOOKING_KEYWORDS, A.BOOKING_MATCHER),
+    ("viewing offer", A.VIEWING_OFFER_PHRASES, A.VIEWING_OFFER_MATCHER),
+    ("name question", A.NAME_QUESTION_PHRASES, A.NAME_QUESTION_MATCHER),
+    ("contact email", A.CONTACT_EMAIL_WORDS, A.CONTACT_EMAIL_MATCHER),
+    ("contact phone", A.CONTACT_PHONE_WORDS, A.CONTACT_PHONE_MATCHER),
+    ("number decline", A.NUMBER_DECLINE_WORDS, A.NUMBER_DECLINE_MATCHER),
+    ("contact question", CONTACT_QUESTION, A.CONTACT_QUESTION_MATCHER),
+    ("contact channel", CONTACT_CHANNEL, A.CONTACT_CHANNEL_MATCHER),
+    ("number question", NUMBER_QUESTION, A.NUMBER_QUESTION_MATCHER),
+    ("number word", NUMBER_WORDS, A.NUMBER_WORD_MATCHER),
+    ("urgency", URGENCY, A.URGENCY_MATCHER),
+] + [(f"objection: {kind}", words, A.OBJECTION_MATCHERS[kind]) for kind, words in OBJECTIONS.items()]
+
+FILLER = ("i am looking for a villa with a pool near the beach, budget around 3 million. "
+          "we are a family of four and would love a garden. what do you have in miami? "
+          "ich suche eine wohnung mit blick aufs meer. je cherche une maison. hola, busco un piso. "
+          "my name is jo and my email is jo@mail.com, call me on +44 7700 900123 please").split()
+
+
+def corpus(n, rnd):
+    vocab = (list(A.WEEKDAY_WORDS) + A.AFFIRMATIVE_WORDS
+             + [w for _, words, _ in SUBSTRING_CHECKS for w in words])
+    messages = []
+    for _ in range(n):
+        words = rnd.choices(FILLER, k=rnd.randint(3, 40))
+        for _ in range(rnd.randint(0, 3)):
+            words.insert(rnd.randint(0, len(words)), rnd.choice(vocab))
+        if rnd.random() < 0.3:
+            words.insert(0, rnd.choice(A.AFFIRMATIVE_WORDS))
+        messages.append(" ".join(words).lower())
+    return messages
+
+
+def old_weekdays(text):
+    positions = []
+    for word, normalized in A.WEEKDAY_WORDS.items():
+        for m in re.finditer(r'\b' + re.escape(word) + r'\b', text):
+            positions.append((m.start(), normalized))
+    positions.sort(key=lambda x: x[0])
+    return list(dict.fromkeys(day for _, day in positions))
+
+
+def new_weekdays(text):
+    return list(dict.fromkeys(A.WEEKDAY_WORDS[word] for _, word in A.keyword_hits(A.WEEKDAY_MATCHER, text)))
+
+
+def old_affirmative(reply):
+    return any(reply == w or reply.startswith(w + ' ') for w in A.AFFIRMATIVE_WORDS)
+
+
+def new_affirmative(reply):
+    return bool(A.AFFIRMATIVE_MATCHER.match(reply))
+
+
+def checks():
+    """label -> (old, new), each taking one lower-cased message."""
+    pairs = {"weekdays": (old_weekdays, new_weekdays),
+             "affirmative": (old_affirmative, new_affirmative)}
+    for label, words, matcher in SUBSTRING_CHECKS:
+        pairs[label] = ((lambda text, words=words: any(w in text for w in words)),
+                        (lambda text, matcher=matcher: bool(matcher.search(text))))
+    return pairs
+
+
+def median_us(fn, messages, runs=5):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for text in messages:
+            fn(text)
+        samples.append((time.perf_counter() - started) * 1e6 / len(messages))
+    return statistics.median(samples)
+
+
+def main():
+    messages = corpus(MESSAGES, random.Random(5))
+    pairs = checks()
+    for label, (old, new) in pairs.items():
+        for text in messages:
+            assert old(text) == new(text), (label, text)
+    print(f"✅ {len(pairs)} checks agree on {len(messages)} messages")
+
+    print(f"\n{'us per message':22} {'old':>9} {'new':>9} {'speedup':>8}")
+    total_old = total_new = 0.0
+    for label, (old, new) in pairs.items():
+        before, after = median_us(old, messages), median_us(new, messages)
+        total_old, total_new = total_old + before, total_new + after
+        print(f"{label:22} {before:9.1f} {after:9.1f} {before / after:7.1f}x")
+    print(f"{'all checks':22} {total_old:9.1f} {total_new:9.1f} {total_old / total_new:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
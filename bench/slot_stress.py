@@ -0,0 +1,122 @@
+"""
+Slot Booking Stress Test
+N threads race POST /book-appointment for the same slot, round after
+round, against a solo agency (max_viewings_per_slot places) and an
+agency whose capacity is its active agents. Every round must end with
+exactly `capacity` bookings, the rest turned away with a 409, and no
+agent double-booked.
+
+Run:  python bench/slot_stress.py
+      STRESS_THREADS=32 STRESS_ROUNDS=50 python bench/slot_stress.py
+      DATABASE_URL=postgresql://... python bench/slot_stress.py
+Defaults to a throwaway SQLite file in the temp directory, recreated
+on every run.
+"""
+
+import collections
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DB_FILE = Path(tempfile.gettempdir()) / "luxury_leads_bench_slots.db"
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{DB_FILE}")
+os.environ.pop("BREVO_API_KEY", None)   # never email the fake customers
+sys.path.insert(0, str(ROOT))
+
+if os.environ["DATABASE_URL"] == f"sqlite:///{DB_FILE}" and DB_FILE.exists():
+    DB_FILE.unlink()
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as A
+
+THREADS = int(os.getenv("STRESS_THREADS", "16"))
+ROUNDS = int(os.getenv("STRESS_ROUNDS", "20"))
+SLOT_TIME = "10:00 AM"
+
+
+def seed():
+    """A solo agency with 2 places per slot and an agency with 3 agents;
+    returns {agency_id: capacity}."""
+    stamp = os.getpid()
+    solo = A.Agency(name="Stress Solo", email=f"solo{stamp}@x.com", tier="solo", max_viewings_per_slot=2)
+    team = A.Agency(name="Stress Team", email=f"team{stamp}@x.com", tier="agency")
+    A.db.session.add_all([solo, team])
+    A.db.session.flush()
+    A.db.session.add_all([A.Agent(agency_id=team.id, name=f"Agent {k}", email=f"agent{k}_{stamp}@x.com")
+                          for k in range(1, 4)])
+    A.db.session.commit()
+    return {agency.id: A.get_slot_capacity(agency) for agency in (solo, team)}
+
+
+def round_dates():
+    """ROUNDS distinct non-Sunday dates, one fresh slot per round."""
+    day = date.today() + timedelta(days=400)
+    while True:
+        if day.weekday() != 6:
+            yield day.isoformat()
+        day += timedelta(days=1)
+
+
+def main():
+    with A.app.app_context():
+        with contextlib.redirect_stdout(io.StringIO()):
+            A.run_migrations()
+        capacities = seed()
+    dates = list(zip(range(ROUNDS), round_dates()))
+    statuses = collections.Counter()
+    barrier = threading.Barrier(THREADS)
+
+    def worker(n):
+        client = A.app.test_client()
+        for r, date_iso in dates:
+            barrier.wait()
+            for agency_id in capacities:
+                response = client.post("/book-appointment", json={
+                    "agency_id": agency_id, "customer_name": f"Racer {n}",
+                    "customer_email": f"racer{n}_{r}@mail.com",
+                    "appointment_date_iso": date_iso, "appointment_time": SLOT_TIME})
+                statuses[agency_id, response.status_code] += 1
+
+    print(f"🏁 {THREADS} threads x {ROUNDS} rounds ({os.environ['DATABASE_URL'].split(':')[0]})")
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    with A.app.app_context():
+        booked = A.db.session.execute(A.db.text(
+            "SELECT agency_id, appointment_date_iso, COUNT(*) FROM appointment "
+            "WHERE status != 'cancelled' AND appointment_time = :time "
+            "GROUP BY agency_id, appointment_date_iso"), {"time": SLOT_TIME}).all()
+        double_booked = A.db.session.execute(A.db.text(
+            "SELECT COUNT(*) FROM (SELECT agent_id FROM appointment "
+            "WHERE agent_id IS NOT NULL AND status != 'cancelled' "
+            "GROUP BY agent_id, appointment_date_iso, appointment_time HAVING COUNT(*) > 1) x")).scalar()
+
+    per_slot = collections.defaultdict(dict)
+    for agency_id, date_iso, n in booked:
+        per_slot[agency_id][date_iso] = n
+    ok = True
+    for agency_id, capacity in capacities.items():
+        counts = [per_slot[agency_id].get(date_iso, 0) for _, date_iso in dates]
+        codes = {code: n for (a, code), n in statuses.items() if a == agency_id}
+        print(f"  agency {agency_id} (capacity {capacity}): per slot min {min(counts)} max {max(counts)}, "
+              f"responses {dict(sorted(codes.items()))}")
+        ok &= all(n == capacity for n in counts)
+        ok &= codes == {200: capacity * ROUNDS, 409: (THREADS - capacity) * ROUNDS}
+    print(f"  agents double-booked: {double_booked}")
+    assert ok and not double_booked, "slot capacity violated"
+    print("✅ Every slot filled to capacity, never past it")
+
+
+if __name__ == "__main__":
+    main()
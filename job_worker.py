@@ -0,0 +1,32 @@
+"""
+Background Job Worker
+Runs the deferred side effects queued by /chat (confirmation emails,
+agent notifications, lead summaries, CRM webhooks) with retries, and
+sweeps expired chat sessions (see reap_expired_sessions).
+Run alongside the web service:  python job_worker.py
+"""
+
+import os
+import time
+
+from app import app, process_pending_jobs, reap_expired_sessions
+
+POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+
+
+def run_worker():
+    print("👷 Job worker started")
+    while True:
+        with app.app_context():
+            try:
+                results = process_pending_jobs()
+                reap_expired_sessions()
+            except Exception as e:
+                print(f"⚠️ Job worker error: {e}")
+                results = {}
+        if not any(results.values()):
+            time.sleep(POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -1,67 +1,29 @@
 """
-Database Migration Script
-Adds intent_score column to existing Lead table
-Run this once to update the database schema
+Database Migrations
+Applies the pending steps in app.MIGRATIONS in order and records each in
+the schema_version table. Run once per deploy, before the web service
+and job worker start:
+    python migrate_db.py            # upgrade to the latest version
+    python migrate_db.py --status   # show applied / pending steps
 """
 
-from app import app, db, Lead
-from sqlalchemy import text
+import sys
 
-print("=" * 60)
-print("🔄 DATABASE MIGRATION - Adding intent_score column")
-print("=" * 60)
-print()
+from app import app, MIGRATIONS, SCHEMA_VERSION, current_schema_version, run_migrations
 
-with app.app_context():
-    try:
-        # Check if column already exists
-        result = db.session.execute(text("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name='lead' AND column_name='intent_score';
-        """))
-        
-        if result.fetchone():
-            print("✅ Column 'intent_score' already exists. No migration needed.")
+
+def show_status():
+    current = current_schema_version()
+    print(f"📊 Schema version {current} of {SCHEMA_VERSION}")
+    for version, description, _ in MIGRATIONS:
+        print(f"  {'✅' if version <= current else '⏳'} {version:>3}  {description}")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        if "--status" in sys.argv:
+            show_status()
         else:
-            print("📝 Adding 'intent_score' column to Lead table...")
-            
-            # Add the column with default value
-            db.session.execute(text("""
-                ALTER TABLE lead 
-                ADD COLUMN intent_score INTEGER DEFAULT 1;
-            """))
-            
-            db.session.commit()
-            
-            print("✅ Column 'intent_score' added successfully!")
-            print()
-            print("📊 Updating existing leads with default score...")
-            
-            # Update existing leads to have score of 3 (medium quality)
-            db.session.execute(text("""
-                UPDATE lead 
-                SET intent_score = 3 
-                WHERE intent_score IS NULL;
-            """))
-            
-            db.session.commit()
-            
-            print("✅ Existing leads updated with default score: 3/5")
-        
-        print()
-        print("=" * 60)
-        print("🎉 MIGRATION COMPLETE!")
-        print("=" * 60)
-        print()
-        
-        # Verify the change
-        result = db.session.execute(text("SELECT COUNT(*) FROM lead;"))
-        count = result.scalar()
-        print(f"📊 Total leads in database: {count}")
-        
-    except Exception as e:
-        print(f"❌ MIGRATION FAILED: {e}")
-        print()
-        print("If you see 'column already exists', that's OK - no action needed.")
-        db.session.rollback()
\ No newline at end of file
+            applied = run_migrations()
+            print(f"🎉 Applied {len(applied)} migration(s) - schema at v{current_schema_version()}"
+                  if applied else f"✔ Schema already at v{SCHEMA_VERSION}")
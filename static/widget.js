@@ -316,6 +316,78 @@
       wrapper.appendChild(bubble);
       messages.appendChild(wrapper);
       messages.scrollTop = messages.scrollHeight;
+      return bubble;
+    }
+
+    // ---------- SLOT PICKER ----------
+    // Shown when the server flags a turn with slot_picker: open days as
+    // chips, then that day's times; a tap books directly (no AI turn).
+    function chip(label, onClick) {
+      const el = document.createElement("button");
+      el.innerText = label;
+      el.style = `
+        padding: 6px 12px;
+        border-radius: 16px;
+        border: 1px solid #25D366;
+        background: transparent;
+        color: #25D366;
+        font-size: 13px;
+        cursor: pointer;
+        font-family: inherit;
+      `;
+      el.onclick = onClick;
+      return el;
+    }
+
+    async function showSlotPicker() {
+      let days;
+      try {
+        const res = await fetch(`${BASE_URL}/widget/availability/${agencyId}`);
+        days = (await res.json()).days || [];
+      } catch {
+        return;
+      }
+      if (!days.length) return;
+
+      const picker = document.createElement("div");
+      picker.style = "display: flex; flex-wrap: wrap; gap: 6px; margin: 4px 0;";
+      messages.appendChild(picker);
+
+      const showDays = () => {
+        picker.innerHTML = "";
+        days.forEach((day) => picker.appendChild(chip(day.label, () => showTimes(day))));
+        messages.scrollTop = messages.scrollHeight;
+      };
+      const showTimes = (day) => {
+        picker.innerHTML = "";
+        picker.appendChild(chip("‹", showDays));
+        day.slots.forEach((time) => picker.appendChild(chip(time, () => bookSlot(day, time))));
+        messages.scrollTop = messages.scrollHeight;
+      };
+      const bookSlot = async (day, time) => {
+        picker.remove();
+        addBubble(`${day.label} at ${time}`, "user");
+        typingIndicator.style.display = "block";
+        try {
+          const res = await fetch(`${BASE_URL}/widget/book`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ agency_id: agencyId, session_id: sessionId, date: day.date, time })
+          });
+          const data = await res.json();
+          typingIndicator.style.display = "none";
+          if (res.ok) {
+            addBubble(data.reply, "ai");
+          } else {
+            addBubble(data.error || "That time didn't work - please pick another.", "ai");
+            if (res.status === 409) showSlotPicker();
+          }
+        } catch {
+          typingIndicator.style.display = "none";
+          addBubble("Connection error. Please check internet.", "ai");
+        }
+      };
+      showDays();
     }
 
     // ---------- SEND MESSAGE ----------
@@ -330,7 +402,7 @@
       messages.scrollTop = messages.scrollHeight;
 
       try {
-        const response = await fetch(`${BASE_URL}/chat`, {
+        const response = await fetch(`${BASE_URL}/chat-stream`, {
           method: "POST",
           headers: { "Content-Type": "application/json" },
           body: JSON.stringify({
@@ -340,18 +412,76 @@
           })
         });
 
-        let data;
-        try {
-          data = await response.json();
-        } catch {
-          data = { reply: "Connection issue. Please try again!" };
+        if (!response.ok || !response.body) {
+          let data;
+          try {
+            data = await response.json();
+          } catch {
+            data = {};
+          }
+          typingIndicator.style.display = "none";
+          addBubble(data.reply || "Connection issue. Please try again!", "ai");
+          return;
         }
 
-        typingIndicator.style.display = "none";
+        // ── Render tokens as they arrive (one JSON object per line) ──
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let bubble = null;
+        let streamed = "";
+
+        const handleLine = (line) => {
+          if (!line.trim()) return;
+          let event;
+          try {
+            event = JSON.parse(line);
+          } catch {
+            return;
+          }
+          if (event.delta) {
+            if (!bubble) {
+              typingIndicator.style.display = "none";
+              bubble = addBubble("", "ai");
+            }
+            streamed += event.delta;
+            bubble.innerText = streamed.trimStart();
+            messages.scrollTop = messages.scrollHeight;
+          } else if (event.error) {
+            // The reply broke off mid-stream - drop the partial text so it
+            // isn't left looking like a complete answer.
+            typingIndicator.style.display = "none";
+            if (bubble) {
+              bubble.innerText = "Connection issue. Please try again!";
+            } else {
+              bubble = addBubble("Connection issue. Please try again!", "ai");
+            }
+          } else if (event.done) {
+            typingIndicator.style.display = "none";
+            const finalText = event.reply || streamed.trim() || "Sorry, could you rephrase?";
+            if (bubble) {
+              bubble.innerText = finalText;
+            } else {
+              bubble = addBubble(finalText, "ai");
+            }
+            if (event.slot_picker) showSlotPicker();
+          }
+        };
+
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split("\n");
+          buffer = lines.pop();
+          lines.forEach(handleLine);
+        }
+        handleLine(buffer);
 
-        setTimeout(() => {
-          addBubble(data.reply || "Sorry, could you rephrase?", "ai");
-        }, 500);
+        typingIndicator.style.display = "none";
+        if (!bubble) {
+          addBubble("Sorry, could you rephrase?", "ai");
+        }
 
       } catch (error) {
         typingIndicator.style.display = "none";